@@ -212,6 +212,25 @@ class AFF4VFS(FlagFramework.CaseTable):
                                           ],
                                         ]
 
+class VFSTree(FlagFramework.CaseTable):
+    """ The ancestors of each directory in the VFS (see
+    FileSystem.tree_rows)
+    """
+    name = 'vfs_tree'
+    index = ['ancestor', 'path']
+    columns = [ [ StringType, dict(name = 'Ancestor', column = 'ancestor', text=True) ],
+                [ StringType, dict(name = 'Path', column = 'path', text=True) ],
+                [ IntegerType, dict(name = 'Depth', column = 'depth') ],
+                ]
+
+    def create(self, dbh):
+        FlagFramework.CaseTable.create(self, dbh)
+
+        ## Index the directories of existing cases
+        try:
+            FileSystem.build_tree_index(dbh.case)
+        except DB.DBError:
+            pass
 
 import unittest
 import pyflag.pyflagsh as pyflagsh
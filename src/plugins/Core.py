@@ -46,6 +46,7 @@ import pyflag.FlagFramework as FlagFramework
 import pyflag.Registry as Registry
 from pyflag.ColumnTypes import AFF4URN, StringType, FilenameType, DeletedType, IntegerType, TimestampType, BigIntegerType
 import pyflag.Magic as Magic
+import pyflag.Store as Store
 
 config.add_option("SCHEMA_VERSION", default=3, absolute=True,
                   help="Current schema version")
@@ -116,6 +117,24 @@ class Scan(Farm.Task):
     def run(self,case=None, inode_id=0, scanners=None, cookie=1, *args, **kwargs):
         if scanners:
             Scanner.scan_inode(case, inode_id, scanners, cookie)
+
+    def coalesce_key(self, argdict, cookie):
+        ## Scans of the same case with the same scanners can be run
+        ## in the same scan loop
+        scanners = argdict.get('scanners') or []
+        return "%s:%s:%s" % (argdict.get('case'), cookie, ','.join(sorted(scanners)))
+
+    def run_many(self, jobs):
+        argdict, cookie = jobs[0]
+        if argdict.get('scanners'):
+            Scanner.scan_inodes(argdict['case'], [ a['inode_id'] for a,c in jobs ],
+                                argdict['scanners'], cookie)
+
+class ScanBatch(Farm.Task):
+    """ A task to scan a batch of inodes in a single job """
+    def run(self,case=None, inode_ids=None, scanners=None, cookie=1, *args, **kwargs):
+        if scanners and inode_ids:
+            Scanner.scan_inodes(case, inode_ids, scanners, cookie)
             
 class DropCase(Farm.Task):
     """ This class is responsible for cleaning up cached data
@@ -155,7 +174,8 @@ class CaseDBInit(FlagFramework.EventHandler):
         `query` MEDIUMTEXT NOT NULL,
         `limit` INT default 0,
         `length` INT default 100,
-        `status` enum('progress','dirty','cached')
+        `status` enum('progress','dirty','cached'),
+        `size` BIGINT default 0
         ) ENGINE=InnoDB""")
 
         case_dbh.execute("""CREATE TABLE sql_cache_tables (
@@ -164,6 +184,14 @@ class CaseDBInit(FlagFramework.EventHandler):
 
         case_dbh.check_index("sql_cache_tables","sql_id")
         case_dbh.check_index("sql_cache_tables","table_name")
+
+        ## Exact row counts of table widget queries (see DBO.cache_count)
+        case_dbh.execute("""CREATE TABLE if not exists `count_cache` (
+        `query_hash` char(32),
+        `table_name` varchar(250),
+        `count` bigint,
+        key(query_hash),
+        key(table_name))""")
         
         case_dbh.execute("""CREATE TABLE if not exists `iosources` (
         `id` INT(11) not null auto_increment,
@@ -218,6 +246,8 @@ class CaseDBInit(FlagFramework.EventHandler):
         priority int default 10,
         when_valid TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL,
 	`cookie` INT(11) not null,
+        pid int default 0,
+        payload mediumblob,
 	key `id`(id)
 	)""")
 
@@ -234,7 +264,9 @@ class CaseDBInit(FlagFramework.EventHandler):
         `query` MEDIUMTEXT NOT NULL,
         `limit` INT default 0,
         `length` INT default 100,
-        `locked` INT default 1
+        `locked` INT default 1,
+        `status` enum('progress','dirty','cached'),
+        `size` BIGINT default 0
         ) ENGINE=InnoDB""")
 
         dbh.execute("""CREATE TABLE `logs` (
@@ -252,10 +284,13 @@ class CaseDBInit(FlagFramework.EventHandler):
         dbh.execute("select value from meta where property='flag_db'")
         DB.check_column_in_table(None, 'sql_cache', 'status',
                                  'enum("progress","dirty","cached")')
+        DB.check_column_in_table(None, 'sql_cache', 'size', 'BIGINT default 0')
         for row in dbh:
             try:
                 DB.check_column_in_table(row['value'], 'sql_cache', 'status',
                                          'enum("progress","dirty","cached")')
+                DB.check_column_in_table(row['value'], 'sql_cache', 'size',
+                                         'BIGINT default 0')
             except: continue
 
         ## Check the schema:
@@ -264,6 +299,8 @@ class CaseDBInit(FlagFramework.EventHandler):
         DB.check_column_in_table(None, 'jobs', 'pid', 'int default 0')
         DB.check_column_in_table(None, 'jobs', 'when_valid',
                                  'TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL')
+        DB.check_column_in_table(None, 'jobs', 'payload', 'mediumblob')
+        dbh.check_index("jobs", "priority")
 
         ## Check for the high_priority_jobs table (its basically
         ## another jobs table for high priority jobs - so workers
@@ -359,7 +396,8 @@ class PyFlagStatistics(Reports.report):
     def display(self, query, result):
         result.heading("PyFlag Statistics")
         dbh = DB.DBO()
-        dbh.execute("select count(*) as count from jobs where state='pending'")
+        dbh.execute("select count(*) as count from jobs where state='pending' "
+                    "and not isnull(payload)")
         row = dbh.fetch()
         result.row("Version", config.VERSION)
         result.row("Outstanding jobs", row['count'])
@@ -368,9 +406,31 @@ class PyFlagStatistics(Reports.report):
         cdbh.execute("select count(*) as count from inode")
         row = cdbh.fetch()
         result.row("Total Inodes in VFS", row['count'])
+
+        stats = DB.CACHE_STATS
+        result.row("Table query cache",
+                   "%s hits, %s misses, %s extensions, %s waits, %s evictions, "
+                   "%s made in %0.2fs" % (stats['hits'], stats['misses'],
+                                          stats['extensions'], stats['waits'],
+                                          stats['evictions'], stats['materialised'],
+                                          stats['materialise_time']))
+
+        for name, cache in sorted(Store.HANDLE_CACHES.items()):
+            result.row("Cached %s" % name,
+                       "%(handles)s open, %(hits)s hits, %(misses)s misses, "
+                       "%(evictions)s evictions" % cache.stats())
+
         result.link("Changelog", url="images/changelog.html")
         result.end_table()
 
+        if config.QUERY_STATS:
+            result.heading("Slowest statements")
+            result.start_table()
+            for template, count, seconds in DB.query_stats()[:20]:
+                result.row(template, "%s executions, %0.2fs total" % (count, seconds))
+
+            result.end_table()
+
         
         pyflaglog.render_system_messages(result)
 
@@ -12,6 +12,7 @@ import time, types
 import pyflag.pyflaglog as pyflaglog
 import BasicCommands
 import pyflag.ScannerUtils as ScannerUtils
+import pyflag.Cookies as Cookies
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 
@@ -35,22 +36,9 @@ class scan_path(pyflagsh.command):
             return dbh.fetch()['path']
         
     def wait_for_scan(self, cookie):
-        """ Waits for scanners to complete """
-        
-        pdbh = DB.DBO()
-        pdbh.check_index('jobs','cookie')
-        
-        ## Often this process owns a worker as well. In that case we can wake it up:
-        Farm.wake_workers()
-        
-        ## Wait until there are no more jobs left.
-        while 1:
-            pdbh.execute("select count(*) as total from jobs where cookie=%r and arg1=%r",
-                         (cookie,
-                          self.environment._CASE))
-            row = pdbh.fetch()
-            if row['total']==0: break
-            time.sleep(1)
+        """ Waits for scanners to complete, yielding their progress """
+        for status in Cookies.wait(cookie):
+            yield Cookies.format_status(status)
 
     def execute(self):
         scanners=[]
@@ -66,35 +54,30 @@ class scan_path(pyflagsh.command):
 
         ## Assume that people always want recursive - I think this makes sense
         path = self.args[0]
-        if not path.endswith("*"):
-            path = path + "*"
-            
-        ## FIXME For massive images this should be broken up, as in the old GUI method
-        dbh=DB.DBO(self.environment._CASE)
-        dbh.execute("select inode_id from vfs where path rlike %r", fnmatch.translate(path))
+        fsfd = FileSystem.DBFS(self.environment._CASE)
+        if FileSystem.glob_prefix(path) == path and fsfd.isdir(path):
+            ## Directories are found in the tree index
+            rows = fsfd.subtree(path, dirs=0)
+        else:
+            if not path.endswith("*"):
+                path = path + "*"
+
+            ## FIXME For massive images this should be broken up, as in the old GUI method
+            dbh=DB.DBO(self.environment._CASE)
+            dbh.execute("select inode_id from vfs where %s",
+                        FileSystem.glob_condition('path', path, recursive=True))
+            rows = dbh
 
-        pdbh = DB.DBO()
-        pdbh.mass_insert_start('jobs')
-    
         ## This is a cookie used to identify our requests so that we
         ## can check they have been done later.
-        cookie = int(time.time())
-            
-        for row in dbh:
-            inode = row['inode_id']
-
-            pdbh.mass_insert(
-                command = 'Scan',
-                arg1 = self.environment._CASE,
-                arg2 = row['inode_id'],
-                arg3 = ','.join(scanners),
-                cookie=cookie,
-                )
-    
-        pdbh.mass_insert_commit()
+        cookie = self.environment.cookie or int(time.time())
+        Scanner.scan_inodes_distributed(self.environment._CASE,
+                                        [ row['inode_id'] for row in rows ],
+                                        scanners, cookie)
     
         ## Wait for the scanners to finish:
-        self.wait_for_scan(cookie)
+        for message in self.wait_for_scan(cookie):
+            yield message
         
         yield "Scanning complete"
 
@@ -155,50 +138,28 @@ class scan(pyflagsh.command):
 
         ## Try to glob the inode list:
         dbh=DB.DBO(self.environment._CASE)
-        dbh.execute("select inode_id from vfs where !isnull(inode_id) and path rlike %r",
-                    (fnmatch.translate(self.args[0])))
-        pdbh = DB.DBO()
-        pdbh.mass_insert_start('jobs')
+        dbh.execute("select inode_id from vfs where !isnull(inode_id) and %s",
+                    FileSystem.glob_condition('path', self.args[0], recursive=True))
         ## This is a cookie used to identify our requests so that we
         ## can check they have been done later.
-        cookie = time.time()
+        cookie = self.environment.cookie or time.time()
         scanners = []
         for i in range(1,len(self.args)):
             scanners.extend(fnmatch.filter(Registry.SCANNERS.scanners, self.args[i]))
 
         scanners = ScannerUtils.fill_in_dependancies(scanners)
-        for row in dbh:
-            Scanner.scan_inode_distributed(dbh.case, row['inode_id'], scanners,
-                                           cookie=cookie)
+        Scanner.scan_inodes_distributed(dbh.case, [ row['inode_id'] for row in dbh ],
+                                        scanners, cookie=cookie)
+
+        for message in self.wait_for_scan(cookie):
+            yield message
 
-            
-        self.wait_for_scan(cookie)
         yield "Scanning complete"
 
     def wait_for_scan(self, cookie):
-        """ Waits for scanners to complete """
-        import pyflag.Farm as Farm
-
-        while Farm.get_cookie_reference(cookie)>0:
-            time.sleep(0.5)
-        
-        return
-    
-        print "Waiting for cookie %s" % cookie
-        pdbh = DB.DBO()
-
-        ## Often this process owns a worker as well. In that case we can wake it up:
-        import pyflag.Farm as Farm
-        
-        #Farm.wake_workers()
-        
-        ## Wait until there are no more jobs left.
-        while 1:
-            pdbh.execute("select * from jobs where cookie=%r limit 1", (cookie))
-            row = pdbh.fetch()
-            if not row: break
-            
-            time.sleep(1)
+        """ Waits for scanners to complete, yielding their progress """
+        for status in Cookies.wait(cookie):
+            yield Cookies.format_status(status)
             
 class scan_inode(scan):
     """ Scan an inode id with the specified scanners """
@@ -234,34 +195,28 @@ class scan_file(scan,BasicCommands.ls):
         if len(self.args)<2:
             yield self.help()
             return
-        pdbh = DB.DBO()
-        pdbh.mass_insert_start('jobs')
-        cookie = int(time.time())
+        ## This is a cookie used to identify our requests so that we
+        ## can check they have been done later.
+        cookie = self.environment.cookie or int(time.time())
         scanners = []
         for i in range(1,len(self.args)):
             scanners.extend(fnmatch.filter(Registry.SCANNERS.scanners, self.args[i]))
 
+        scanners = ScannerUtils.fill_in_dependancies(scanners)
+        inode_ids = []
         for path in self.glob_files(self.args[:1]):
             try:
-                path, inode, inode_id = self.environment._FS.lookup(path = path)
+                inode_ids.append(self.environment._FS.lookup(path = path))
             except Exception,e:
                 continue
-            ## This is a cookie used to identify our requests so that we
-            ## can check they have been done later.
-
-            pdbh.mass_insert(
-                command = 'Scan',
-                arg1 = self.environment._CASE,
-                arg2 = inode_id,
-                arg3 = ','.join(scanners),
-                cookie=cookie,
-                )
-
-        pdbh.mass_insert_commit()
+
+        Scanner.scan_inodes_distributed(self.environment._CASE, inode_ids,
+                                        scanners, cookie)
         
         ## Wait for the scanners to finish:
         if 1 or self.environment.interactive:
-            self.wait_for_scan(cookie)
+            for message in self.wait_for_scan(cookie):
+                yield message
             
         yield "Scanning complete"
 
@@ -304,8 +259,6 @@ class load_and_scan(scan):
         filesystem=self.args[2]
         query = {}
 
-        dbh = DB.DBO()
-        dbh.mass_insert_start('jobs')
         ## This works out all the scanners that were specified:
         tmp = []
         for i in range(3,len(self.args)):
@@ -335,6 +288,27 @@ class load_and_scan(scan):
         fs.load(mnt_point, iosource, scanners)
 
         ## Wait for all the scanners to finish
-        self.wait_for_scan(fs.cookie)
+        for message in self.wait_for_scan(fs.cookie):
+            yield message
         
         yield "Loading complete"
+
+class workers(pyflagsh.command):
+    """ Shows the counters kept by the running workers """
+    def help(self):
+        return "workers: Shows jobs run, time per task, bytes read and memory usage of each worker"
+
+    def execute(self):
+        import pyflag.Farm as Farm
+
+        yield "%8s %8s %10s %12s %8s %8s  %s" % ('pid', 'jobs', 'uptime', 'bytes read',
+                                                 'rss', 'peak', 'tasks (jobs/seconds)')
+        for stats in Farm.get_worker_stats():
+            tasks = [ "%s=%s/%0.1fs" % (name, count, seconds) for
+                      name, (count, seconds) in stats['tasks'].items() ]
+            tasks.sort()
+
+            yield "%8s %8s %9ds %12s %7sM %7sM  %s" % (stats['pid'], stats['jobs'],
+                                                       time.time() - stats['started'],
+                                                       stats['bytes_read'], stats['rss'],
+                                                       stats['peak_rss'], ' '.join(tasks))
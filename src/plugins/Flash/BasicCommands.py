@@ -576,27 +576,20 @@ class find(ls):
                 yield posixpath.normpath( "/////%s/%s" % (file['path'],file['name']))
         
     def list(self,path):
-        """ List the files in a particular path """
+        """ List the files below a particular path """
         path=posixpath.abspath(posixpath.join(self.environment.CWD,path))
         try:
-            if self.environment._FS.isdir(path):
-                if not path.endswith('/'):
-                    path=path+'/'
-
-                for dir in self.environment._FS.longls(path=path, dirs=0):
-                    yield dir
-
-                for dir in self.environment._FS.longls(path=path, dirs=1):
-                    yield dir
-                    for file in self.list(path+dir['name']):
-                        yield file
-
-#            else:
-#                yield {'name':path, 'path':''}
-
+            if not self.environment._FS.isdir(path):
+                return
         except AttributeError:
             raise RuntimeError("No Filesystem loaded, do you need to load a filesystem first?")
 
+        ## Everything below path is found with a single query on the
+        ## directory tree index (rather than listing each directory in
+        ## turn)
+        for row in self.environment._FS.subtree(path):
+            yield row
+
 class find_dict(find):
     """ This command returns a full dict of information for each file returned """
     def execute(self):
@@ -42,6 +42,8 @@ import pyflag.LogFile as LogFile
 import plugins.LogAnalysis.LogAnalysis as LogAnalysis
 import pyflag.pyflaglog as pyflaglog
 import pyflag.ScannerUtils as ScannerUtils
+import pyflag.Cookies as Cookies
+import pyflag.Farm as Farm
 import time
 import plugins.LogAnalysis.Whois as Whois
 from pyflag.ColumnTypes import IPType
@@ -156,6 +158,16 @@ class LoadPresetLog(Reports.report):
         pass
         #LogFile.drop_table(query['case'], query['table'])
 
+class LoadLogChunk(Farm.Task):
+    """ Loads a chunk of a log file (see LogFile.Log.load_chunks) """
+    def run(self, case=None, preset=None, datafile=None, start=0, end=None,
+            name=None, filter=None, **kwargs):
+        count, bytes_read, parse_time, insert_time = LogFile.load_chunk(
+            (case, preset, datafile, start, end, name, filter))
+
+        ## This is reported with the progress of the cookie
+        Farm.add_bytes_scanned(bytes_read)
+
 import pyflag.IO as IO
 
 class LoadIOSource(Reports.report):
@@ -274,6 +286,11 @@ class ScanFS(Reports.report):
     description = "Scan filesystem using spceified scanners"
     family = "Load Data"
     order = 30
+
+    ## The cookies of the scans we started, keyed by canonical
+    ## query. Like report.executing this is a class variable because
+    ## each request gets a new report instance.
+    cookies = {}
     
     def __init__(self,flag,ui=None):
         Reports.report.__init__(self,flag,ui)
@@ -349,18 +366,29 @@ class ScanFS(Reports.report):
             
         #Use pyflash to do all the work
         env = pyflagsh.environment(case=query['case'])
+        env.cookie = int(time.time())
+        self.cookies[FlagFramework.canonicalise(query)] = env.cookie
         pyflagsh.shell_execv(env=env, command="scan_path",
                              argv=[query['path'], scanner_names])
 
-    def progress(self,query,result):
-        result.decoration='naked'
-        result.heading("Scanning path %s" % (query['path']))
-        scanners = self.calculate_scanners(query)
+    def render_jobs(self, query, result):
+        """ Shows the progress of our jobs """
+        cookie = self.cookies.get(FlagFramework.canonicalise(query))
+        if cookie:
+            result.para(Cookies.format_status(Cookies.get_status(cookie)))
+            return
+
         dbh = DB.DBO()
         dbh.execute("select count(*) as jobs from jobs")
         jobs = dbh.fetch()['jobs']
 
         result.para("%s jobs pending (all cases)" % jobs)
+
+    def progress(self,query,result):
+        result.decoration='naked'
+        result.heading("Scanning path %s" % (query['path']))
+        scanners = self.calculate_scanners(query)
+        self.render_jobs(query, result)
         result.para("The following scanners are used: %s" % scanners)
         pyflaglog.render_system_messages(result)
 
@@ -369,6 +397,7 @@ class ScanFS(Reports.report):
         ## where a re-scan on the same directory doesnt work.
         FlagFramework.reset_all(family = query['family'], report=query['report'],
                                 case=query['case'], path=query['path'])
+        self.cookies.pop(FlagFramework.canonicalise(query), None)
 
         ## Browse the filesystem instantly
         result.refresh(0,
@@ -405,6 +434,8 @@ class ScanInode(ScanFS):
         
         #Use pyflash to do all the work
         env = pyflagsh.environment(case=query['case'])
+        env.cookie = int(time.time())
+        self.cookies[FlagFramework.canonicalise(query)] = env.cookie
         pyflagsh.shell_execv(env=env, command="scan",
                              argv=[query['inode'],] + scanner_names)
 
@@ -412,11 +443,7 @@ class ScanInode(ScanFS):
         result.decoration='naked'
         result.heading("Scanning inode %s" % (query['inode']))
         scanners = self.calculate_scanners(query)
-        dbh = DB.DBO()
-        dbh.execute("select count(*) as jobs from jobs")
-        jobs = dbh.fetch()['jobs']
-
-        result.para("%s jobs pending (all cases)" % jobs)
+        self.render_jobs(query, result)
         result.para("The following scanners are used: %s" % scanners)
         pyflaglog.render_system_messages(result)
 
@@ -425,6 +452,7 @@ class ScanInode(ScanFS):
         ## where a re-scan on the same directory doesnt work.
         FlagFramework.reset_all(family = query['family'], report=query['report'],
                                 case=query['case'], path=query['inode'])
+        self.cookies.pop(FlagFramework.canonicalise(query), None)
 
         ## Browse the filesystem instantly
         result.refresh(0,
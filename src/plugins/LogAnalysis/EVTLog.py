@@ -16,6 +16,9 @@ class EventLogLog(Simple.SimpleLog):
     """ Log parser for Windows Event log files """
     name = "Event Logs"
 
+    ## Event logs are binary records, not lines
+    splittable = False
+
     def get_fields(self):
         if self.datafile==None:
             raise IOError("Datafile is not set!!!")
@@ -459,3 +459,28 @@ class SimpleLogTest(LogFile.LogDriverTester):
         dbh.execute("select count(*) as c from `%s_log`", self.test_table_two)
         row = dbh.fetch()
         self.assertEqual(row['c'], 12)
+
+    def test05LoadChunks(self):
+        """ Test that loading in chunks by several processes loads the same rows """
+        dbh = DB.DBO(self.test_case)
+        table = self.test_table_two + " chunked"
+        LogFile.drop_table(self.test_case, table)
+
+        log = LogFile.load_preset(self.test_case, self.log_preset_two, [self.test_file_two])
+        log.chunk_size = 100
+
+        processes = config.LOG_PROCESSES
+        config.LOG_PROCESSES = 3
+        try:
+            for a in log.load(table):
+                pass
+        finally:
+            config.LOG_PROCESSES = processes
+
+        self.assertEqual(log.rows_loaded, 12)
+
+        def rows(table):
+            dbh.execute("select * from `%s_log`", table)
+            return sorted([ sorted(row.items()) for row in dbh ])
+
+        self.assertEqual(rows(table), rows(self.test_table_two))
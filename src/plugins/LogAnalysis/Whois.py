@@ -35,7 +35,7 @@ config=pyflag.conf.ConfObject()
 import re
 import pyflag.pyflaglog as pyflaglog
 import pyflag.Store as Store
-import os
+import os, time, array, bisect, struct, socket, threading
 
 description = "Offline Whois"
 hidden = False
@@ -52,6 +52,10 @@ config.add_option("PRECACHE_WHOIS", default=False, action="store_true",
                   " slow (especially when loading large log "
                   " files). Select this to enable this option.")
 
+config.add_option("NO_WHOIS_ROUTE_INDEX", default=False, action="store_true",
+                  help="Disable the in memory whois route index and look up "
+                  "routes in the database instead")
+
 config.add_option("flush_geocache", default=False, action="store_true",
                   help="Flush the GeoIP/Whois Cache. You will not be able to search on "
                   " GeoIP/Whois data loaded previously until a new lookup is done")
@@ -70,9 +74,17 @@ if config.flush_geocache:
 #config.add_option("SEARCHABLE_ORG
 #config.add_option("SEARCHABLE_ISP
 
-## A cache of whois addresses - This really does not need to be
-## invalidated as the data should never change
-WHOIS_CACHE = Store.Store()
+config.add_option("WHOIS_CACHE_SIZE", default=100000, type='int',
+                  help="The number of IP addresses whose whois and GeoIP "
+                  "data is kept in memory")
+
+## Caches of the whois id (keyed by the numeric address) and the GeoIP
+## record (keyed by the dotted quad) of recently seen addresses. These
+## really do not need to be invalidated as the data should never
+## change.
+CACHE_LOCK = threading.Lock()
+WHOIS_CACHE = Store.LRU(max_items = config.WHOIS_CACHE_SIZE)
+GEOIP_CACHE = Store.LRU(max_items = config.WHOIS_CACHE_SIZE)
 
 ## Try for the GeoIP City Stuff....
 
@@ -132,6 +144,14 @@ if gi_org_resolver or gi_isp_resolver:
                       help="Should we show extended GEOIP information? ")
 
 def get_all_geoip_data(ip):
+    CACHE_LOCK.acquire()
+    try:
+        return GEOIP_CACHE.get(ip)
+    except KeyError:
+        pass
+    finally:
+        CACHE_LOCK.release()
+
     result = {}
     try:
         result.update(gi_resolver.record_by_addr(ip))
@@ -145,29 +165,296 @@ def get_all_geoip_data(ip):
         result.update({"isp":gi_isp_resolver.org_by_addr(ip)})
     except (KeyError,AttributeError): pass
 
+    CACHE_LOCK.acquire()
+    try:
+        GEOIP_CACHE.put(ip, result)
+    finally:
+        CACHE_LOCK.release()
+
+    return result
+
+## The GeoIP dimension tables referenced by whois_cache:
+## (table, column, GeoIP record key, default)
+GEOIP_DIMENSIONS = (("geoip_city", "city", "city", "Unknown"),
+                    ("geoip_country", "country", "country_code3", "---"),
+                    ("geoip_isp", "isp", "isp", "Unknown"),
+                    ("geoip_org", "org", "org", "Unknown"))
+
+def _dimension_key(value):
+    ## MySQL compares strings case insensitively and ignores trailing
+    ## spaces
+    return value.lower().rstrip()
+
+def dimension_ids(dbh, table, column, values):
+    """ Returns a dict of the ids of values in the GeoIP dimension
+    table. Values which are not in the table yet are added.
+
+    values is a dict keyed by the value, with a dict of any other
+    columns to insert with it.
+    """
+    result = {}
+    def fetch(values):
+        for i in range(0, len(values), 1000):
+            dbh.execute("select id, `%s` as value from `%s` where `%s` in (%s)",
+                        (column, table, column, ",".join(
+                [ DB.expand("%r", (v,)) for v in values[i:i+1000] ])))
+            for row in dbh:
+                result[_dimension_key(row['value'])] = row['id']
+
+        return [ v for v in values if _dimension_key(v) not in result ]
+
+    missing = fetch(values.keys())
+    if missing:
+        dbh.mass_insert_start(table, _fast=True)
+        for value in missing:
+            args = dict(values[value])
+            args[column] = value
+            dbh.mass_insert(args)
+
+        dbh.mass_insert_commit()
+        fetch(missing)
+
     return result
 
-def insert_whois_cache(sql_ip, id, ipinfo):
+def int_to_ip(ip):
+    return socket.inet_ntoa(struct.pack("!I", ip))
+
+def enrich_ips(ips):
+    """ Makes sure the whois_cache has a row for each of the ips (dotted
+    quads or unsigned ints).
+
+    The distinct addresses which are not cached are resolved in one
+    go, and their whois_cache rows are added with one multi row
+    insert. Returns a dict of whois ids keyed by the ips.
+    """
+    result = {}
+    missing = {}
+    CACHE_LOCK.acquire()
+    try:
+        for ip in set(ips):
+            if ip is None: continue
+            try:
+                numeric = ip_to_int(ip)
+            except socket.error:
+                pyflaglog.log(pyflaglog.DEBUG, "Invalid IP address %r" % ip)
+                result[ip] = 0
+                continue
+
+            try:
+                result[ip] = WHOIS_CACHE.get(numeric)
+            except KeyError:
+                missing.setdefault(numeric, []).append(ip)
+    finally:
+        CACHE_LOCK.release()
+
+    if not missing: return result
+
     dbh = DB.DBO()
-    dbh.insert("whois_cache",
-               _ip = sql_ip,
-               id = id,
+    dbh.check_index("whois_cache", "ip")
+
+    ## Some of these may already be in the database:
+    ids = {}
+    numerics = missing.keys()
+    for i in range(0, len(numerics), 1000):
+        dbh.execute("select ip, id from whois_cache where ip in (%s)",
+                    ",".join([ "%s" % n for n in numerics[i:i+1000] ]))
+        for row in dbh:
+            ids[row['ip']] = row['id']
+
+    new = [ n for n in numerics if n not in ids ]
+    if new:
+        if config.PRECACHE_WHOIS:
+            whois_ids = lookup_whois_ids(new)
+        else:
+            whois_ids = [0] * len(new)
+
+        records = [ get_all_geoip_data(int_to_ip(n)) for n in new ]
 
-               _geoip_city = DB.expand("(select id from geoip_city where city=%r "
-                                       "limit 1)", (ipinfo.get('city','Unknown'),)) or '',    
-               _geoip_country = DB.expand("(select id from geoip_country where country"
-                                          "=%r limit 1)", (ipinfo.get("country_code3","---"),)),
+        ## Work out the ids of all the GeoIP values in one go
+        dimensions = {}
+        for table, column, key, default in GEOIP_DIMENSIONS:
+            values = {}
+            for record in records:
+                value = record.get(key) or default
+                if table == "geoip_country":
+                    values[value] = dict(country2 = record.get('country_code') or '00')
+                else:
+                    values[value] = {}
 
-               _geoip_org = DB.expand("(select id from geoip_org where org"
-                                      "=%r limit 1)", (ipinfo.get("org","Unknown"),)),
+            dimensions[table] = dimension_ids(dbh, table, column, values)
 
-               _geoip_isp = DB.expand("(select id from geoip_isp where isp"
-                                      "=%r limit 1)", (ipinfo.get("isp","Unknown"),)),
+        dbh.mass_insert_start("whois_cache", _fast=True)
+        for n, whois_id, record in zip(new, whois_ids, records):
+            args = dict(ip = n, id = whois_id)
+            for table, column, key, default in GEOIP_DIMENSIONS:
+                value = _dimension_key(record.get(key) or default)
+                args[table] = dimensions[table].get(value, 0)
 
-               _fast = True
-               )
+            dbh.mass_insert(args)
+            ids[n] = whois_id
+
+        dbh.mass_insert_commit()
+
+    CACHE_LOCK.acquire()
+    try:
+        for n, id in ids.items():
+            WHOIS_CACHE.put(n, id)
+            for ip in missing[n]:
+                result[ip] = id
+    finally:
+        CACHE_LOCK.release()
+
+    return result
+
+class RouteIndex:
+    """ An in memory longest prefix match index of the whois routes.
+
+    Routes nest (a smaller network is always wholly within a larger
+    one) so we flatten them into a sorted list of disjoint intervals,
+    each labeled with the whois id of the most specific route covering
+    it. A lookup is then a single bisection.
+
+    The intervals are kept in two arrays rather than lists of python
+    objects. This keeps the index small, and because reading from it
+    does not touch any reference counts, the pages remain shared
+    between forked workers.
+    """
+    def __init__(self, routes):
+        """ routes is an iterable of (network, netmask, whois_id) """
+        self.starts = array.array('I')
+        self.ids = array.array('i')
+        self.routes = 0
+
+        ## A route listed more than once keeps its last whois id
+        unique = {}
+        for network, netmask, whois_id in routes:
+            unique[(int(network) & MASK32, int(netmask) & MASK32)] = int(whois_id)
+            self.routes += 1
+
+        ## Larger networks sort before the networks they contain
+        blocks = unique.items()
+        blocks.sort()
+
+        ## A stack of (end, whois_id) of the routes enclosing the
+        ## current position:
+        stack = []
+        self._add(0, -1)
+        for (start, netmask), whois_id in blocks:
+            end = start + (netmask ^ MASK32) + 1
+            while stack and stack[-1][0] <= start:
+                self._pop(stack)
+
+            self._add(start, whois_id)
+            stack.append((end, whois_id))
+
+        while stack:
+            self._pop(stack)
+
+    def _pop(self, stack):
+        """ The route at the top of the stack ends here, the enclosing
+        route resumes.
+        """
+        end, whois_id = stack.pop()
+        if stack: whois_id = stack[-1][1]
+        else: whois_id = -1
+
+        if end <= MASK32:
+            self._add(end, whois_id)
+
+    def _add(self, start, whois_id):
+        if self.starts and self.starts[-1] == start:
+            self.ids[-1] = whois_id
+        elif not self.ids or self.ids[-1] != whois_id:
+            self.starts.append(start)
+            self.ids.append(whois_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, ip):
+        """ Returns the whois id of the most specific route for ip (an
+        int or a dotted quad string).
+        """
+        whois_id = self.ids[bisect.bisect_right(self.starts, ip_to_int(ip)) - 1]
+        if whois_id < 0:
+            raise Reports.ReportError("Unable to find whois entry for %s. This should not happen... " % ip)
+
+        return whois_id
+
+    def lookup_many(self, ips):
+        """ Looks up a whole column of ips at once, returning a list
+        of whois ids in the same order.
+        """
+        starts, ids, bisect_right = self.starts, self.ids, bisect.bisect_right
+        result = []
+        for ip in ips:
+            whois_id = ids[bisect_right(starts, ip_to_int(ip)) - 1]
+            if whois_id < 0:
+                raise Reports.ReportError("Unable to find whois entry for %s. This should not happen... " % ip)
+            result.append(whois_id)
+
+        return result
+
+MASK32 = 0xFFFFFFFFL
+
+def ip_to_int(ip):
+    """ Converts a dotted quad into an unsigned int (in host order so
+    it compares numerically). ints are returned unchanged.
+    """
+    try:
+        return struct.unpack("!I", socket.inet_aton(ip.strip()))[0]
+    except AttributeError:
+        return ip
+
+## The route index for this process - it is loaded the first time its
+## needed, or by the prefork event so the workers can share it.
+ROUTE_INDEX = None
+ROUTE_INDEX_LOCK = threading.Lock()
+
+def get_route_index():
+    global ROUTE_INDEX
+
+    ROUTE_INDEX_LOCK.acquire()
+    try:
+        if ROUTE_INDEX is None:
+            start = time.time()
+            dbh = DB.DBO()
+            dbh.stream_execute("select network, netmask, whois_id from whois_routes")
+            routes = []
+            for batch in dbh.iter_batches(10000):
+                routes.extend(batch)
+
+            ROUTE_INDEX = RouteIndex(routes)
+            pyflaglog.log(pyflaglog.DEBUG, "Loaded %s whois routes into %s "
+                          "intervals in %0.2fs" % (ROUTE_INDEX.routes, len(ROUTE_INDEX),
+                                                  time.time() - start))
+        return ROUTE_INDEX
+    finally:
+        ROUTE_INDEX_LOCK.release()
+
+def flush_route_index():
+    """ Forgets the route index (e.g. after the whois db is reloaded) """
+    global ROUTE_INDEX
+    ROUTE_INDEX = None
 
 def lookup_whois_id(dbh, ip):
+    if not config.NO_WHOIS_ROUTE_INDEX:
+        return get_route_index().lookup(ip)
+
+    return lookup_whois_id_sql(dbh, ip)
+
+def lookup_whois_ids(ips):
+    """ Returns the whois ids for a list of ips """
+    if not config.NO_WHOIS_ROUTE_INDEX:
+        return get_route_index().lookup_many(ips)
+
+    dbh = DB.DBO()
+    return [ lookup_whois_id_sql(dbh, ip) for ip in ips ]
+
+def lookup_whois_id_sql(dbh, ip):
+    """ Finds the most specific route by querying the database for
+    each netmask in turn.
+    """
     netmask = 0
     while 1:
         dbh.execute("select whois_id from whois_routes where ( inet_aton(%r) & inet_aton('255.255.255.255') & ~%r ) = network and (inet_aton('255.255.255.255') & ~%r) = netmask limit 1 " , (ip,netmask,netmask))
@@ -190,91 +477,11 @@ def lookup_whois(ip):
     @arg ip: Either an unsigned int or a string IP in decimal notation.
     Returns a whois id. This id can be used to display the whois table.
     """
-    ## Polymorphic code - if its numeric we use it as such - if its a
-    ## string it must be an IP in dot notation.
-    try:
-        ip/2
-        sql_ip = ip
-    except TypeError:
-        if ip == None:
-            pyflaglog.log(pyflaglog.WARNING, "Was asked to perform a whois lookup on a blank IP address. Will return the default route, but this might suggest an error") 
-            return 0
-        sql_ip = "inet_aton(%r)" % ip.strip()
-
-    ## First check the cache:
-    id = 0
-    try:
-        return WHOIS_CACHE.get(ip)
-    except KeyError:
-        dbh = DB.DBO()
-        
-        dbh.check_index("whois_cache", "ip")
-        dbh.execute("select id from whois_cache where ip=%s limit 1" , sql_ip)
-        row = dbh.fetch()
-        if row:
-            id = row['id']
-            WHOIS_CACHE.put(id, key=ip)
-            
-            return id
-
-    if config.PRECACHE_WHOIS:
-        id = lookup_whois_id(dbh, ip)
-    
-    ## Cache it. We also may as well do a GEOIP lookup :)
-    ipinfo = get_all_geoip_data(ip)
-
-    ## For speed we try and do it all in one go
-    try:
-        insert_whois_cache(sql_ip, id, ipinfo)
-    ## we can only assume that we got nothing back from the geoip stuff
-    except DB.DBError,e:
-        ##
-        ## LOOKUP GEOIP COUNTRY
-        ##
-        try:
-            dbh.insert("geoip_country", _fast=True,
-                       country = ipinfo.get('country_code3','---'),
-                       country2 = ipinfo.get('country_code','00'))
-        except DB.DBError, e:
-            pass
-
-        ## 
-        ## LOOKUP GEOIP CITY
-        ##
-        try:
-            dbh.insert("geoip_city", _fast=True,
-                       city=ipinfo.get('city','Unknown'))
-        except DB.DBError, e:
-            pass
-
-        ##
-        ## LOOKUP GEOIP ISP
-        ##
-        try:
-            dbh.insert("geoip_isp", _fast=True,
-                       isp=ipinfo.get('isp','Unknown'))
-        except DB.DBError, e:
-            pass
-
-        ## 
-        ## LOOKUP GEOISP ORG
-        ##
-        try:
-            dbh.insert("geoip_org", _fast=True,
-                       org=ipinfo.get('org','Unknown'))
-        except DB.DBError, e:
-            pass
+    if ip == None:
+        pyflaglog.log(pyflaglog.WARNING, "Was asked to perform a whois lookup on a blank IP address. Will return the default route, but this might suggest an error") 
+        return 0
 
-
-        ## 
-        ## Try again
-        ##
-        try:
-            insert_whois_cache(sql_ip, id, ipinfo)
-        except DB.DBError, e: 
-            pyflaglog.log(pyflaglog.WARNING, "Problem in GeoIP " \
-                          "caching: %s %s" % (e,ip))
-    return id
+    return enrich_ips([ip])[ip]
 
 def _geoip_cached_record(ip):
     dbh = DB.DBO()
@@ -348,12 +555,12 @@ class PrecacheWhois(Reports.report):
         self.count = row['count']
 
         ## Now find all IP addresses:
-        dbh.execute("select count(*) as count, inet_ntoa(`%s`) as ip from `%s` group by `%s`",
-                    (query['column'], query['table'], query['column']))
+        dbh.stream_execute("select count(*) as count, `%s` as ip from `%s` group by `%s`",
+                           (query['column'], query['table'], query['column']))
         
-        for row in dbh:
-            lookup_whois(row['ip'])
-            self.processed += row['count']
+        for counts, ips in dbh.iter_batches(10000, ('count', 'ip'), as_columns=True):
+            enrich_ips(ips)
+            self.processed += sum(counts)
 
     def progress(self, query, result):
         result.heading("Caching IP addresses from table %s" % query['table'])
@@ -498,6 +705,15 @@ class WhoisInit(FlagFramework.EventHandler):
         except:
             pass
 
+    def prefork(self, dbh, case):
+        ## Load the route index before the workers are forked so
+        ## they all share the one copy.
+        if config.PRECACHE_WHOIS and not config.NO_WHOIS_ROUTE_INDEX:
+            try:
+                get_route_index()
+            except DB.DBError, e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to load whois routes: %s" % e)
+
     def init_default_db(self, dbh, case):
         dbh.execute("""CREATE TABLE `whois` (
         `id` int(11) NOT NULL,
@@ -590,51 +806,15 @@ config.add_option("PRECACHE_IPMETADATA", default=True,
 
 def extended_csv(self, value):
     """ This extended csv allows us to render GeoIP data into the output """
-    #if self.callback: return ["-", "-", "-"]
-
-    value.replace("\n","\\n")
-    value.replace("\r","\\r")
-
     geoipdata = get_all_geoip_data(value)
 
-    if geoipdata.has_key("city"):
-        returnCity = geoipdata['city'] or "Unknown"
-    else:
-        returnCity = "Unknown"
-
-    if geoipdata.has_key("country_code3"):
-        returnCountry = geoipdata['country_code3'] or "---"
-    else:
-        returnCountry = "---"
-
-    if geoipdata.has_key("org"):
-        returnOrg = geoipdata['org'] or "Unknown" 
-    else:
-        returnOrg = "Unknown"
-
-    if geoipdata.has_key("isp"):
-        returnISP = geoipdata['isp'] or "Unknown" 
-    else:
-        returnISP = "Unknown"
-
-    if geoipdata.has_key("latitude"):
-        returnLat = geoipdata['latitude'] or "Unknown" 
-    else:
-        returnLat = "Unknown"
-
-    if geoipdata.has_key("longitude"):
-        returnLong = geoipdata['longitude'] or "Unknown"
-    else:
-        returnLong = "Unknown"
-
-    #self.extended_names = [name, name + "_geoip_city", name + "_geoip_country", name + "_whois_organisation", name + "_geoip_isp", name + "_geoip_lat", name + "_geoip_long"]
     return {self.name:value, 
-            self.name + "_geoip_city":returnCity, 
-            self.name + "_geoip_country":returnCountry, 
-            self.name + "_geoip_org":returnOrg, 
-            self.name + "_geoip_isp":returnISP, 
-            self.name + "_geoip_lat":returnLat,
-            self.name + "_geoip_long":returnLong}
+            self.name + "_geoip_city": geoipdata.get('city') or "Unknown",
+            self.name + "_geoip_country": geoipdata.get('country_code3') or "---",
+            self.name + "_geoip_org": geoipdata.get('org') or "Unknown",
+            self.name + "_geoip_isp": geoipdata.get('isp') or "Unknown",
+            self.name + "_geoip_lat": geoipdata.get('latitude') or "Unknown",
+            self.name + "_geoip_long": geoipdata.get('longitude') or "Unknown"}
 
 def operator_whois_country(self, column, operator, country):
     """ Matches the specified country whois string (e.g. AU, US, CA). Note that this works from the whois cache table so you must have allowed complete calculation of whois data when loading the log file or these results will be meaningless. """
@@ -652,19 +832,24 @@ def operator_whois_country(self, column, operator, country):
            % (self.column, config.FLAGDB, config.FLAGDB, config.FLAGDB,
               config.FLAGDB, config.FLAGDB, country)
 
-def code_maxmind_isp_like(self, column, operator, isp):
-    """ Returns true if column has an ISP which contains the word isp in it """
+def code_geoip_like(self, key, pattern):
+    """ Returns a function which matches rows whose GeoIP record has
+    the key matching the pattern. The records come from the GeoIP cache
+    so each address is only looked up once.
+    """
+    ## this is not that accurate but close:
+    regex = re.compile(pattern.replace('%','.*'))
+    column = self.column
     def f(row):
-        data = get_all_geoip_data(row[self.column])
-        ## this is not that accurate but close:
-        clean_isp = isp.replace('%','.*')
-        if 'isp' in data and re.search(clean_isp,data['isp']):
-            return True
-        else:
-            return False
+        data = get_all_geoip_data(row[column])
+        return bool(data.get(key) and regex.search(data[key]))
 
     return f
 
+def code_maxmind_isp_like(self, column, operator, isp):
+    """ Returns true if column has an ISP which contains the word isp in it """
+    return code_geoip_like(self, 'isp', isp)
+
 def code_maxmind_isp(self, column, operator, isp):
     """ Returns true if column has an ISP which contains the word isp in it """
     return self.code_maxmind_isp_like(column, operator, isp)
@@ -705,17 +890,8 @@ def operator_maxmind_isp_like(self, column, operator, isp):
               config.FLAGDB, config.FLAGDB, isp)
 
 def code_maxmind_org(self, column, operator, org):
-    """ Returns true if column has an ISP which contains the word isp in it """
-    def f(row):
-        data = get_all_geoip_data(row[self.column])
-        ## this is not that accurate but close:
-        clean_isp = org.replace('%','.*')
-        if 'org' in data and re.search(clean_isp,data['org']):
-            return True
-        else:
-            return False
-
-    return f
+    """ Returns true if column has an organisation which contains the word org in it """
+    return code_geoip_like(self, 'org', org)
 
 def code_maxmind_org_like(self, column, operator, org):
     return self.code_maxmind_org( column, operator, org)
@@ -753,17 +929,8 @@ def operator_maxmind_org_like(self, column, operator, org):
               config.FLAGDB, config.FLAGDB, org)
 
 def code_maxmind_city(self, column, operator, city):
-    """ Returns true if column has an ISP which contains the word isp in it """
-    def f(row):
-        data = get_all_geoip_data(row[column])
-        ## this is not that accurate but close:
-        clean_isp = isp.replace('%','.*')
-        if 'city' in data and re.search(clean_isp,data['city']):
-            return True
-        else:
-            return False
-
-    return f
+    """ Returns true if column has a city which contains the word city in it """
+    return code_geoip_like(self, 'city', city)
 
 def operator_maxmind_city(self, column, operator, city):
     """ Matches the specified city string (e.g. Canberra, Chicago). Note that this works from the whois cache table so you must have allowed complete calculation of whois data when loading the log file or these results will be meaningless. """
@@ -801,6 +968,7 @@ def operator_maxmind_city(self, column, operator, city):
 #           % (self.column, self.case, self.case, country)
 
 def code_maxmind_country(self, column, operator, country):
+    column = self.column
     def f(row):
         data = get_all_geoip_data(row[column])
         return data.get("country_code3")==country
@@ -894,16 +1062,26 @@ def geoip_render_html(self, value, table_renderer):
     
 
 def insert(self, value):
-    ### When inserted we need to convert them from string to ints
-    if config.PRECACHE_IPMETADATA==True:
-        lookup_whois(value)
-
+    ### When inserted we need to convert them from string to ints. The
+    ### whois data is worked out for all the addresses at once by
+    ### enrich() after the table is loaded.
     return "_"+self.column, "inet_aton(%r)" % value.strip()
+
+def enrich(self, dbh, table):
+    """ Resolves the whois and GeoIP data of all the distinct addresses
+    in the column.
+    """
+    if not config.PRECACHE_IPMETADATA: return
+
+    dbh.stream_execute("select distinct `%s` from `%s`", (self.column, table))
+    for batch in dbh.iter_batches(10000, as_columns=True):
+        enrich_ips(batch[0])
     
 from pyflag.ColumnTypes import IPType, add_display_hook, clear_display_hook
 add_display_hook(IPType, "geoip_display_hook", geoip_display_hook,1)
 
 IPType.insert = insert
+IPType.enrich = enrich
 IPType.extended_csv = extended_csv
 IPType.operator_whois_country = operator_whois_country
 IPType.code_maxmind_isp_like = code_maxmind_isp_like
@@ -955,3 +1133,31 @@ class WhoisTest(unittest.TestCase):
             row = dbh.fetch()
             self.assertEqual(netname, row['netname'])
 
+
+    def test02RouteIndex(self):
+        """ Test the route index finds the most specific route """
+        routes = [ (ip_to_int(network), ip_to_int(netmask), whois_id) for \
+                   network, netmask, whois_id in (
+            ("0.0.0.0", "0.0.0.0", 1),
+            ("10.0.0.0", "255.0.0.0", 2),
+            ("10.1.0.0", "255.255.0.0", 3),
+            ("10.1.2.0", "255.255.255.0", 4),
+            ("10.1.2.128", "255.255.255.128", 5),
+            ("192.168.0.0", "255.255.0.0", 6),
+            ("255.255.255.0", "255.255.255.0", 7),
+            ) ]
+
+        index = RouteIndex(routes)
+        for ip, whois_id in (("9.255.255.255", 1), ("10.0.0.0", 2),
+                             ("10.1.2.3", 4), ("10.1.2.200", 5),
+                             ("10.1.3.0", 3), ("10.2.0.0", 2),
+                             ("11.0.0.0", 1), ("192.168.1.1", 6),
+                             ("192.169.0.0", 1), ("255.255.255.255", 7)):
+            self.assertEqual(index.lookup(ip), whois_id)
+
+        self.assertEqual(index.lookup_many(["10.1.2.3", ip_to_int("10.1.2.200"),
+                                            "1.2.3.4"]), [4, 5, 1])
+
+        ## Without a default route some addresses are not covered
+        index = RouteIndex(routes[1:])
+        self.assertRaises(Reports.ReportError, index.lookup, "11.0.0.0")
@@ -43,7 +43,10 @@ from pyflag.attributes import *
 
 oracle = pyaff4.Resolver()
 
-PCAP_FILE_CACHE = Store.FastStore()
+## Pcap readers keyed by the urn of the pcap file. We hold the File
+## with the reader so we can return its handle when it is evicted.
+PCAP_FILE_CACHE = Store.HandleCache("PCAP readers", max_handles = 10,
+                                    kill_cb = lambda (fd, pcap_file): fd.close())
 
 class PCAPMagic(Magic.Magic):
     """ Identify PCAP files """
@@ -223,7 +226,6 @@ class PCAPScanner(GenScanFactory):
         ## Now process the file
         try:
             pcap_file = pypcap.PyPCAP(fd, file_id=1)
-            PCAP_FILE_CACHE.add(fd.urn, pcap_file)
         except IOError:
             pyflaglog.log(pyflaglog.WARNING,
                           DB.expand("%s does not appear to be a pcap file", fd.urn))
@@ -249,28 +251,31 @@ def dissect_packet(stream_fd):
             not oracle.resolve_value(stream_fd.urn, pyaff4.AFF4_TARGET, urn):
         raise RuntimeError("%s is not a stream" % stream_fd.urn)
 
-    ## Get the file from cache
-    try:
-        pcap_file = PCAP_FILE_CACHE.get(urn.value)
-    except KeyError:
-        pcap_fd = dbfs.open(urn = urn)
-        pcap_file = pypcap.PyPCAP(pcap_fd)
-        PCAP_FILE_CACHE.add(urn.value, pcap_file)
-
     offset = stream_fd.tell()
 
     ## What is the current range?
     (target_offset_at_point,
      available_to_read) =  fd.get_range(offset, None)
+    fd.close()
 
     if available_to_read:
-        ## Go to the packet
-        pcap_file.seek(target_offset_at_point)
+        ## Get the file from cache
+        def open_pcap():
+            pcap_fd = dbfs.open(urn = urn)
+            return pcap_fd, pypcap.PyPCAP(pcap_fd)
 
-        ## Dissect it
+        key = urn.value
+        pcap_fd, pcap_file = PCAP_FILE_CACHE.get(key, open_pcap)
         try:
-            return pcap_file.dissect()
-        except: pass
+            ## Go to the packet
+            pcap_file.seek(target_offset_at_point)
+
+            ## Dissect it
+            try:
+                return pcap_file.dissect()
+            except: pass
+        finally:
+            PCAP_FILE_CACHE.put(key, (pcap_fd, pcap_file))
 
 def generate_streams_in_time_order(forward_fd, reverse_fd):
     """ This generator will return the next fd who's readptr is the
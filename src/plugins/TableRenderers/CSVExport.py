@@ -25,8 +25,6 @@ class CSVRenderer(UI.TableRenderer):
         pass
 
     def render_table(self, query, result):
-        g = self.generate_rows(query)
-
         ## Make the table headers with suitable order by links:
         hiddens = [ int(x) for x in query.getarray(self.hidden) ]
 
@@ -36,6 +34,8 @@ class CSVRenderer(UI.TableRenderer):
             if e in hiddens: continue
             self.column_names.append(self.elements[e].name)
             elements.append(self.elements[e])
+
+        g = self.generate_columns(query)
             
         def generator(query, result):
             #yield "#Pyflag Table widget output\n#Query was %s.\n" % query
@@ -45,21 +45,17 @@ class CSVRenderer(UI.TableRenderer):
 
             yield ",".join(self.column_names)+"\r\n"
             data = cStringIO.StringIO()
-            csv_writer = csv.DictWriter(data,self.column_names,
-                                        dialect = 'excel')
-
-            for row in g:
-                result = {}
-                for e in elements:
-                    try:
-                        result[e.name] = e.csv(row[e.name])
-                    except AttributeError:
-                        result[e.name] = row[e.name]
-
-                csv_writer.writerow(result)
-                data.seek(0)
-                yield data.read()
+            csv_writer = csv.writer(data, dialect = 'excel')
+
+            for columns in g:
+                ## Each column is converted in one go
+                columns = [ e.csv_batch(values) for e, values in \
+                            zip(elements, columns) ]
 
+                csv_writer.writerows(zip(*columns))
+                yield data.getvalue()
+
+                data.seek(0)
                 data.truncate(0)
             
         result.generator.generator = generator(query,result)
@@ -67,6 +63,32 @@ class CSVRenderer(UI.TableRenderer):
         result.generator.headers = [("Content-Disposition",
                                      "attachment; filename=\"%s.csv\"" % query.get(\
                                      'filename','table')),]
+
+    def generate_columns(self, query):
+        """ Generates batches of the visible columns (each as a tuple
+        of values).
+
+        Exports read the whole table once, so rather than paging
+        through the cache we stream the rows from the server.
+        """
+        dbh = DB.DBO(self.case)
+        self.sql = sql = self._make_sql(query)
+
+        try:    start_limit = int(query.get("start_limit",0))
+        except: start_limit = 0
+
+        try:    end_limit = int(query.get("end_limit",0))
+        except: end_limit = 0
+
+        if end_limit > 0:
+            sql += " limit %s,%s" % (start_limit, max(end_limit - start_limit, 0))
+        elif start_limit > 0:
+            sql += " limit %s,18446744073709551615" % start_limit
+
+        dbh.stream_execute(sql)
+        for columns in dbh.iter_batches(columns = self.column_names,
+                                        as_columns = True):
+            yield columns
         
     def generate_rows(self, query):
         """ This implementation gets all the rows, but makes small
@@ -1,4 +1,9 @@
 ## This is a hack to make unit tests from the main code appear in the
 ## plugins for the tester to use it:
 from pyflag.Store import StoreTests
-from pyflag.FileSystem import VFSTests
+from pyflag.FileSystem import VFSTests, GlobTests, TreeTests
+from pyflag.Broker import BrokerTests
+from pyflag.Cookies import CookieTests
+from pyflag.MultiGrep import ScannerTest
+from pyflag.LogFile import ReadChunksTest, SplitLinesTest
+from pyflag.Exgrep import CarveTest
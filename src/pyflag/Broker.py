@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" A job broker which distributes Farm jobs to workers on many hosts.
+
+The broker is selected with JOB_QUEUE=broker. It is normally started
+by the master (Farm.start_workers), and workers on other hosts connect
+to it by running Farm.py with the same options, e.g.:
+
+   python Farm.py --job_queue=broker --broker_host=master.example.com
+
+Remote workers run their jobs against the shared case database and
+AFF4 volumes, so they must be configured to reach those as well.
+
+Protocol
+--------
+
+Messages are pickled tuples, prefixed by their length and an HMAC
+keyed with BROKER_SECRET. Since pickles are executable, the broker
+must only be reachable from trusted hosts, and neither the broker nor
+its clients will start without a secret.
+
+('post', command, argdict, cookie, priority): Queue a new job.
+
+('get', limit): Ask for up to limit jobs. The broker replies with
+   ('jobs', [(id, command, argdict, cookie), ...]) as soon as jobs are
+   available.
+
+('done', [id, ...], bytes): The jobs are finished, having scanned
+   bytes of data.
+
+('heartbeat',): Sent periodically by all clients.
+
+('pending',): The broker replies with the number of queued jobs.
+
+The broker keeps the cookie counts (see Farm.increment_cookie) - jobs
+are counted when they are posted and when they are reported done. If a
+client disconnects or misses its heartbeats for BROKER_TIMEOUT seconds, the
+jobs it holds are returned to the queue.
+"""
+import socket, select, struct, pickle, hmac, hashlib, heapq, threading
+import os, sys, time, errno
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.pyflaglog as pyflaglog
+import pyflag.Farm as Farm
+import pyflag.FlagFramework as FlagFramework
+
+config.add_option("BROKER_HOST", default="localhost",
+                  help="The host the job broker listens on")
+
+config.add_option("BROKER_PORT", default=7780, type='int',
+                  help="The port the job broker listens on")
+
+config.add_option("BROKER_SECRET", default="",
+                  help="A shared secret used to authenticate messages to the job broker (required)")
+
+config.add_option("BROKER_HEARTBEAT", default=10, type='int',
+                  help="Number of seconds between heartbeats sent to the job broker")
+
+config.add_option("BROKER_TIMEOUT", default=60, type='int',
+                  help="The broker requeues the jobs of workers it has not heard from in this many seconds")
+
+config.add_option("NO_BROKER", default=False, action='store_true',
+                  help="Do not start a job broker in the master (use an external broker)")
+
+## Length and digest
+HEADER = "!I20s"
+HEADER_SIZE = struct.calcsize(HEADER)
+
+def sign(data):
+    return hmac.new(config.BROKER_SECRET, data, hashlib.sha1).digest()
+
+def check_secret():
+    """ Anyone can sign messages with an empty secret, and messages
+    are unpickled - so we refuse to run without one.
+    """
+    if not config.BROKER_SECRET:
+        raise RuntimeError("BROKER_SECRET must be set to use the job broker")
+
+class Connection:
+    """ A connection carrying messages to or from the broker """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+        ## Messages received but not returned yet
+        self.messages = []
+        self.lock = threading.Lock()
+        self.request_lock = threading.Lock()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def pack(self, message):
+        """ Returns the framed message """
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        return struct.pack(HEADER, len(data), sign(data)) + data
+
+    def send(self, message):
+        data = self.pack(message)
+        self.lock.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.lock.release()
+
+    def feed(self, data):
+        """ Adds data read from the socket. Returns a list of the
+        complete messages received.
+        """
+        self.buffer += data
+        result = []
+        while len(self.buffer) >= HEADER_SIZE:
+            length, digest = struct.unpack(HEADER, self.buffer[:HEADER_SIZE])
+            if len(self.buffer) < HEADER_SIZE + length: break
+
+            data = self.buffer[HEADER_SIZE:HEADER_SIZE + length]
+            self.buffer = self.buffer[HEADER_SIZE + length:]
+            if sign(data) != digest:
+                raise IOError("Message failed authentication")
+
+            result.append(pickle.loads(data))
+
+        return result
+
+    def receive(self):
+        """ Blocks until a message is received. Returns None if the
+        connection is closed.
+        """
+        while not self.messages:
+            data = self.sock.recv(65536)
+            if not data: return None
+            self.messages.extend(self.feed(data))
+
+        return self.messages.pop(0)
+
+    def request(self, message):
+        """ Sends the message and waits for the reply """
+        self.request_lock.acquire()
+        try:
+            self.send(message)
+            return self.receive()[1]
+        finally:
+            self.request_lock.release()
+
+    def close(self):
+        self.sock.close()
+
+def connect(host=None, port=None):
+    """ Connects to the broker and starts sending heartbeats """
+    check_secret()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if host is None: host = config.BROKER_HOST
+    if port is None: port = config.BROKER_PORT
+    sock.connect((host, port))
+    connection = Connection(sock)
+
+    def heartbeat():
+        while 1:
+            time.sleep(config.BROKER_HEARTBEAT)
+            try:
+                connection.send(('heartbeat',))
+            except socket.error:
+                break
+
+    t = threading.Thread(target=heartbeat)
+    t.setDaemon(True)
+    t.start()
+
+    return connection
+
+class Client:
+    """ The broker's record of a connected client """
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.last_seen = time.time()
+        ## Jobs given to this client which are not done yet, by id
+        self.in_flight = {}
+        ## How many jobs the client is waiting for
+        self.wanted = 0
+        self.jobs_done = 0
+
+class Broker:
+    """ Queues jobs by priority and hands them out to workers """
+    def __init__(self, host=None, port=None):
+        check_secret()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if host is None: host = config.BROKER_HOST
+        if port is None: port = config.BROKER_PORT
+        self.listener.bind((host, port))
+        self.listener.listen(50)
+        self.port = self.listener.getsockname()[1]
+
+        ## A heap of (-priority, sequence, id, command, argdict, cookie)
+        self.pending = []
+        self.sequence = 0
+        self.clients = {}
+        self.waiting = []
+
+    def push(self, job):
+        heapq.heappush(self.pending, job)
+
+    def dispatch(self):
+        """ Gives pending jobs to waiting clients """
+        while self.pending and self.waiting:
+            client = self.waiting.pop(0)
+            jobs = []
+            while self.pending and len(jobs) < client.wanted:
+                job = heapq.heappop(self.pending)
+                client.in_flight[job[2]] = job
+                jobs.append(job[2:])
+
+            client.wanted = 0
+            try:
+                client.connection.send(('jobs', jobs))
+            except socket.error:
+                self.drop(client)
+
+    def drop(self, client):
+        """ Forgets about the client, returning its jobs to the queue """
+        try:
+            del self.clients[client.connection.fileno()]
+        except KeyError:
+            return
+
+        if client in self.waiting:
+            self.waiting.remove(client)
+
+        if client.in_flight:
+            pyflaglog.log(pyflaglog.INFO, "Requeuing %s jobs from %s" % (len(client.in_flight),
+                                                                     client.address))
+            for job in client.in_flight.values():
+                self.push(job)
+
+        client.connection.close()
+        self.dispatch()
+
+    def handle(self, client, message):
+        client.last_seen = time.time()
+        action = message[0]
+
+        if action == 'post':
+            command, argdict, cookie, priority = message[1:]
+            Farm.increment_cookie(cookie)
+            self.sequence += 1
+            self.push((-priority, self.sequence, self.sequence, command, argdict, cookie))
+            self.dispatch()
+
+        elif action == 'get':
+            client.wanted = message[1]
+            if client not in self.waiting:
+                self.waiting.append(client)
+            self.dispatch()
+
+        elif action == 'done':
+            cookies = []
+            for id in message[1]:
+                try:
+                    cookies.append(client.in_flight.pop(id)[5])
+                except KeyError:
+                    pass
+
+            client.jobs_done += len(cookies)
+            Farm.decrement_cookies(cookies, message[2])
+
+        elif action == 'pending':
+            client.connection.send(('pending', len(self.pending)))
+
+    def check_timeouts(self):
+        expired = time.time() - config.BROKER_TIMEOUT
+        for client in self.clients.values():
+            if client.last_seen < expired:
+                pyflaglog.log(pyflaglog.WARNING, "Worker %s missed its heartbeat" % (client.address,))
+                self.drop(client)
+
+    def run(self, keepalive=None):
+        """ The main loop of the broker. If keepalive is given we exit
+        when it becomes readable (our master quit).
+        """
+        pyflaglog.log(pyflaglog.INFO, "Job broker listening on port %s" % self.port)
+        last_check = time.time()
+
+        while 1:
+            fds = [ self.listener ] + [ c.connection.sock for c in self.clients.values() ]
+            if keepalive:
+                fds.append(keepalive)
+
+            try:
+                readable = select.select(fds, [], [], 1)[0]
+            except select.error, e:
+                if e[0] == errno.EINTR: continue
+                raise
+
+            if keepalive and keepalive in readable:
+                return
+
+            for sock in readable:
+                if sock is self.listener:
+                    new, address = self.listener.accept()
+                    connection = Connection(new)
+                    self.clients[connection.fileno()] = Client(connection, address)
+                    continue
+
+                client = self.clients.get(sock.fileno())
+                if not client: continue
+
+                try:
+                    data = sock.recv(65536)
+                    if not data:
+                        self.drop(client)
+                        continue
+
+                    for message in client.connection.feed(data):
+                        self.handle(client, message)
+                except (socket.error, IOError), e:
+                    pyflaglog.log(pyflaglog.WARNING, "Dropping client %s: %s" % (client.address, e))
+                    self.drop(client)
+
+            if time.time() - last_check > 1:
+                self.check_timeouts()
+                last_check = time.time()
+
+def start_broker(keepalive=None, write_keepalive=None):
+    """ Forks a broker process. Returns its pid. """
+    broker = Broker()
+
+    pid = os.fork()
+    if pid:
+        broker.listener.close()
+        return pid
+
+    if write_keepalive:
+        os.close(write_keepalive)
+
+    ## The tdb must not be shared across a fork
+    FlagFramework.job_tdb = None
+    try:
+        broker.run(keepalive)
+    finally:
+        os._exit(0)
+
+## Unit tests:
+import unittest
+
+class BrokerTests(unittest.TestCase):
+    """ Job broker tests """
+    def setUp(self):
+        self.old = (config.BROKER_PORT, config.BROKER_SECRET, Farm.job_queue)
+        self.pids = []
+        config.BROKER_SECRET = config.BROKER_SECRET or "BrokerTests secret"
+
+        ## Start a broker on a free port
+        broker = Broker("127.0.0.1", 0)
+        config.BROKER_HOST = "127.0.0.1"
+        config.BROKER_PORT = broker.port
+        Farm.job_queue = Farm.BrokerQueue()
+
+        self.keepalive, self.write_keepalive = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(self.write_keepalive)
+                FlagFramework.job_tdb = None
+                broker.run(self.keepalive)
+            finally:
+                os._exit(0)
+
+        broker.listener.close()
+        self.pids.append(pid)
+
+    def tearDown(self):
+        ## This makes the broker and the workers exit
+        os.close(self.write_keepalive)
+        os.close(self.keepalive)
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+
+        config.BROKER_PORT, config.BROKER_SECRET, Farm.job_queue = self.old
+
+    def start_worker(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(self.write_keepalive)
+                FlagFramework.job_tdb = None
+                Farm.job_queue = Farm.BrokerQueue()
+                Farm.worker_run(self.keepalive)
+            finally:
+                os._exit(0)
+
+        self.pids.append(pid)
+
+    def test01Loopback(self):
+        """ Test workers in separate processes complete all jobs """
+        cookie = int(time.time())
+        for i in range(200):
+            Farm.post_job("Scan", dict(case=None, inode_id=i, scanners=[]), cookie)
+
+        ## The broker handles our messages in order, so once it replies
+        ## all the posts have been counted.
+        self.assertEqual(Farm.job_queue.pending(), 200)
+
+        ## This worker takes some jobs and dies before completing
+        ## them. They should be requeued.
+        connection = connect()
+        connection.send(('get', 10))
+        message = connection.receive()
+        self.assertEqual(message[0], 'jobs')
+        self.assertEqual(len(message[1]), 10)
+        connection.close()
+
+        for i in range(3):
+            self.start_worker()
+
+        for i in range(300):
+            if Farm.get_cookie_reference(cookie) == 0: break
+            time.sleep(0.1)
+
+        ## All jobs must be counted exactly once
+        self.assertEqual(Farm.get_cookie_reference(cookie), 0)
+        self.assertEqual(Farm.job_queue.pending(), 0)
+
+if __name__=="__main__":
+    import pyflag.Registry as Registry
+
+    config.set_usage(usage = "PyFlag Job Broker")
+
+    Registry.Init()
+
+    config.parse_options()
+
+    Broker().run()
@@ -204,17 +204,16 @@ class Reassembler:
 
     def del_point(self, file_pos):
         """ Remove the point at file_pos if it exists """
-        idx = self.points.index(file_pos)
-        try:
-            del self.mapping[file_pos]
-            self.points.pop(idx)
-        except: pass
+        if file_pos not in self.mapping: return
+
+        self.points.pop(bisect.bisect_left(self.points, file_pos))
+        del self.mapping[file_pos]
+        self.segments = None
 
     def add_point(self, file_pos, image_pos, comment=None):
         """ Adds a new point to the mapping function. Points may be
         added in any order.
         """
-        bisect.insort_left(self.points, file_pos)
         ## We already have this position in here - we need to decide
         ## if this is a better value. Its not a hard and fast rule,
         ## but generally if the current position is not too far away
@@ -225,9 +224,12 @@ class Reassembler:
             expected, left = self.interpolate(file_pos-1)
             if abs(image_pos - expected) > abs(self.mapping[file_pos] - expected):
                 return
+        else:
+            bisect.insort_left(self.points, file_pos)
             
         self.mapping[file_pos] = image_pos
         self.comments[file_pos] = comment
+        self.segments = None
         
     def seek(self, offset, whence=0):
         if whence==0:
@@ -257,7 +259,7 @@ class Reassembler:
 
         ## If we are asked to interpolate an identified point its
         ## always the same as itself.
-        if file_offset in self.points:
+        if file_offset in self.mapping:
             return self.mapping[file_offset], 1
 
         elif direction_forward:
@@ -274,29 +276,82 @@ class Reassembler:
             #print "Reverse interpolation %s %s %s" % (self.points[r],file_offset, r)
             return self.mapping[self.points[r]] - (self.points[r] - file_offset), self.points[r] - file_offset
 
+    ## The compiled segment table - see get_segments()
+    segments = None
+
+    def get_segments(self):
+        """ Returns the mapping function as a table of segments of unit
+        slope. This is a tuple of two lists - the file offset each
+        segment starts at, and the difference between the image offset
+        and the file offset within the segment. The last segment
+        extends forever.
+
+        The table gives the same result as interpolate() for every
+        offset. It is built when needed after the points change.
+        """
+        if self.segments and self.segments[0] == self.interpolate_forward:
+            return self.segments[1:]
+
+        starts = []
+        deltas = []
+        def add(start, delta):
+            ## Collinear segments are merged
+            if deltas and deltas[-1] == delta: return
+            starts.append(start)
+            deltas.append(delta)
+
+        points = self.points
+        ## Before the first point we interpolate backwards from it
+        if points[0] > 0:
+            add(0, self.mapping[points[0]] - points[0])
+
+        for i in range(len(points)):
+            add(points[i], self.mapping[points[i]] - points[i])
+
+            ## Between points we interpolate backwards from the next
+            ## point if required
+            if not self.interpolate_forward and i+1 < len(points) and \
+                   points[i] + 1 < points[i+1]:
+                add(points[i] + 1, self.mapping[points[i+1]] - points[i+1])
+
+        self.segments = (self.interpolate_forward, starts, deltas)
+        return starts, deltas
+
     def tell(self):
         return self.readptr
 
     def read(self, length):
-        result = ''
+        ## Without any points we just read the image
+        if not self.points:
+            data = self.fd.read(length)
+            self.readptr += len(data)
+            return data
+
+        starts, deltas = self.get_segments()
+        result = []
         while length>0:
-            try:
-                m, left = self.interpolate(self.readptr)
-                self.fd.seek(m,0)
-            except:
-                left = 1000
+            i = bisect.bisect_right(starts, self.readptr) - 1
+            image_offset = self.readptr + deltas[i]
 
-            want_to_read = min(left, length)
+            ## This part of the file would be before the start of the
+            ## image
+            if image_offset < 0: break
 
-            assert(want_to_read > 0)
+            ## Read up to the next discontinuity
+            if i+1 < len(starts):
+                want_to_read = min(starts[i+1] - self.readptr, length)
+            else:
+                want_to_read = length
+
+            self.fd.seek(image_offset)
             data = self.fd.read(want_to_read)
             if not data: break
 
-            self.readptr += min(left, length)
-            result += data
+            self.readptr += len(data)
+            result.append(data)
             length -= len(data)
 
-        return result
+        return ''.join(result)
 
     def save_map(self, fd):
         """ Saves the map onto the fd 
@@ -403,6 +458,7 @@ class Reassembler:
             self.add_point(p, c.mapping[p], c.comments[p])
 
 from optparse import OptionParser
+import pyflag.MultiGrep as MultiGrep
 
 class CarverFramework:
     """ This base class is the framework for building advanced
@@ -448,41 +504,68 @@ class CarverFramework:
         parser.add_option('', '--plot_type', default="png",
                           help = "The file type to save the plot to (e.g. png, eps)")
 
+        parser.add_option('-j', '--processes', default=None, type='int',
+                          help = "Build the index with this many processes (0 for one per CPU)")
+
+        parser.add_option('', '--range_size', default=256, type='int',
+                          help = "The size (in MB) of the ranges of the image each process indexes")
+
         self.parser = parser
 
-    cregexs = {}
     regexs = {}
     
     def build_index(self, index_file):
-        hits = {}
-        ## Compile the res
-        for k,v in self.regexs.items():
-            self.cregexs[k] = re.compile(v)
-
-        BLOCK_SIZE = 4096
-
+        """ Finds all the hits of our regexs in the image and saves
+        them in the index file.
+        """
         p = pickle.Pickler(open(index_file,'w'))
 
-        offset = 0
-        fd = open(self.args[0],'r')
-        while 1:
-            data = fd.read(BLOCK_SIZE)
-            if len(data)==0: break
-
-            for k,v in self.cregexs.items():
-                for m in v.finditer(data):
-                    print "Found %s in %s" % (k, offset + m.start())
-                    try:
-                        hits[k].append(offset + m.start())
-                    except KeyError:
-                        hits[k] = [ offset + m.start(), ]
-
-            offset += len(data)
+        if self.options.processes is None:
+            scanner = MultiGrep.Scanner(self.regexs.items(), overlapping=False)
+            fd = open(self.args[0],'r')
+            hits = self.collect_hits(scanner.scan_file(fd))
+        else:
+            hits = self.build_index_parallel()
 
         ## Serialise the hits into a file:
         p.dump(hits)
         return hits
 
+    def collect_hits(self, hits):
+        result = {}
+        for k, start, end in hits:
+            print "Found %s in %s" % (k, start)
+            try:
+                result[k].append(start)
+            except KeyError:
+                result[k] = [ start, ]
+
+        return result
+
+    def build_index_parallel(self):
+        """ Splits the image into ranges which are indexed by a pool
+        of processes. The hits of all the ranges are then merged in
+        offset order.
+        """
+        filename = self.args[0]
+        fd = open(filename, 'r')
+        fd.seek(0, 2)
+        ranges = MultiGrep.split_ranges(fd.tell(), self.options.range_size * 1024 * 1024)
+        fd.close()
+
+        jobs = [ (filename, self.regexs.items(), start, end) for start, end in ranges ]
+        results = {}
+        for job, hits in MultiGrep.parallel_map(index_range, jobs, self.options.processes):
+            print "Indexed range %s-%s (%s of %s): %s hits" % (
+                job[2], job[3], len(results) + 1, len(jobs), len(hits))
+            results[job[2]] = hits
+
+        hits = []
+        for start, end in ranges:
+            hits.extend(results[start])
+
+        return self.collect_hits(MultiGrep.remove_overlaps(hits))
+
     def generate_function(self, c):
         """ Generates test functions and uses a discriminator to
         evolve the carver object c into the best suitable one.
@@ -563,6 +646,17 @@ class CarverFramework:
             raise RuntimeError("Nothing to do, use -h for help")
 
 
+def index_range((filename, regexs, start, end)):
+    """ Returns the hits of the regexs which start between start and
+    end of the file.
+    """
+    scanner = MultiGrep.Scanner(regexs, overlapping=False)
+    fd = open(filename, 'r')
+    try:
+        return list(scanner.scan_range(fd, start, end))
+    finally:
+        fd.close()
+
 import unittest
 
 class CarverTest(unittest.TestCase):
@@ -588,5 +682,29 @@ class CarverTest(unittest.TestCase):
         print c.interpolate(50, True)
         print c.interpolate(520, True)
 
+    def test_Read(self):
+        """ Test that reads follow the mapping function """
+        image = open(self.filename).read()
+        c = Reassembler(open(self.filename))
+        c.add_point(0, 1024)
+        c.add_point(512, 0)
+        c.add_point(1024, 512)
+        c.add_point(1536, 1024)
+
+        ## The last two points are collinear with the second
+        self.assertEqual(c.get_segments(), ([0, 512], [1024, -512]))
+        self.assertEqual(c.read(2048), image[1024:1536] + image[0:1536])
+
+        for offset in range(0, 2000, 37):
+            c.seek(offset)
+            data = c.read(100)
+            for i in range(0, 100, 11):
+                self.assertEqual(data[i], image[c.interpolate(offset + i)[0]])
+
+        ## Changing the points changes the segments
+        c.del_point(512)
+        c.seek(0)
+        self.assertEqual(c.read(100), image[1024:1124])
+
 if __name__=='__main__':    
     unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Times the brute force loop of jpeg_test.py.
+
+For each candidate sector a Forced point is added to the reassembler,
+the file is read from the start up to a few sectors past the candidate
+(which is what the decoder does) and the point is removed again.
+
+If the jpeg module is available the reads are done by decoding the
+file as jpeg_test.py does, otherwise the file is just read.
+"""
+from optparse import OptionParser
+import time, random
+import Carver
+
+SECTOR_SIZE = 512
+
+parser = OptionParser(usage="""%prog [options] [image_file]
+
+Without an image file a random one is made in memory.""")
+
+parser.add_option('-H', '--header', default=0, type='int',
+                  help = 'The sector of the file header in the image')
+
+parser.add_option('-d', '--discontinuity', default=200, type='int',
+                  help = 'The sector in the file to add forced points after')
+
+parser.add_option('-n', '--candidates', default=2000, type='int',
+                  help = 'The number of candidate sectors to try')
+
+parser.add_option('-p', '--points', default=20, type='int',
+                  help = 'The number of points the map already has')
+
+(options, args) = parser.parse_args()
+
+if args:
+    fd = open(args[0])
+else:
+    import cStringIO
+    fd = cStringIO.StringIO(''.join([ chr(random.randint(0,255)) for i in \
+                                      range(SECTOR_SIZE * 10000) ]))
+
+try:
+    import jpeg
+except ImportError:
+    jpeg = None
+
+c = Carver.Reassembler(fd)
+c.add_point(0, options.header * SECTOR_SIZE, "File header")
+
+## Some already identified points before the discontinuity
+for i in range(1, options.points):
+    sector = i * options.discontinuity / options.points
+    c.add_point(sector * SECTOR_SIZE, (options.header + sector) * SECTOR_SIZE, "Forced")
+
+if jpeg and args:
+    d = jpeg.decoder(c)
+else:
+    d = None
+
+start = time.time()
+read = 0
+for i in range(options.candidates):
+    file_offset = options.discontinuity + i % 2
+    sector_offset = options.header + options.discontinuity + i
+
+    c.seek(0)
+    c.add_point(file_offset * SECTOR_SIZE, sector_offset * SECTOR_SIZE, "Forced")
+    if d:
+        d.decode(file_offset + 5)
+    else:
+        ## The decoder reads in small chunks
+        length = (file_offset + 5) * SECTOR_SIZE
+        while length > 0:
+            data = c.read(min(4096, length))
+            if not data: break
+            length -= len(data)
+            read += len(data)
+
+    c.del_point(file_offset * SECTOR_SIZE)
+
+elapsed = time.time() - start
+print "%s candidates in %0.2fs (%0.0f candidates/s, %0.1f MB/s read)" % (
+    options.candidates, elapsed, options.candidates / max(elapsed, 0.001),
+    read / max(elapsed, 0.001) / 1024 / 1024)
@@ -200,6 +200,11 @@ class ColumnType:
         """ Creates an index on table using dbh """
         dbh.check_index(table, self.column)
 
+    def enrich(self, dbh, table):
+        """ This is called once table has been loaded so we can work
+        out any extra data about all our values at once.
+        """
+
     def where(self):
         pass
 
@@ -324,6 +329,13 @@ class ColumnType:
             return "-"
         else: return value
 
+    def csv_batch(self, values):
+        """ Outputs a list of values for csv output. Column types
+        which need to look up their values should override this to
+        look up all the values at once.
+        """
+        return [ self.csv(value) for value in values ]
+
     def extended_csv(self, value):
         return {self.name:self.csv(value)}
 
@@ -944,10 +956,21 @@ class AFF4URN(IntegerType):
         return '<a href="%s">%s</a>' % (value, value)
 
     def csv(self, value):
-        fsfd = FileSystem.DBFS(self.case)
-        path, inode, inode_id = fsfd.lookup(inode_id=value)
-
-        return inode
+        return self.csv_batch([value])[0]
+
+    def csv_batch(self, values):
+        ## Look up the paths of all the inodes in one query
+        paths = {}
+        ids = [ v for v in values if v is not None ]
+        if ids:
+            dbh = DB.DBO(self.case)
+            dbh.execute("select inode_id, concat(path,'/',name) as path "
+                        "from vfs where inode_id in (%s)",
+                        ",".join([ "%d" % int(v) for v in set(ids) ]))
+            for rows in dbh.iter_batches(columns = ['inode_id', 'path']):
+                paths.update(rows)
+
+        return [ paths.get(v, v) for v in values ]
     
     def column_decorator(self, table, sql, query, result):
         case = query['case']
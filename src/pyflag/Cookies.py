@@ -0,0 +1,613 @@
+#!/usr/bin/env python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" A counter service which tracks the jobs posted with each cookie.
+
+Jobs are posted with a cookie so the poster can tell when all of them
+are done. Keeping the counts in jobs.tdb means every post and every
+finished job locks the tdb, and waiters have to poll it - with many
+workers and clients most of the time is spent waiting for the lock.
+
+Instead the master starts a cookie server (see Farm.start_workers)
+listening on the Unix socket COOKIE_SOCKET. Posters and workers just
+send it messages, and clients can subscribe to a cookie to be told of
+its progress as jobs finish and when they are all done (see wait()).
+
+If NO_COOKIE_SERVER is set the counts are kept in jobs.tdb as
+before. The choice is made by the option alone, never by whether the
+server happens to be reachable, so all the processes must agree on it
+(set it in the config file rather than on one command line). Otherwise
+a job could be counted in one place and finished in the other.
+
+While the server is unreachable (e.g. before the master started it)
+messages are kept in the process and sent once it can be reached
+again.
+
+Protocol
+--------
+
+Messages are framed the same way as those of the job broker (see
+pyflag.Broker).
+
+('add', cookie, count): count jobs were posted with the cookie.
+
+('done', [cookie, ...], bytes): A job of each of the cookies is
+   done. bytes is the number of bytes those jobs scanned - it is
+   credited to the first cookie.
+
+('status', cookie): The server replies with ('status', status).
+
+('subscribe', cookie, interval): The server sends ('progress', status)
+   as the jobs progress, at most every interval seconds. A final
+   status is sent as soon as no jobs are outstanding.
+
+A status is a dict with the keys cookie, posted, done, outstanding,
+bytes, elapsed and eta (the estimated seconds left, or None if not
+known yet). outstanding may briefly be negative if a worker's message
+arrives before the poster's - the jobs are only finished when it is 0.
+
+The server never blocks writing to a client. Replies are buffered and
+a client which lets more than MAX_BACKLOG bytes pile up is dropped.
+
+The counts are only kept in memory - they are lost if the server is
+restarted.
+"""
+import socket, select, os, time, errno
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.pyflaglog as pyflaglog
+import pyflag.Broker as Broker
+
+config.add_option("COOKIE_SOCKET", default=None,
+                  help="The Unix socket of the cookie server (default RESULTDIR/cookies.sock)")
+
+config.add_option("NO_COOKIE_SERVER", default=False, action='store_true',
+                  help="Do not use a cookie server - count jobs in jobs.tdb (all processes must agree on this)")
+
+config.add_option("COOKIE_PROGRESS_INTERVAL", default=5, type='int',
+                  help="Number of seconds between progress reports while waiting for jobs")
+
+## Counters of finished cookies are forgotten after this many seconds
+EXPIRY = 3600
+
+## Seconds to wait before trying to reach a server which was not running
+RETRY_PERIOD = 10
+
+## Clients which do not read their replies are dropped once this many
+## bytes are waiting for them
+MAX_BACKLOG = 1024 * 1024
+
+def enabled():
+    """ Are the jobs counted by the cookie server (rather than in
+    jobs.tdb)?
+    """
+    return not config.NO_COOKIE_SERVER
+
+def socket_path():
+    return config.COOKIE_SOCKET or os.path.join(config.RESULTDIR, "cookies.sock")
+
+class Counter:
+    """ The progress of the jobs of a cookie """
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.posted = 0
+        self.done = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.changed = self.started
+        ## Incremented on every change
+        self.version = 0
+        ## Subscribed connection -> [interval, last sent, version sent]
+        self.subscribers = {}
+
+    def status(self):
+        outstanding = self.posted - self.done
+        elapsed = time.time() - self.started
+
+        if outstanding <= 0:
+            eta = 0
+        elif self.done:
+            eta = elapsed / self.done * outstanding
+        else:
+            eta = None
+
+        return dict(cookie = self.cookie, posted = self.posted, done = self.done,
+                    outstanding = outstanding, bytes = self.bytes,
+                    elapsed = elapsed, eta = eta)
+
+class CookieServer:
+    """ Counts the jobs of each cookie and notifies subscribers """
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.listener.listen(50)
+
+        self.counters = {}
+        self.connections = {}
+        ## Data waiting to be written to each connection (by fileno)
+        self.outgoing = {}
+        ## Counters which have subscribers we still need to tell about
+        ## a change
+        self.changed = set()
+
+    def get_counter(self, cookie):
+        cookie = str(cookie)
+        try:
+            return self.counters[cookie]
+        except KeyError:
+            counter = self.counters[cookie] = Counter(cookie)
+            return counter
+
+    def touch(self, counter):
+        counter.changed = time.time()
+        counter.version += 1
+        if counter.subscribers:
+            self.changed.add(counter)
+
+    def handle(self, connection, message):
+        action = message[0]
+
+        if action == 'add':
+            counter = self.get_counter(message[1])
+            counter.posted += message[2]
+            self.touch(counter)
+
+        elif action == 'done':
+            cookies, bytes = message[1:]
+            for cookie in cookies:
+                counter = self.get_counter(cookie)
+                counter.done += 1
+                counter.bytes += bytes
+                bytes = 0
+                self.touch(counter)
+
+        elif action == 'status':
+            self.reply(connection, ('status', self.get_counter(message[1]).status()))
+
+        elif action == 'subscribe':
+            counter = self.get_counter(message[1])
+            counter.subscribers[connection] = [message[2], 0, -1]
+            self.changed.add(counter)
+
+    def notify(self):
+        """ Sends the changes to subscribers which are due for them """
+        now = time.time()
+        for counter in list(self.changed):
+            status = counter.status()
+            finished = not status['outstanding']
+            pending = False
+
+            for connection, subscriber in counter.subscribers.items():
+                interval, last_sent, version = subscriber
+                if version == counter.version: continue
+
+                if not finished and now - last_sent < interval:
+                    pending = True
+                    continue
+
+                if not self.reply(connection, ('progress', status)):
+                    continue
+
+                subscriber[1:] = [now, counter.version]
+                if finished:
+                    del counter.subscribers[connection]
+
+            if not pending:
+                self.changed.discard(counter)
+
+    def reply(self, connection, message):
+        """ Queues the message for the connection. Returns False if
+        the connection had to be dropped.
+        """
+        fd = connection.fileno()
+        data = self.outgoing.get(fd, '') + connection.pack(message)
+        if len(data) > MAX_BACKLOG:
+            pyflaglog.log(pyflaglog.WARNING, "Dropping cookie client which is not reading its replies")
+            self.drop(connection)
+            return False
+
+        self.outgoing[fd] = data
+        return self.write(connection)
+
+    def write(self, connection):
+        """ Writes as much of the queued data as the connection takes
+        without blocking. Returns False if the connection was dropped.
+        """
+        fd = connection.fileno()
+        data = self.outgoing.get(fd)
+        if not data: return True
+
+        try:
+            sent = connection.sock.send(data)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+
+            self.drop(connection)
+            return False
+
+        if sent < len(data):
+            self.outgoing[fd] = data[sent:]
+        else:
+            del self.outgoing[fd]
+
+        return True
+
+    def drop(self, connection):
+        try:
+            del self.connections[connection.fileno()]
+        except KeyError:
+            return
+
+        self.outgoing.pop(connection.fileno(), None)
+
+        for counter in self.counters.values():
+            counter.subscribers.pop(connection, None)
+
+        connection.close()
+
+    def expire(self):
+        expired = time.time() - EXPIRY
+        for cookie, counter in self.counters.items():
+            if counter.posted == counter.done and not counter.subscribers and \
+                   counter.changed < expired:
+                del self.counters[cookie]
+
+    def run(self, keepalive=None):
+        """ The main loop of the server. If keepalive is given we exit
+        when it becomes readable (our master quit).
+        """
+        pyflaglog.log(pyflaglog.INFO, "Cookie server listening on %s" % self.path)
+        last_expired = time.time()
+
+        try:
+            while 1:
+                fds = [ self.listener ] + [ c.sock for c in self.connections.values() ]
+                if keepalive:
+                    fds.append(keepalive)
+
+                waiting = [ self.connections[fd].sock for fd in self.outgoing ]
+
+                try:
+                    readable, writable = select.select(fds, waiting, [], 0.5)[:2]
+                except select.error, e:
+                    if e[0] == errno.EINTR: continue
+                    raise
+
+                if keepalive and keepalive in readable:
+                    return
+
+                for sock in writable:
+                    connection = self.connections.get(sock.fileno())
+                    if connection:
+                        self.write(connection)
+
+                for sock in readable:
+                    if sock is self.listener:
+                        new, address = self.listener.accept()
+                        ## A client which stops reading must not block us
+                        new.setblocking(0)
+                        connection = Broker.Connection(new)
+                        self.connections[connection.fileno()] = connection
+                        continue
+
+                    connection = self.connections.get(sock.fileno())
+                    if not connection: continue
+
+                    try:
+                        try:
+                            data = sock.recv(65536)
+                        except socket.error, e:
+                            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                                continue
+                            raise
+
+                        if not data:
+                            self.drop(connection)
+                            continue
+
+                        for message in connection.feed(data):
+                            self.handle(connection, message)
+                    except (socket.error, IOError), e:
+                        pyflaglog.log(pyflaglog.WARNING, "Dropping cookie client: %s" % e)
+                        self.drop(connection)
+
+                ## Subscribers are only notified once all the messages
+                ## which arrived together are handled. A job must be
+                ## posted before a worker can finish it, so we never
+                ## see it done before it was added.
+                self.notify()
+
+                if time.time() - last_expired > 60:
+                    self.expire()
+                    last_expired = time.time()
+        finally:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+def connect(path=None):
+    """ Connects to the cookie server """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except socket.error:
+        sock.close()
+        raise
+
+    return Broker.Connection(sock)
+
+def start_server(keepalive=None, write_keepalive=None):
+    """ Forks a cookie server process. Returns its pid, or None if a
+    server is already running.
+    """
+    try:
+        connect().close()
+        pyflaglog.log(pyflaglog.INFO, "Using the cookie server already on %s" % socket_path())
+        return None
+    except socket.error:
+        pass
+
+    server = CookieServer()
+
+    pid = os.fork()
+    if pid:
+        server.listener.close()
+        return pid
+
+    if write_keepalive:
+        os.close(write_keepalive)
+
+    try:
+        server.run(keepalive)
+    finally:
+        os._exit(0)
+
+## Our connection to the server
+client = None
+client_pid = None
+next_attempt = 0
+
+## Messages we could not send yet
+backlog = []
+
+def get_client():
+    """ Returns this process's connection to the cookie server, or
+    None if no server is running.
+    """
+    global client, client_pid, next_attempt
+
+    ## Connections must not be shared across a fork
+    if client_pid != os.getpid():
+        client = None
+        client_pid = os.getpid()
+        next_attempt = 0
+        del backlog[:]
+
+    if not client and time.time() >= next_attempt:
+        try:
+            client = connect()
+        except socket.error:
+            next_attempt = time.time() + RETRY_PERIOD
+
+    return client
+
+def drop_client():
+    global client, next_attempt
+
+    if client:
+        client.close()
+    client = None
+    next_attempt = time.time() + RETRY_PERIOD
+
+def flush():
+    """ Sends the messages we could not send before. Returns False
+    if some are still waiting for the server.
+    """
+    if not backlog: return True
+
+    connection = get_client()
+    if not connection: return False
+
+    try:
+        while backlog:
+            connection.send(backlog[0])
+            backlog.pop(0)
+    except socket.error:
+        drop_client()
+        return False
+
+    pyflaglog.log(pyflaglog.INFO, "Reached the cookie server again")
+    return True
+
+def send(message):
+    """ Sends the message to the server. If the server can not be
+    reached the message is kept and sent later - we never count the
+    jobs anywhere else (see enabled()).
+    """
+    ## This also discards a backlog left by our parent process
+    connection = get_client()
+
+    if not backlog:
+        try:
+            if connection:
+                connection.send(message)
+                return
+        except socket.error:
+            drop_client()
+
+        pyflaglog.log(pyflaglog.WARNING, "Cookie server not reachable on %s - holding job counts until it is" % socket_path())
+
+    backlog.append(message)
+    flush()
+
+def request(message):
+    """ Sends the message and returns the server's reply, or None if
+    no server is running.
+    """
+    connection = get_client()
+    if not connection: return None
+
+    try:
+        return connection.request(message)
+    except (socket.error, TypeError):
+        drop_client()
+        return None
+
+def get_status(cookie):
+    """ Returns the status of the jobs of cookie. If the jobs are
+    counted in jobs.tdb only the outstanding jobs are known. If the
+    server can not be reached nothing is known (outstanding is None).
+    """
+    import pyflag.Farm as Farm
+
+    if enabled():
+        status = request(('status', cookie))
+        if status is not None: return status
+        outstanding = None
+    else:
+        outstanding = Farm.get_cookie_reference(cookie)
+
+    return dict(cookie = str(cookie), posted = None, done = None,
+                outstanding = outstanding, bytes = None, elapsed = None, eta = None)
+
+def wait(cookie, interval=None):
+    """ Yields the status of the jobs of cookie as they progress, at
+    most every interval seconds, until none are outstanding. The last
+    status yielded is the final one.
+    """
+    if interval is None:
+        interval = config.COOKIE_PROGRESS_INTERVAL
+
+    while enabled():
+        try:
+            connection = connect()
+        except socket.error:
+            pyflaglog.log(pyflaglog.WARNING, "Cookie server not reachable on %s - waiting for it" % socket_path())
+            time.sleep(RETRY_PERIOD)
+            continue
+
+        try:
+            connection.send(('subscribe', cookie, interval))
+            while 1:
+                message = connection.receive()
+                if not message: break
+
+                yield message[1]
+                if message[1]['outstanding'] == 0: return
+        finally:
+            connection.close()
+
+    ## The jobs are counted in jobs.tdb - we need to poll it
+    started = last_sent = time.time()
+    while 1:
+        status = get_status(cookie)
+        now = time.time()
+        if not status['outstanding'] or now - last_sent >= interval:
+            last_sent = now
+            status['elapsed'] = now - started
+            yield status
+
+        if not status['outstanding']: return
+        time.sleep(0.5)
+
+def format_status(status):
+    """ Describes the status for the user """
+    if status['outstanding'] is None:
+        return "Cookie server not reachable"
+    elif status['posted'] is None:
+        result = "%s jobs outstanding" % status['outstanding']
+    else:
+        result = "%s of %s jobs done, %s outstanding" % (status['done'], status['posted'],
+                                                       status['outstanding'])
+
+    if status['bytes']:
+        result += ", %0.1f MB scanned" % (status['bytes'] / 1024.0 / 1024)
+
+    if status['outstanding'] > 0 and status['eta'] is not None:
+        result += ", about %s left" % time.strftime("%H:%M:%S", time.gmtime(status['eta']))
+
+    return result
+
+## Unit tests:
+import unittest
+
+class CookieTests(unittest.TestCase):
+    """ Cookie server tests """
+    def setUp(self):
+        self.path = "/tmp/pyflag_test_cookies.%s" % os.getpid()
+        server = CookieServer(self.path)
+
+        self.keepalive, self.write_keepalive = os.pipe()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                os.close(self.write_keepalive)
+                server.run(self.keepalive)
+            finally:
+                os._exit(0)
+
+        server.listener.close()
+
+    def tearDown(self):
+        os.close(self.write_keepalive)
+        os.close(self.keepalive)
+        os.waitpid(self.pid, 0)
+
+    def test01Progress(self):
+        """ Subscribers are told when all jobs are done """
+        poster = connect(self.path)
+        worker = connect(self.path)
+        poster.send(('add', 1, 10))
+
+        waiter = connect(self.path)
+        waiter.send(('subscribe', 1, 0))
+        self.assertEqual(waiter.receive()[1]['outstanding'], 10)
+
+        for i in range(10):
+            worker.send(('done', [1], 100))
+
+        while 1:
+            status = waiter.receive()[1]
+            if not status['outstanding']: break
+
+        self.assertEqual(status['done'], 10)
+        self.assertEqual(status['bytes'], 1000)
+        self.assertEqual(poster.request(('status', 1))['outstanding'], 0)
+
+    def test02EarlyDone(self):
+        """ A job reported done before it was posted does not finish the cookie """
+        poster = connect(self.path)
+        worker = connect(self.path)
+        worker.send(('done', [2], 0))
+        self.assertEqual(worker.request(('status', 2))['outstanding'], -1)
+
+        poster.send(('add', 2, 1))
+        self.assertEqual(poster.request(('status', 2))['outstanding'], 0)
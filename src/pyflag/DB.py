@@ -35,13 +35,14 @@ import pyflag.conf
 config = pyflag.conf.ConfObject()
 
 import pyflag.pyflaglog as pyflaglog
-import time,types
+import time,types,operator,tempfile,os
 from Queue import Queue, Full, Empty
 from MySQLdb.constants import FIELD_TYPE, FLAG
 import threading
 
 ## This store stores information about indexes
 import Store
+from hashlib import md5
 DBIndex_Cache=Store.Store()
 
 db_connections=0
@@ -76,9 +77,21 @@ config.add_option("DBCACHE_AGE", default=60, type='int',
 config.add_option("DBCACHE_LENGTH", default=1024, type='int',
                 help="Number of rows to cache for table searches")
 
+config.add_option("DBCACHE_SIZE", default=100, type='int',
+                  help="Maximum size (in MB) of the cached results of "
+                  "table searches")
+
 config.add_option("MASS_INSERT_THRESHOLD", default=300, type='int',
                   help="Number of rows where the mass insert buffer will be flushed.")
 
+config.add_option("MASS_INSERT_INFILE", default=False, action='store_true',
+                  help="Mass inserts are loaded with LOAD DATA LOCAL INFILE "
+                  "where possible (the server must allow local_infile)")
+
+config.add_option("INFILE_THRESHOLD", default=50000, type='int',
+                  help="Number of rows where the mass insert buffer will be "
+                  "flushed when loading with LOAD DATA LOCAL INFILE")
+
 config.add_option("TABLE_QUERY_TIMEOUT", default=10, type='int',
                   help="The table widget will timeout queries after this many seconds")
 
@@ -89,6 +102,10 @@ config.add_option("DB_SS_CURSOR", default=False,
                   action='store_true',
                   help = "Enable server side database cursors")
 
+config.add_option("QUERY_STATS", default=False, action='store_true',
+                  help = "Count the executions and time of each statement "
+                  "template (shown in the PyFlag Stats report)")
+
 import types
 import MySQLdb.converters
 
@@ -181,6 +198,30 @@ def expand(format, params):
 
     return result
 
+## Compiled statement templates keyed by their format string. SQL
+## which is built dynamically can make many templates so we only keep
+## this many.
+TEMPLATE_CACHE = {}
+TEMPLATE_CACHE_SIZE = 1000
+
+def compile_template(sql):
+    """ Splits the format string sql into a list alternating between
+    literal text and the format codes (r, s or b), so the codes are at
+    the odd indexes. Templates are cached so each format string is
+    only parsed once.
+    """
+    try:
+        return TEMPLATE_CACHE[sql]
+    except KeyError:
+        pass
+
+    template = expand_re.split(sql)
+    if len(TEMPLATE_CACHE) >= TEMPLATE_CACHE_SIZE:
+        TEMPLATE_CACHE.clear()
+
+    TEMPLATE_CACHE[sql] = template
+    return template
+
 def db_expand(sql, params):
     """ A utility function for interpolating into the query string.
     
@@ -199,8 +240,7 @@ def db_expand(sql, params):
     to utf8 when sending to the server and the binary data will be
     corrupted.
     """
-    sql = str(sql)
-    d = dict(count = 0)
+    template = compile_template(str(sql))
 
     if isinstance(params, basestring):
         params = (params,)
@@ -210,36 +250,113 @@ def db_expand(sql, params):
     except:
         params = (params,)
 
-    def cb(m):
-        x = params[d['count']]
-        
-        if m.group(1)=="s":
-            #result = u"%s" % (force_unicode(params[d['count']]))
-            result = force_string(x)
+    result = template[:]
+    for i in range(1, len(template), 2):
+        x = params[i / 2]
+        code = template[i]
+
+        if code=="s":
+            result[i] = force_string(x)
             
         ## Raw escaping
-        elif m.group(1)=='r':
-            result = force_string(x)
-            result = "'%s'" % escape(result, quote="'")
-            #result = u"'%s'" % escape(force_unicode(params[d['count']]), quote="'")
-            #result = u"'%s'" % escape(force_unicode(params[d['count']]))
+        elif code=='r':
+            result[i] = "'%s'" % escape(force_string(x), quote="'")
 
         ## This needs to be binary escaped:
-        elif m.group(1)=='b':
-            #data = params[d['count']].decode("latin1")
-            data = params[d['count']]
-            #data = ''.join(r"\\x%02X" % ord(x) for x in params[d['count']])
-            #data = params[d['count']]
-            result = "_binary'%s'" % escape(data)
-            #print result.encode("ascii","ignore")
+        else:
+            result[i] = "_binary'%s'" % escape(x)
 
-        d['count'] +=1
-        return result
+    return ''.join(result)
 
-    result = expand_re.sub(cb,sql)
+## Statistics of the cached_execute cache in this process
+CACHE_STATS = dict(hits = 0, misses = 0, extensions = 0, waits = 0,
+                   evictions = 0, materialised = 0, materialise_time = 0.0)
+
+## Cache entries being made by this process as (case, id). Threads
+## waiting for them wait on CACHE_CONDITION.
+MATERIALISING = set()
+CACHE_CONDITION = threading.Condition()
+
+## The errors of cache entries which this process failed to make, by
+## (case, id), so their waiters can report them
+CACHE_ERRORS = {}
+
+## Tables (and their aliases) in the from clause of a query
+TABLE_RE = re.compile(r"(?:\bfrom|\bjoin|,)\s+(?:`?\w+`?\.)?`?(\w+)`?"
+                      r"(?:\s+(?:as\s+)?`?(\w+)`?)?", re.I)
+
+## Words which may follow a table name but are not aliases
+NOT_ALIASES = set(("where", "join", "left", "right", "inner", "outer", "cross",
+                   "natural", "straight_join", "on", "using", "group", "order",
+                   "having", "limit", "union", "for", "lock", "procedure", "into",
+                   "use", "ignore", "force"))
+
+def table_aliases(sql):
+    """ Returns a dict mapping the aliases of the tables in the query
+    to the table names.
+    """
+    match = re.search(r"\bfrom\b", sql, re.I)
+    if not match: return {}
+
+    result = {}
+    for table, alias in TABLE_RE.findall(sql[match.start():]):
+        if alias and alias.lower() not in NOT_ALIASES:
+            result[alias] = table
 
     return result
 
+## Marks a column missing from a row in a mass insert
+MISSING = object()
+
+## Encoders for mass insert values (escaped, raw, binary, NULL)
+SQL_ENCODERS = (lambda v: "'%s'" % escape(force_string(v)),
+                force_string,
+                lambda v: "_binary'%s'" % escape(v),
+                'NULL')
+
+TSV_ENCODERS = (lambda v: escape(force_string(v), quote=''),
+                None,
+                lambda v: escape(v, quote=''),
+                '\\N')
+
+## Set if the server refused LOAD DATA LOCAL INFILE
+INFILE_FAILED = False
+
+## Execution counts and total times keyed by statement template
+QUERY_STATS = {}
+QUERY_STATS_LOCK = threading.Lock()
+
+def record_query(template, seconds):
+    """ Accounts for an execution of the template which took seconds """
+    QUERY_STATS_LOCK.acquire()
+    try:
+        try:
+            stats = QUERY_STATS[template]
+        except KeyError:
+            if len(QUERY_STATS) >= TEMPLATE_CACHE_SIZE:
+                template = "(other statements)"
+
+            stats = QUERY_STATS.setdefault(template, [0, 0])
+
+        stats[0] += 1
+        stats[1] += seconds
+    finally:
+        QUERY_STATS_LOCK.release()
+
+def query_stats():
+    """ Returns a list of (template, count, total seconds) for all the
+    statements executed by this process, the slowest first.
+    """
+    QUERY_STATS_LOCK.acquire()
+    try:
+        result = [ (template, count, seconds) for template, (count, seconds) \
+                   in QUERY_STATS.items() ]
+    finally:
+        QUERY_STATS_LOCK.release()
+
+    result.sort(key = lambda x: x[2], reverse=True)
+    return result
+
 class PyFlagDirectCursor(MySQLdb.cursors.DictCursor):
     ignore_warnings = False
     
@@ -325,6 +442,27 @@ class PyFlagCursor(MySQLdb.cursors.SSDictCursor):
         except IndexError:
             return None
 
+    def fetchmany_tuples(self, size):
+        """ Returns up to size rows as tuples in column order. This is
+        much faster than fetchone() for many rows because we do not
+        build a dict for each row.
+        """
+        self._check_executed()
+        result = []
+        if self.py_row_cache:
+            names = [ d[0] for d in self.description ]
+            for row in self.py_row_cache[:size]:
+                result.append(tuple([ row.get(n) for n in names ]))
+
+            self.py_row_cache = self.py_row_cache[size:]
+
+        ## Note that fetch_row(0) fetches all the rows
+        if len(result) < size and self._result:
+            result.extend(self._result.fetch_row(size - len(result), 0))
+
+        self.rownumber = self.rownumber + len(result)
+        return result
+
     def close(self):
         self.connection = None
 
@@ -383,6 +521,9 @@ def mysql_connect(case):
     if config.STRICTSQL:
         mysql_connection_args['sql_mode'] = "STRICT_ALL_TABLES"
 
+    if config.MASS_INSERT_INFILE:
+        mysql_connection_args['local_infile'] = 1
+
     if config.DB_SS_CURSOR:
         mysql_connection_args['cursorclass'] = PyFlagCursor
     else:
@@ -483,6 +624,8 @@ class PooledDBO:
     """
     temp_tables = []
     transaction = False
+    ## Indexes waiting to be built by build_indexes() by table
+    deferred_indexes = None
     ## This stores references to the pools
     DBH = Store.Store(max_size=10)
 
@@ -552,6 +695,17 @@ class PooledDBO:
         if params:
             string = db_expand(query_str, params)
         else: string = query_str
+
+        if config.QUERY_STATS:
+            start = time.time()
+            try:
+                return self._execute(string)
+            finally:
+                record_query(query_str, time.time() - start)
+
+        return self._execute(string)
+
+    def _execute(self, string):
         try:
             self.cursor.execute(string)
         #If anything went wrong we raise it as a DBError
@@ -590,73 +744,176 @@ class PooledDBO:
                 raise DBError(e)
 
     def expire_cache(self):
-        """ Expires the cache if needed """
-        ## Expire the cache if needed
-        self.start_transaction()
-        try:
-            self.execute("select * from sql_cache where timestamp < date_sub(now(), interval %r minute) for update", config.DBCACHE_AGE)
-            ## Make a copy to maintain the cursor
-            tables = [ row['id'] for row in self ]
-            for table_id in tables:
-                self.execute("delete from sql_cache where id = %r" , table_id)
-                self.execute("delete from sql_cache_tables where sql_id = %r" , table_id)
-                self.execute("drop table if exists `cache_%s`" , table_id)
-                
-        finally:
-            self.end_transaction()
+        """ Drops cache entries which were not used for DBCACHE_AGE
+        minutes, and then the least recently used entries until the
+        cache fits in DBCACHE_SIZE.
+        """
+        self.execute("select id from sql_cache where timestamp < date_sub(now(), interval %r minute) and status != 'progress'", config.DBCACHE_AGE)
+        ids = [ row['id'] for row in self ]
+
+        budget = config.DBCACHE_SIZE * 1024 * 1024
+        total = 0
+        self.execute("select id, size from sql_cache where status = 'cached' order by timestamp desc")
+        for row in self:
+            total += row['size'] or 0
+            if total > budget and row['id'] not in ids:
+                ids.append(row['id'])
+
+        if ids:
+            CACHE_STATS['evictions'] += len(ids)
+            self.drop_cache_entries(ids)
+
+    def drop_cache_entries(self, ids):
+        """ Removes the cache entries with ids and their tables """
+        ids_sql = ",".join([ "%d" % int(i) for i in ids ])
+        self.execute("delete from sql_cache where id in (%s)", ids_sql)
+        self.execute("delete from sql_cache_tables where sql_id in (%s)", ids_sql)
+        for i in ids:
+            self.execute("drop table if exists `cache_%s`" , i)
             
     def cached_execute(self, sql, limit=0, length=50):
         """ Executes the sql statement using the cache.
 
-        strategy: Check the sql_cache table for the row, if it does not exist, make it
-        if its in progress, spin for a while
-        if its cached return it.
-        
+        strategy: Find the cached window of the sql starting before
+        limit. If it covers the rows we want return them, if the rows
+        follow shortly after the window extend it, otherwise make a
+        new window. If the window is still being made we wait for it.
         """
         if config.SQL_CACHE_MODE=="realtime":
             self.expire_cache()
             
-        self.execute("""select * from sql_cache where query = %r and `limit` <= %r and `limit` + `length` >= %r order by id limit 1 for update""", (sql, limit, limit + length))
+        self.execute("""select * from sql_cache where query = %r and `limit` <= %r order by `limit` desc limit 1""", (sql, limit))
         row = self.fetch()
+        if row and row['status'] == 'progress':
+            CACHE_STATS['waits'] += 1
+            row = self._wait_for_cache(row['id'])
+
+        if row and row['status'] == 'dirty' and config.SQL_CACHE_MODE == "realtime":
+            ## Row is dirty - make it again
+            self.drop_cache_entries([row['id']])
+            row = None
+
         if not row:
             ## Row does not exist - make it
+            CACHE_STATS['misses'] += 1
             return self._make_sql_cache_entry(sql, limit, length)
-        elif row['status'] == 'dirty':
-            if config.SQL_CACHE_MODE == "realtime":
-                ## Row is dirty - make it
-                self._make_sql_cache_entry(sql, limit, length)
-            else:
-                ## We dont care about dirty rows now
-                return self.execute("select * from cache_%s limit %s,%s",
-                                    (row['id'], limit - row['limit'], length))
-            
-        elif row['status'] == 'cached':
-            return self.execute("select * from cache_%s limit %s,%s",
-                                (row['id'], limit - row['limit'], length))
-        elif row['status'] == 'progress':
-            ## Spin until its ready
-            count = config.TABLE_QUERY_TIMEOUT
-            while count > 0:
-                self.execute("select * from sql_cache where id=%r and status!='progress' limit 1", row['id'])
-                row2=self.fetch()
-                if row2:
-                    return self.execute("select * from cache_%s limit %s,%s",
-                                        (row['id'], limit - row['limit'], length))
-
-                time.sleep(1)
-                count -= 1
-                pyflaglog.log(pyflaglog.DEBUG,"Waiting for query to complete for %u" % count)
-            raise DBError("Query still executing - try again soon")
+
+        end = row['limit'] + row['length']
+        if limit + length > end:
+            if limit > end + config.DBCACHE_LENGTH:
+                ## Too far from this window - make a new one
+                CACHE_STATS['misses'] += 1
+                return self._make_sql_cache_entry(sql, limit, length)
+
+            CACHE_STATS['extensions'] += 1
+            row = self._extend_cache_entry(row, limit + length)
+        else:
+            CACHE_STATS['hits'] += 1
+            ## Keep the entry fresh for the LRU
+            self.execute("update sql_cache set timestamp = now() where id = %r", row['id'])
+
+        return self.execute("select * from cache_%s limit %s,%s",
+                            (row['id'], limit - row['limit'], length))
+
+    def _wait_for_cache(self, id):
+        """ Waits for the cache entry id to be made and returns its
+        row. Raises DBError if this takes too long.
+        """
+        deadline = time.time() + config.TABLE_QUERY_TIMEOUT
+
+        ## Entries made by this process notify us when they are done
+        key = (self.case, id)
+        CACHE_CONDITION.acquire()
+        try:
+            while key in MATERIALISING:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DBError("Query still executing - try again soon")
+
+                CACHE_CONDITION.wait(remaining)
+
+            error = CACHE_ERRORS.pop(key, None)
+        finally:
+            CACHE_CONDITION.release()
+
+        ## Report why the query failed
+        if isinstance(error, DBError):
+            raise error
+        elif error:
+            raise DBError("Unable to cache query: %s" % error)
+
+        ## Entries made by other processes need to be polled
+        while 1:
+            self.execute("select * from sql_cache where id=%r limit 1", id)
+            row = self.fetch()
+            if not row:
+                raise DBError("Unable to cache query")
+
+            if row['status'] != 'progress':
+                return row
+
+            if time.time() > deadline:
+                raise DBError("Query still executing - try again soon")
+
+            time.sleep(1)
+            pyflaglog.log(pyflaglog.DEBUG,"Waiting for query to complete for cache entry %s" % id)
+
+    def _materialise(self, id, statement, length):
+        """ Runs statement to fill the table cache_<id> in a worker
+        thread, then marks the entry cached with the length given.
+
+        Returns the row of the entry when done, or raises DBError if
+        it takes longer than TABLE_QUERY_TIMEOUT.
+        """
+        key = (self.case, id)
+        CACHE_CONDITION.acquire()
+        MATERIALISING.add(key)
+        CACHE_CONDITION.release()
+
+        def run_query():
+            dbh = DBO(self.case)
+            dbh.discard = True
+            start = time.time()
+            try:
+                try:
+                    dbh.execute(statement)
+                    dbh.execute("show table status like 'cache_%s'", id)
+                    row = dbh.fetch()
+                    size = row and row['Data_length'] or 0
+                    dbh.execute("update sql_cache set status='cached', `length`=%r, size=%r where id=%r",
+                                (length, size, id))
+                    CACHE_STATS['materialised'] += 1
+                    CACHE_STATS['materialise_time'] += time.time() - start
+                except Exception,e:
+                    pyflaglog.log(pyflaglog.WARNINGS, "Unable to cache query %s: %s" % (id, e))
+                    CACHE_CONDITION.acquire()
+                    CACHE_ERRORS[key] = e
+                    CACHE_CONDITION.release()
+
+                    ## Make sure we remove the progress status from the
+                    ## table
+                    dbh.drop_cache_entries([id])
+            finally:
+                CACHE_CONDITION.acquire()
+                MATERIALISING.discard(key)
+                CACHE_CONDITION.notifyAll()
+                CACHE_CONDITION.release()
+
+        ## We start by launching a worker thread
+        worker = threading.Thread(target=run_query)
+        worker.start()
+
+        return self._wait_for_cache(id)
 
     def _make_sql_cache_entry(self, sql, limit, length):
         ## Query is not in cache - create a new cache entry: We create
         ## the cache centered on the required range - this allows
         ## quick paging forward and backwards.
         lower_limit = max(limit - config.DBCACHE_LENGTH/2,0)
+        window = max(config.DBCACHE_LENGTH, limit + length - lower_limit)
 
         ## Determine which tables are involved:
-        self.execute("explain %s", sql)
-        tables = [ row['table'] for row in self if row['table'] ]
+        tables = self.query_tables(sql)
             
         if not tables:
             ## Should not happen - the query does not affect any tables??
@@ -665,7 +922,7 @@ class PooledDBO:
         self.insert('sql_cache',
                     query = sql, _timestamp='now()',
                     limit = lower_limit,
-                    length = config.DBCACHE_LENGTH,
+                    length = window,
                     status = 'progress',
                     _fast = True
                     )
@@ -679,66 +936,106 @@ class PooledDBO:
                         sql_id = id,
                         table_name = t,
                         _fast = True)
-            
-        ## Now comes the tricky part
-        def run_query():
-            dbh = DBO(self.case)
-            dbh.discard = True
-            try:
-                dbh.execute("create table cache_%s %s limit %s,%s",
-                            (id,sql, lower_limit, config.DBCACHE_LENGTH))
-                for row in dbh: pass
-                dbh.execute("update sql_cache set status='cached' where id=%r" , id)
-                dbh.execute("commit")
-            except Exception,e:
-                ## Make sure we remove the progress status from the
-                ## table
-                dbh.execute("delete from sql_cache where id=%r", id)
-                raise
-            
-        ## We start by launching a worker thread
-        worker = threading.Thread(target=run_query)
-        worker.start()
 
-        ## Wait for the worker to finish
-        worker.join(config.TABLE_QUERY_TIMEOUT)
-        if worker.isAlive():
-            raise DBError("Query still executing - try again soon")
+        self._materialise(id, db_expand("create table cache_%s %s limit %s,%s",
+                                        (id, sql, lower_limit, window)), window)
 
-        for i in range(config.TABLE_QUERY_TIMEOUT):
-            try:
-                return self.execute("select * from cache_%s limit %s,%s",
-                                    (id,limit - lower_limit,length))
-            except DBError,e:
-                ## Sometimes it takes a while for the table to be
-                ## available to the two threads. (Is this normal -
-                ## this seems like a weird race?)
-                if "doesn't exist" in e.__str__():
-                    time.sleep(1)
-                else:
-                    break
+        return self.execute("select * from cache_%s limit %s,%s",
+                            (id,limit - lower_limit,length))
 
-                raise e
+    def _extend_cache_entry(self, row, end):
+        """ Appends rows to the cache entry so it covers up to end.
+        Returns the row of the entry when done.
+        """
+        new_length = row['length']
+        while row['limit'] + new_length < end:
+            new_length += config.DBCACHE_LENGTH
+
+        ## Make sure only one thread extends the entry
+        self.execute("update sql_cache set status='progress' where id=%r and status='cached' and `length`=%r",
+                     (row['id'], row['length']))
+        if not self.cursor.connection.affected_rows():
+            return self._wait_for_cache(row['id'])
+
+        old_end = row['limit'] + row['length']
+        return self._materialise(row['id'],
+                                 db_expand("insert into cache_%s %s limit %s,%s",
+                                           (row['id'], row['query'], old_end,
+                                            row['limit'] + new_length - old_end)),
+                                 new_length)
             
     def __iter__(self):
         return self
 
+    def cached_count(self, sql):
+        """ Returns the number of rows of the query remembered by
+        cache_count(), or None if we do not know it.
+        """
+        try:
+            self.execute("select `count` from count_cache where query_hash = %r limit 1",
+                         md5(force_string(sql)).hexdigest())
+        except DBError:
+            return None
+
+        row = self.fetch()
+        if row: return row['count']
+
+    def query_tables(self, sql):
+        """ Returns the names of the tables the query reads. EXPLAIN
+        reports the aliases of tables so we map them back to the table
+        names (which is what invalidate() is called with).
+        """
+        self.execute("explain %s", sql)
+        names = [ row['table'] for row in self if row['table'] ]
+        aliases = table_aliases(sql)
+
+        result = []
+        for name in names:
+            ## Derived tables are listed as <derived2> etc - their
+            ## tables have rows of their own
+            if name.startswith("<"): continue
+
+            name = aliases.get(name, name)
+            if name not in result:
+                result.append(name)
+
+        return result
+
+    def cache_count(self, sql, count):
+        """ Remembers the number of rows of the query until one of its
+        tables is invalidated.
+        """
+        tables = self.query_tables(sql)
+
+        query_hash = md5(force_string(sql)).hexdigest()
+        self.execute("create table if not exists count_cache ("
+                     "`query_hash` char(32), `table_name` varchar(250), "
+                     "`count` bigint, key(query_hash), key(table_name))")
+        for t in tables:
+            self.insert('count_cache', query_hash = query_hash,
+                        table_name = t, count = count, _fast = True)
+
     def invalidate(self,table):
         """ Invalidate all copies of the cache which relate to this table """
+        ## Counts of this table are no longer exact. Most tables have
+        ## no cached counts, and looking is cheaper than deleting
+        ## (which locks count_cache).
+        try:
+            self.execute("select 1 from count_cache where `table_name`=%r limit 1", table)
+            if self.fetch():
+                self.execute("delete from count_cache where `table_name`=%r", table)
+        except DBError:
+            pass
+
         if config.SQL_CACHE_MODE=='realtime':
-            self.execute("start transaction")
             try:
-                try:
-                    self.execute("select sql_id from sql_cache_tables where `table_name`=%r for update", table)
-                except Exception, e:
-                    pass
+                self.execute("select sql_id from sql_cache_tables where `table_name`=%r", table)
                 ids = [row['sql_id'] for row in self]
-                for id in ids:
-                    self.execute("delete from sql_cache where id=%r", id)
-                    self.execute("delete from sql_cache_tables where sql_id=%r", id)
-                    self.execute("drop table if exists cache_%s", id)
-            finally:
-                self.end_transaction()
+            except DBError, e:
+                ids = []
+
+            if ids:
+                self.drop_cache_entries(ids)
 
     def _calculate_set(self, **fields):
         """ Calculates the required set clause from the fields provided """
@@ -798,35 +1095,117 @@ class PooledDBO:
         self.execute(sql, [table,]+args)
                     
     def mass_insert_start(self, table, _fast=False):
+        ## The rows are kept by column - each column is a list of
+        ## values (MISSING where a row did not have the column)
         self.mass_insert_cache = {}
         self.mass_insert_table = table
         self.mass_insert_row_count = 0
         self.mass_insert_fast = _fast
+        self.mass_insert_raw = False
     
     def mass_insert(self, args=None, **columns):
         """ Starts a mass insert operation. When done adding rows, call commit_mass_insert to finalise the insert.
         """
         if args: columns = args
-        
+
+        cache = self.mass_insert_cache
+        count = self.mass_insert_row_count
         for k,v in columns.items():
-            ## _field means to pass the field
+            try:
+                column = cache[k]
+            except KeyError:
+                column = cache[k] = []
+                ## _field means to pass the field
+                if k.startswith('_') and not k.startswith('__'):
+                    self.mass_insert_raw = True
+
+            if len(column) < count:
+                column.extend([MISSING] * (count - len(column)))
+
+            column.append(v)
+
+        self.mass_insert_row_count+=1
+
+        ## LOAD DATA can not take raw sql so we only use it for tables
+        ## without raw fields
+        if config.MASS_INSERT_INFILE and not self.mass_insert_raw and \
+               not INFILE_FAILED:
+            threshold = config.INFILE_THRESHOLD
+        else:
+            threshold = config.MASS_INSERT_THRESHOLD
+
+        if self.mass_insert_row_count > threshold:
+            self.mass_insert_commit()
+
+    def _mass_insert_columns(self, encoders):
+        """ Returns the column names and a list of encoded values for
+        each column. encoders is a tuple of functions to encode
+        escaped, raw and binary values, and the value for NULL.
+        """
+        escaped, raw, binary, null = encoders
+        count = self.mass_insert_row_count
+        names = []
+        columns = {}
+        for k, values in self.mass_insert_cache.items():
             if k.startswith("__"):
-                v=db_expand("%b", (v,))
-                k=k[2:]
+                name = k[2:]
+                encoder = binary
             elif k.startswith('_'):
-                k=k[1:]
+                name = k[1:]
+                encoder = raw
             else:
-                v=db_expand("%r", (v,))
-                
+                name = k
+                encoder = escaped
+
+            values = values + [MISSING] * (count - len(values))
+            values = [ v is MISSING and null or encoder(v) for v in values ]
+
+            ## The same column may be given both raw and escaped
+            ## (e.g. col and _col) in different rows
             try:
-                self.mass_insert_cache[k][self.mass_insert_row_count]=v
-            except:
-                self.mass_insert_cache[k]={ self.mass_insert_row_count: v}
+                old = columns[name]
+                for i in range(count):
+                    if old[i] is null: old[i] = values[i]
+            except KeyError:
+                names.append(name)
+                columns[name] = values
+
+        return names, [ columns[name] for name in names ]
+
+    def _mass_insert_sql(self):
+        names, columns = self._mass_insert_columns(SQL_ENCODERS)
+        rows = [ ",".join(row) for row in zip(*columns) ]
+
+        self.execute("insert ignore into `%s` (%s) values (%s)", (
+            self.mass_insert_table,
+            ','.join(["`%s`" % c for c in names]),
+            "),(".join(rows)))
+
+    def _mass_insert_infile(self):
+        """ Writes the rows to a tab separated file and loads it """
+        global INFILE_FAILED
+
+        names, columns = self._mass_insert_columns(TSV_ENCODERS)
+        fd, filename = tempfile.mkstemp(suffix=".tsv")
+        try:
+            outfd = os.fdopen(fd, "wb")
+            for row in zip(*columns):
+                outfd.write("\t".join(row))
+                outfd.write("\n")
 
-        self.mass_insert_row_count+=1
-        if self.mass_insert_row_count > config.MASS_INSERT_THRESHOLD:
-            self.mass_insert_commit()
-            self.mass_insert_start(self.mass_insert_table, _fast=self.mass_insert_fast)
+            outfd.close()
+            try:
+                self.execute("load data local infile %r ignore into table `%s` "
+                             "character set binary (%s)", (
+                    filename, self.mass_insert_table,
+                    ','.join(["`%s`" % c for c in names])))
+            except DBError, e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to LOAD DATA LOCAL INFILE "
+                              "(%s) - using inserts instead" % e)
+                INFILE_FAILED = True
+                self._mass_insert_sql()
+        finally:
+            os.unlink(filename)
 
     def mass_insert_commit(self):
         try:
@@ -837,24 +1216,14 @@ class PooledDBO:
 
         if len(keys)==0: return
         
-        args = []
-        values = []
-        for i in range(self.mass_insert_row_count):
-            for k in keys:
-                try:
-                    args.append(self.mass_insert_cache[k][i])
-                except KeyError:
-                    args.append('NULL')
-
-            values.append(",".join(["%s"] * len(keys)))
-
-        sql = "insert ignore into `%s` (%s) values (%s)" % (self.mass_insert_table,
-                                                   ','.join(["`%s`" % c for c in keys]),
-                                                   "),(".join(values))
         if not self.mass_insert_fast:
             self.invalidate(self.mass_insert_table)
-            
-        self.execute(sql,*args)
+
+        if config.MASS_INSERT_INFILE and not self.mass_insert_raw and \
+               not INFILE_FAILED:
+            self._mass_insert_infile()
+        else:
+            self._mass_insert_sql()
 
         ## Ensure the cache is now empty:
         self.mass_insert_start(self.mass_insert_table,
@@ -879,6 +1248,66 @@ class PooledDBO:
         It is encouraged to use this function over cursor.fetchone to ensure that if columns get reordered in the future code does not break. The result of this function is a dictionary with keys being the column names and values being the values """
         return self.cursor.fetchone()
     
+    def stream_execute(self, query_str, *params):
+        """ Executes the query with a server side cursor.
+
+        The rows are streamed from the server as they are fetched
+        rather than being stored in memory first. This is suitable for
+        reading very large result sets with fetchmany() or
+        iter_batches(). Note that no other queries may be issued on
+        this object until all the rows are read.
+        """
+        if not isinstance(self.cursor, PyFlagCursor):
+            self.cursor = self.dbh.cursor(PyFlagCursor)
+
+        return self.execute(query_str, *params)
+
+    def column_names(self):
+        """ Returns the names of the columns in the current result set """
+        return [ d[0] for d in self.cursor.description or () ]
+
+    def fetchmany(self, size=1000, columns=None):
+        """ Returns a list of up to size rows as tuples.
+
+        If columns is given, only those columns are returned (in that
+        order), otherwise all the columns are returned in the order of
+        column_names(). An empty list is returned when there are no
+        more rows.
+        """
+        names = self.column_names()
+        if isinstance(self.cursor, PyFlagCursor):
+            rows = self.cursor.fetchmany_tuples(size)
+        else:
+            ## Cursors which store the result as dicts
+            rows = [ tuple([ row.get(n) for n in names ]) for row in \
+                     self.cursor.fetchmany(size) ]
+
+        if columns:
+            indexes = [ names.index(c) for c in columns ]
+            if len(indexes) == 1:
+                i = indexes[0]
+                rows = [ (row[i],) for row in rows ]
+            elif indexes != range(len(names)):
+                getter = operator.itemgetter(*indexes)
+                rows = [ getter(row) for row in rows ]
+
+        return rows
+
+    def iter_batches(self, size=1000, columns=None, as_columns=False):
+        """ A generator of batches of rows (see fetchmany()).
+
+        If as_columns is set each batch is a list of columns, each
+        being a tuple of the values of that column in the batch.
+        """
+        while 1:
+            rows = self.fetchmany(size, columns)
+            if not rows: break
+
+            if as_columns:
+                yield zip(*rows)
+            else:
+                yield rows
+
     def check_index(self, table, key, idx_type='', length=None):
         """ This checks the database to ensure that the said table has an index on said key.
 
@@ -903,6 +1332,13 @@ class PooledDBO:
             else:
                 sql="(`%s`)" % (key) 
 
+            ## Build it later with the other indexes of this table
+            try:
+                self.deferred_indexes[table][key] = "add index %s %s" % (idx_type, sql)
+                return
+            except (TypeError, KeyError):
+                pass
+
             pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Oops... No index found in table %s on field %s - Generating index, this may take a while" %(table,key))
             ## Index not found, we make it here:
             self.execute("Alter table `%s` add index %s %s",(table,idx_type,sql))
@@ -910,6 +1346,30 @@ class PooledDBO:
             ## Add to cache:
             fields.append(key)
         
+    def defer_indexes(self, table):
+        """ Indexes added to table by check_index() are not made until
+        build_indexes() is called. This allows all the indexes to be
+        built in a single ALTER TABLE after the table is loaded.
+        """
+        if self.deferred_indexes is None:
+            self.deferred_indexes = {}
+
+        self.deferred_indexes.setdefault(table, {})
+
+    def build_indexes(self, table):
+        """ Builds all the deferred indexes of table """
+        try:
+            indexes = self.deferred_indexes.pop(table)
+        except (AttributeError, KeyError):
+            return
+
+        if not indexes: return
+
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Building indexes on %s for %s" % (
+            table, ",".join(indexes.keys())))
+        self.execute("alter table `%s` %s", (table, ",".join(indexes.values())))
+        DBIndex_Cache.expire("^%s/%s$" % (re.escape(self.case), re.escape(table)))
+
     def get_meta(self, property, table='meta',**args):
         """ Returns the value for the given property in meta table selected database
 
@@ -1053,6 +1513,34 @@ def check_column_in_table(case, table, column_name, sql):
     except:
         dbh.execute("alter table `%s` add `%s` %s", table, column_name, sql)
 
+## The primary key column of tables keyed by case/table
+PRIMARY_KEYS = Store.Store()
+
+def get_primary_key(case, table):
+    """ Returns the column of the primary key of table, or None if the
+    table does not have a single column primary key.
+    """
+    cache_key = "%s/%s" % (case, table)
+    try:
+        return PRIMARY_KEYS.get(cache_key)
+    except KeyError:
+        pass
+
+    dbh = DBO(case)
+    try:
+        dbh.execute("show index from `%s` where Key_name = 'PRIMARY'", table)
+        columns = [ row['Column_name'] for row in dbh ]
+    except DBError:
+        columns = []
+
+    if len(columns) == 1:
+        key = columns[0]
+    else:
+        key = None
+
+    PRIMARY_KEYS.put(key, key=cache_key)
+    return key
+
 ## The following are utilitiy functions which can be used to manage
 ## schema changes
 def convert_to_unicode(case, table):
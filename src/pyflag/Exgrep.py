@@ -30,11 +30,18 @@
 
 This module will extract files from an image by using their magic.
 """
-import re,types
+import re,types,os
 import pyflag.conf
 import pyflag.pyflaglog as pyflaglog
 config=pyflag.conf.ConfObject()
 
+config.add_option("CARVE_PROCESSES", default=0, type='int',
+                  help="Number of processes to carve with (0 uses all the CPUs)")
+
+config.add_option("CARVE_RANGE_SIZE", default=256, type='int',
+                  help="Size (in MB) of the ranges of the image each carving "
+                  "process works on")
+
 ## This initialises the cut definition stack:
 definitions=[]
 
@@ -159,31 +166,77 @@ def add_definition(i):
     definitions.append(i)
 
 import pyflag.IO as IO
+import pyflag.MultiGrep as MultiGrep
+
+def get_cuts(extension=None):
+    """ Returns the definitions for the extensions required, and a
+    scanner for all their start and end regexes.
+    """
+    cuts = [ cut for cut in definitions if not extension or \
+             cut['Extension'] in extension ]
+
+    ## The start regexes must come before the end regexes so a start
+    ## and end at the same offset are seen in that order.
+    patterns = [ (("start", i), cut['StartRE']) for i, cut in enumerate(cuts) ]
+    patterns += [ (("end", i), cut['EndRE']) for i, cut in enumerate(cuts) \
+                  if cut.has_key('EndRE') ]
+
+    return cuts, MultiGrep.Scanner(patterns)
+
+def carve(cuts, hits):
+    """ Produces the files carved from the stream of scanner hits.
+
+    If there is an end RE, the file extends to the first end found
+    within MaxLength of its start. This is essential for certain file
+    types which do not tolerate garbage at the end of the file,
+    e.g. pdfs. Otherwise (or if the end is not found) the file is
+    MaxLength long.
+
+    The end is found in the same pass as the start so we never need to
+    read the data again. Files are produced as soon as their end is
+    known, so they may not be in offset order.
+    """
+    ## The starts which are still waiting for their end, for each cut:
+    pending = [ [] for cut in cuts ]
+
+    def result(offset, length, cut):
+        return {'offset':offset,'length':length,'type':cut['Extension']}
+
+    for (kind, i), start, end in hits:
+        ## No end can be found for starts which are more than
+        ## MaxLength behind us
+        for j in range(len(cuts)):
+            starts = pending[j]
+            length = cuts[j]['MaxLength']
+            while starts and starts[0] + length < start:
+                yield result(starts.pop(0), length, cuts[j])
+
+        cut = cuts[i]
+        if kind == "start":
+            if cut.has_key('CEndRE'):
+                pending[i].append(start)
+            else:
+                yield result(start, cut['MaxLength'], cut)
+        else:
+            for offset in pending[i]:
+                yield result(offset, min(end - offset, cut['MaxLength']), cut)
+
+            pending[i] = []
+
+    for i in range(len(cuts)):
+        for offset in pending[i]:
+            yield result(offset, cuts[i]['MaxLength'], cuts[i])
 
 def process_string(string,extension=None):
     """ This is just like process except it operates on a string """
-    for cut in definitions:
-        offset=0
-        if extension and cut['Extension'] not in extension: continue
-        while 1:
-            match=cut['CStartRE'].search(string,offset)
-            if match:
-                offset=match.start()
-                length=cut['MaxLength']
-                ## If there is an end RE, we try to read the entire length in, and then look for the end to we can adjust the length acurately. This is essential for certain file types which do not tolerate garbage at the end of the file, e.g. pdfs.
-                if cut.has_key('CEndRE'):
-                    end_match=cut['CEndRE'].search(string,offset)
-                    if end_match:
-                        length=end_match.end()-offset
-
-                yield({'offset':offset,'length':length,'type':cut['Extension']})
-                offset+=1
-            else:
-                break
+    cuts, scanner = get_cuts(extension)
+    return carve(cuts, scanner.scan(string))
     
 def process(case,subsys,extension=None):
     """ A generator to produce all the recoverable files within the io object identified by identifier
 
+    All the definitions are searched for in one pass over the data.
+
     @arg subsys: Either an IO object to use, or the string name of an io object that will be opened using IO.open().
     @arg extension: A list of extensions we would like to see
     """
@@ -191,49 +244,131 @@ def process(case,subsys,extension=None):
         io=IO.open(case,subsys)
     else:
         io=subsys
-        
-    blocksize=1024*1024*10
-    windowsize=100
-    count=0
-    bytes_read=0
-    window=''
-    while(1):
-        ## This implements a sliding window of window bytes to ensure
-        ## we do not miss a signature that was split across blocksize:
-        try:
-            data=io.read(blocksize)
-            if not len(data): break
-        except IOError:
-            break
-        
-        f=window+data
-        bytes_read+=len(data)
+
+    def progress(bytes_read):
         pyflaglog.log(pyflaglog.INFO,"Processed %u Mb" % (bytes_read/1024/1024))
-        for cut in definitions:
-            if extension and cut['Extension'] not in extension: continue
-            pos=0
-            while pos<blocksize:
-                match=cut['CStartRE'].search(f,pos)
-                if match:
-                    offset=match.start()+count-len(window)
-                    length=cut['MaxLength']
-                    ## If there is an end RE, we try to read the entire length in, and then look for the end to we can adjust the length acurately. This is essential for certain file types which do not tolerate garbage at the end of the file, e.g. pdfs.
-                    if cut.has_key('CEndRE'):
-                        tell=io.tell()
-                        io.seek(offset)
-                        file_data=io.read(length)
-                        io.seek(tell)
-
-                        end_match=cut['CEndRE'].search(file_data,0)
-                        if end_match:
-                            length=end_match.end()
-                  
-                    yield({'offset':offset,'length':length,'type':cut['Extension']})
-                    pos=match.start()+1
-                else:
-                    pos=blocksize
-
-        window=f[-windowsize:]
-        count+=blocksize
+
+    cuts, scanner = get_cuts(extension)
+    for hit in carve(cuts, scanner.scan_fd(io, progress=progress)):
+        yield hit
         
     io.close()
+
+def open_source(case, subsys):
+    """ Opens the IO source subsys in case. If case is None subsys is
+    the filename of a raw image.
+    """
+    if case is None:
+        return open(subsys, 'rb')
+
+    return IO.open(case, subsys)
+
+def init_carve_process():
+    """ Called in each carving process when it starts. The images
+    cached by the parent share their file offsets with it, so we must
+    open our own.
+    """
+    IO.IO_Cache.flush()
+
+def carve_range((case, subsys, extension, start, end)):
+    """ Carves the files which start between start and end of the
+    source. We read MaxLength past end to find the ends of these
+    files.
+    """
+    io = open_source(case, subsys)
+    try:
+        cuts, scanner = get_cuts(extension)
+        max_length = max([0] + [ cut['MaxLength'] for cut in cuts ])
+
+        def hits():
+            for hit in scanner.scan_range(io, start, end + max_length):
+                ## Files starting after end belong to the next range
+                if hit[0][0] == "start" and hit[1] >= end: continue
+                yield hit
+
+        return list(carve(cuts, hits()))
+    finally:
+        io.close()
+
+def process_parallel(case, subsys, extension=None, processes=None, range_size=None):
+    """ Like process but the source is split into ranges which are
+    carved by a pool of processes at the same time.
+
+    subsys must be the name of an IO source (or an image filename if
+    case is None) as each process opens it separately. Files are
+    produced as each range is finished.
+    """
+    io = open_source(case, subsys)
+    io.seek(0, 2)
+    size = io.tell()
+    io.close()
+
+    range_size = int((range_size or config.CARVE_RANGE_SIZE) * 1024 * 1024)
+    jobs = [ (case, subsys, extension, start, end) for start, end in \
+             MultiGrep.split_ranges(size, range_size) ]
+
+    done = 0
+    for job, result in MultiGrep.parallel_map(carve_range, jobs,
+                                              processes or config.CARVE_PROCESSES,
+                                              init_carve_process):
+        done += 1
+        pyflaglog.log(pyflaglog.INFO, "Carved range %u-%u Mb (%s of %s): %s files" % (
+            job[3]/1024/1024, job[4]/1024/1024, done, len(jobs), len(result)))
+
+        for hit in result:
+            yield hit
+
+import unittest
+
+class CarveTest(unittest.TestCase):
+    """ Carving files by their magic """
+    def setUp(self):
+        import tempfile
+
+        ## (type, data) in order - the offset and length of each file
+        ## is recorded as the image is built
+        files = [ ("gif", "GIF89a" + "g" * 100),
+                  ("png", "\x89PNG\x0d\x0a\x1a\x0a" + "p" * 400 + "IEND\xae\x42\x60\x82"),
+                  ("pdf", "%PDF-1.4" + "d" * 3000 + "\x0d%%EOF\x0d"),
+                  ("png", "\x89PNG\x0d\x0a\x1a\x0a" + "p" * 100) ]
+
+        self.data = ""
+        self.expected = []
+        for extension, data in files:
+            self.data += "x" * 900
+            self.expected.append((len(self.data), len(data), extension))
+            self.data += data
+
+        self.data += "x" * 900
+
+        ## Files without an end are MaxLength long
+        self.expected[0] = (self.expected[0][0], 50000, "gif")
+        self.expected[3] = (self.expected[3][0], 500000, "png")
+
+        fd, self.filename = tempfile.mkstemp(suffix=".dd")
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def carved(self, hits):
+        return sorted([ (hit['offset'], hit['length'], hit['type']) for hit in hits ])
+
+    def test01Carve(self):
+        """ Carved files start at their magic and end at their end """
+        self.assertEqual(self.carved(process_string(self.data)), self.expected)
+        self.assertEqual(self.carved(process(None, open(self.filename, 'rb'))),
+                         self.expected)
+
+        ## Only the extensions asked for are carved
+        self.assertEqual(self.carved(process_string(self.data, ["png"])),
+                         [ x for x in self.expected if x[2] == "png" ])
+
+    def test02Parallel(self):
+        """ Carving ranges in parallel finds the same files """
+        ## The pdf spans several ranges
+        for range_size in (512, 1024, 4096, len(self.data)):
+            hits = process_parallel(None, self.filename, processes=2,
+                                    range_size=range_size / 1024.0 / 1024)
+            self.assertEqual(self.carved(hits), self.expected)
@@ -39,9 +39,43 @@ Our requirements from a distributed processing framework are:
 
 4. Workers must be able to exist when their nanny or master exits.
 
+Job queues
+----------
 
+Jobs are distributed through a job queue selected by the JOB_QUEUE
+option:
+
+fifo: Jobs are pickled into fixed PACKET_SIZE writes on the named
+   FIFO. This is fast but jobs must be small, jobs are lost if all
+   the workers die, and if the FIFO is full the poster runs the job
+   itself.
+
+db: Jobs are stored in the jobs table of the pyflag database. Jobs
+   may be of any size, are serviced in priority order, survive
+   restarts of the workers and the master, and posters block when
+   too many jobs are outstanding. The FIFO is only used to wake
+   sleeping workers up.
+
+broker: Jobs are sent to a job broker over TCP, so workers on other
+   hosts can service them (see pyflag.Broker).
+
+Regardless of the queue, the number of outstanding jobs for each
+cookie is kept by the cookie server (see pyflag.Cookies), or in the
+jobs.tdb if no server is running.
+
+Worker pool
+-----------
+
+The master starts WORKERS workers. If MAX_WORKERS is larger, the
+nanny periodically adds workers while jobs are queued up and there is
+spare CPU and memory, and retires them again when the queue is
+idle. Workers are retired, or recycled when they use too much memory,
+only between jobs.
+
+Each worker keeps counters of the jobs it ran in workers.tdb (see
+get_worker_stats()).
 """ 
-import sys,os,select, pytdb
+import sys,os,select, pytdb, errno, threading, fcntl, termios
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 import pyflag.pyflaglog as pyflaglog
@@ -51,7 +85,7 @@ import pyflag.Registry as Registry
 import pyflag.Store as Store
 import pdb
 import pyflag.FlagFramework as FlagFramework
-import pickle
+import pickle, struct
 
 ## All writes to the pipes must be exactly this size. This guarantees
 ## that commands are atomically read and written.
@@ -66,38 +100,254 @@ FlagFramework.job_tdb = None
 config.add_option("MAXIMUM_WORKER_MEMORY", default=0, type='int',
                   help='Maximum amount of memory (Mb) the worker is allowed to consume (0=unlimited,default)')
 
+config.add_option("MAX_WORKERS", default=0, type='int',
+                  help='The nanny may start up to this many workers when there is a backlog of jobs (0=only start WORKERS)')
+
+config.add_option("WORKER_SCALE_PERIOD", default=10, type='int',
+                  help='Number of seconds between the nanny checking if workers need to be added or retired')
+
+config.add_option("WORKER_CPU_THRESHOLD", default=90, type='int',
+                  help='The nanny will not add workers when CPU utilisation (%) is above this')
+
+config.add_option("MINIMUM_FREE_MEMORY", default=256, type='int',
+                  help='The nanny will not add workers (and retire them) when there is less free memory (Mb) than this')
+
+def get_rss(pid=None):
+    """ Returns the resident memory of the process in Mb """
+    mem = open("/proc/%s/statm" % (pid or os.getpid())).read().split()
+    return int(mem[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
 def check_mem():
     """ Checks for our current memory usage - if it exceeds the limit
     we exit and let the nanny restart us.
+
+    This is only called between jobs so we never exit with a job in
+    flight.
     """
-    if config.MAXIMUM_WORKER_MEMORY > 0:
-        mem = open("/proc/%s/statm" % os.getpid()).read().split()
-        if int(mem[1])*4096/1024/1024 > config.MAXIMUM_WORKER_MEMORY:
-            pyflaglog.log(pyflaglog.WARNING, "Process resident memory exceeds threshold. Exiting")
-            os._exit(0)
+    rss = get_rss()
+    if worker_stats:
+        worker_stats.update_usage(rss)
+
+    if config.MAXIMUM_WORKER_MEMORY > 0 and rss > config.MAXIMUM_WORKER_MEMORY:
+        pyflaglog.log(pyflaglog.WARNING, "Process resident memory exceeds threshold. Exiting")
+        exit_worker()
+
+class WorkerStats:
+    """ Counters about the work done by a worker.
+
+    These are stored pickled in workers.tdb keyed by the worker's pid,
+    so the master and other processes can report on them.
+    """
+    ## Minimum number of seconds between saving the counters
+    SAVE_PERIOD = 1
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.jobs = 0
+        ## Task name -> [jobs, seconds]
+        self.tasks = {}
+        self.bytes_read = 0
+        self.rss = 0
+        self.peak_rss = 0
+        self.last_saved = 0
+
+    def job_done(self, command, count, elapsed):
+        self.jobs += count
+        try:
+            task = self.tasks[command]
+        except KeyError:
+            task = self.tasks[command] = [0, 0]
+
+        task[0] += count
+        task[1] += elapsed
+
+    def update_usage(self, rss):
+        self.rss = rss
+        self.peak_rss = max(self.peak_rss, rss)
+
+        ## This counts all bytes read by the process (including from
+        ## the page cache)
+        try:
+            for line in open("/proc/%s/io" % self.pid):
+                if line.startswith("rchar:"):
+                    self.bytes_read = int(line.split()[1])
+                    break
+        except (IOError, ValueError):
+            pass
+
+        self.save()
+
+    def save(self, force=False):
+        now = time.time()
+        if not force and now - self.last_saved < self.SAVE_PERIOD:
+            return
+
+        self.last_saved = now
+        get_worker_tdb().store(str(self.pid), pickle.dumps(self.__dict__))
+
+    def remove(self):
+        try:
+            get_worker_tdb().delete(str(self.pid))
+        except (KeyError, IOError):
+            pass
+
+worker_stats = None
+
+def get_worker_tdb():
+    if not FlagFramework.worker_tdb:
+        FlagFramework.worker_tdb = pytdb.PyTDB("%s/workers.tdb" % config.RESULTDIR)
+
+    return FlagFramework.worker_tdb
+
+FlagFramework.worker_tdb = None
+
+def get_worker_stats():
+    """ Returns a list of the counters of all live workers """
+    tdb = get_worker_tdb()
+    result = []
+    for key in tdb.list_keys():
+        try:
+            stats = pickle.loads(tdb.get(key))
+            os.kill(stats['pid'], 0)
+        except OSError:
+            ## This worker is gone
+            tdb.delete(key)
+            continue
+        except Exception:
+            continue
+
+        result.append(stats)
+
+    result.sort(key = lambda x: x['pid'])
+    return result
+
+def record_job(command, count, elapsed):
+    if worker_stats:
+        worker_stats.job_done(command, count, elapsed)
+
+def exit_worker():
+    """ Exits the worker (between jobs) """
+    if worker_stats:
+        worker_stats.remove()
+
+    os._exit(0)
 
 class Task:
     """ All distributed tasks need to extend this subclass """
     def run(self, **kwargs):
         """ This method is called in the worker to run """
 
+    def coalesce_key(self, argdict, cookie):
+        """ Returns a key for this job. Queued jobs with the same key
+        may be given to run_many() together. Return None if the job
+        can not be coalesced.
+        """
+        return None
+
+    def run_many(self, jobs):
+        """ Runs a list of (argdict, cookie) jobs which share the same
+        coalesce key.
+        """
+        for argdict, cookie in jobs:
+            self.run(cookie=cookie, **argdict)
+
 config.add_option("WORKERS", default=2, type='int',
                   help='Number of workers to start up')
 
 config.add_option("FIFO", default=config.RESULTDIR + "/jobs",
                   help = "The fifo to use for distributing jobs")
 
-def run_task(command, argdict, cookie):
-    """ Runs the given task in the current process """
+config.add_option("JOB_QUEUE", default="fifo",
+                  help = "The job queue to use for distributing jobs (fifo, db)")
+
+config.add_option("JOB_QUEUE_LIMIT", default=10000, type='int',
+                  help = "Posting jobs blocks when this many jobs are outstanding in the db job queue")
+
+config.add_option("JOB_QUEUE_POLL", default=5, type='int',
+                  help = "Number of seconds workers wait between checking the db job queue")
+
+config.add_option("JOB_BATCH_SIZE", default=100, type='int',
+                  help = "Maximum number of items posted in a single batch job")
+
+config.add_option("JOB_COALESCE", default=1, type='int',
+                  help = "Workers run up to this many queued jobs of the same kind together")
+
+## The default priority of jobs. Jobs with higher priorities are
+## serviced first.
+DEFAULT_PRIORITY = 10
+
+## The number of bytes scanned by the current job (see add_bytes_scanned())
+bytes_scanned = 0
+
+def add_bytes_scanned(count):
+    """ Tasks call this to report how much data they scanned. It is
+    credited to the cookie of the job.
+    """
+    global bytes_scanned
+    bytes_scanned += count
+
+def take_bytes_scanned():
+    global bytes_scanned
+
+    result = bytes_scanned
+    bytes_scanned = 0
+    return result
+
+def increment_cookie(cookie):
+    """ Records a new outstanding job for the cookie """
+    import pyflag.Cookies as Cookies
+
+    if Cookies.enabled():
+        Cookies.send(('add', cookie, 1))
+        return
+
+    job_tdb = get_job_tdb()
+
+    job_tdb.lock()
+    try:
+        try:
+            count = int(job_tdb.get(str(cookie))) + 1
+            job_tdb.store(str(cookie), str(count))
+        except (KeyError, TypeError):
+            job_tdb.store(str(cookie), str(1))
+    finally:
+        job_tdb.unlock()
+
+def decrement_cookies(cookies, bytes=0):
+    """ Marks a job for each of the cookies as done. bytes is the
+    amount of data the jobs scanned.
+    """
+    import pyflag.Cookies as Cookies
+
+    if Cookies.enabled():
+        Cookies.send(('done', list(cookies), bytes))
+        return
+
     ## Jobs tdb keeps track of outstanding jobs
     job_tdb = get_job_tdb()
-    
+
+    job_tdb.lock()
+    try:
+        for cookie in cookies:
+            try:
+                count = int(job_tdb.get("%s" % cookie)) - 1
+                job_tdb.store(str(cookie), str(count))
+            except (KeyError, TypeError):
+                job_tdb.store(str(cookie), str(0))
+    finally:
+        job_tdb.unlock()
+
+def run_task(command, argdict, cookie):
+    """ Runs the given task in the current process """
     try:
         task = Registry.TASKS.dispatch(command)
     except:
         pyflaglog.log(pyflaglog.DEBUG, "Dont know how to process job %s" % command)
         return
     
+    take_bytes_scanned()
+    start = time.time()
     try:
         task = task()
         task.run(cookie=cookie, **argdict)
@@ -105,15 +355,464 @@ def run_task(command, argdict, cookie):
         #pdb.post_mortem(t = sys.exc_info()[2])
         pyflaglog.log(pyflaglog.ERRORS, "Error %s %s %s" % (task.__class__.__name__,argdict,e))
 
-    ## Decrement the cookie in the jobs_tdb
-    job_tdb.lock()
+    record_job(command, 1, time.time() - start)
+
+    ## Decrement the cookie
+    get_job_queue().jobs_done([cookie], take_bytes_scanned())
+
+def run_tasks(command, jobs):
+    """ Runs a list of (argdict, cookie) jobs of the same command and
+    coalesce key in the current process.
+    """
+    if len(jobs) == 1:
+        argdict, cookie = jobs[0]
+        return run_task(command, argdict, cookie)
+
     try:
-        count = int(job_tdb.get("%s" % cookie)) - 1
-        job_tdb.store(str(cookie), str(count))
-    except (KeyError, TypeError):
-        job_tdb.store(str(cookie), str(0))
-        
-    job_tdb.unlock()
+        task = Registry.TASKS.dispatch(command)
+    except:
+        pyflaglog.log(pyflaglog.DEBUG, "Dont know how to process job %s" % command)
+        return
+
+    take_bytes_scanned()
+    start = time.time()
+    try:
+        task = task()
+        task.run_many(jobs)
+    except Exception,e:
+        pyflaglog.log(pyflaglog.ERRORS, "Error %s (%s jobs) %s" % (task.__class__.__name__,
+                                                                len(jobs), e))
+
+    record_job(command, len(jobs), time.time() - start)
+
+    get_job_queue().jobs_done([ cookie for argdict, cookie in jobs ],
+                              take_bytes_scanned())
+
+def get_coalesce_key(command, argdict, cookie):
+    try:
+        task = Registry.TASKS.dispatch(command)
+    except:
+        return None
+
+    return task().coalesce_key(argdict, cookie)
+
+def run_jobs(jobs):
+    """ Runs a list of (command, argdict, cookie) jobs.
+
+    Jobs with the same coalesce key are run together.
+    """
+    groups = {}
+    order = []
+    for command, argdict, cookie in jobs:
+        key = get_coalesce_key(command, argdict, cookie)
+        if key is None:
+            order.append((command, [(argdict, cookie)]))
+            continue
+
+        try:
+            groups[(command, key)].append((argdict, cookie))
+        except KeyError:
+            group = groups[(command, key)] = [(argdict, cookie)]
+            order.append((command, group))
+
+    for command, group in order:
+        run_tasks(command, group)
+
+def ring_doorbell():
+    """ Wakes up a sleeping worker.
+
+    This writes a single byte to the FIFO. If the FIFO is full there
+    are plenty of wakeups pending already so we just ignore it.
+    """
+    global job_pipe
+
+    if not job_pipe:
+        try:
+            job_pipe = os.open(config.FIFO, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+
+    try:
+        os.write(job_pipe, '\x00')
+    except OSError:
+        pass
+
+class JobQueue:
+    """ Base class for job queues.
+
+    Posters call add_job() and post() for each job. Workers wait for
+    the fd returned by open_worker() to become readable (or for poll
+    seconds) and then call service() to run jobs.
+    """
+    ## Workers block until jobs arrive
+    poll = None
+
+    def fits(self, command, argdict, cookie):
+        """ Can the queue carry this job? """
+        return True
+
+    def pending(self):
+        """ Returns the number of jobs waiting to be run """
+        return 0
+
+    def add_job(self, cookie):
+        """ Called for each job posted with the cookie """
+        increment_cookie(cookie)
+
+    def jobs_done(self, cookies, bytes=0):
+        """ Called when jobs with these cookies are finished. bytes is
+        the amount of data they scanned.
+        """
+        decrement_cookies(cookies, bytes)
+
+    def open_worker(self):
+        """ Prepares this process to service the queue. Returns an fd
+        which becomes readable when jobs may be available.
+        """
+        global job_pipe
+
+        ## Open the pipes
+        try:
+            os.mkfifo(config.FIFO)
+        except OSError,e:
+            pass
+
+        self.read_pipe = os.open(config.FIFO, os.O_RDONLY | os.O_NONBLOCK) 
+        job_pipe = os.open(config.FIFO, os.O_WRONLY | os.O_NONBLOCK)
+
+        return self.read_pipe
+
+    def service(self, readable):
+        """ Runs the next jobs if available.
+
+        Returns True if there may be more jobs immediately available.
+        """
+        return False
+
+    def recover(self, pid=None):
+        """ Returns jobs held by dead workers to the queue """
+
+class FIFOQueue(JobQueue):
+    """ Distributes jobs as fixed size packets written to the FIFO.
+
+    Workers read jobs directly from the FIFO. This queue does not
+    support priorities and does not persist jobs.
+    """
+    def fits(self, command, argdict, cookie):
+        """ Can this job be written in a single packet? """
+        return len(pickle.dumps((command, argdict, cookie))) <= PACKET_SIZE
+
+    def pending(self):
+        """ Returns the number of jobs waiting in the FIFO """
+        try:
+            fd = os.open(config.FIFO, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return 0
+
+        try:
+            data = fcntl.ioctl(fd, termios.FIONREAD, "\x00" * 4)
+            return struct.unpack("i", data)[0] / PACKET_SIZE
+        finally:
+            os.close(fd)
+
+    def post(self, command, argdict, cookie, priority):
+        global job_pipe
+
+        if not job_pipe:
+            try:
+                job_pipe = os.open(config.FIFO, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                pass
+
+        fds = []
+        if job_pipe:
+            fds.append(job_pipe)
+
+        ## Now we see if we can actually write to the jobs fifo:
+        fds = select.select([], fds, [], 0)
+        if job_pipe in fds[1]:
+            ## We can write to the fifo - dispatch the job for someone else
+            data = pickle.dumps((command, argdict, cookie))
+            if len(data) > PACKET_SIZE:
+                print "Error: data is larger than packet size... "
+                os._exit(1)
+
+            try:
+                res = os.write(job_pipe, data + '\x00' * (PACKET_SIZE - len(data)))
+            except OSError:
+                ## Cant write to this pipe - try again next time
+                os.close(job_pipe)
+                job_pipe = None
+                run_task(command, argdict, cookie)            
+
+        else:
+            ## No we can not write it now - we should just do the job
+            ## ourselves
+            run_task(command, argdict, cookie)
+
+    def service(self, readable):
+        if not readable: return False
+
+        ## Read as many jobs as we may coalesce
+        jobs = []
+        while len(jobs) < max(config.JOB_COALESCE, 1):
+            try:
+                data = os.read(self.read_pipe, PACKET_SIZE)
+            except OSError:
+                break
+
+            if not data: break
+            jobs.append(pickle.loads(data))
+
+        run_jobs(jobs)
+
+        return False
+
+class DBQueue(JobQueue):
+    """ Stores jobs persistently in the jobs table of the pyflag db.
+
+    Jobs are pickled into the payload column so they may be of any
+    size. Workers take the highest priority pending job, mark it as
+    processing under their pid and remove it once it is done. If a
+    worker dies its jobs are returned to the pending state so another
+    worker can run them.
+    """
+    ## Number of posts between checking the size of the queue
+    CHECK_INTERVAL = 100
+
+    def __init__(self):
+        self.pid = None
+        self._dbh = None
+        self.posted = 0
+        self.poll = config.JOB_QUEUE_POLL
+
+    def pending(self):
+        ## We may be called from the nanny thread - so we use our own
+        ## handle
+        dbh = DB.DBO()
+        dbh.execute("select count(*) as count from jobs where state='pending' "
+                    "and not isnull(payload)")
+        return dbh.fetch()['count']
+
+    def dbh(self):
+        ## Database handles must not be shared across a fork
+        if self.pid != os.getpid():
+            self._dbh = DB.DBO()
+            self.pid = os.getpid()
+
+        return self._dbh
+
+    def wait_for_space(self):
+        """ Blocks until the queue has room for more jobs.
+
+        Workers never block here because if all the workers are
+        waiting for space nobody will ever service the queue - they
+        may exceed the limit instead.
+        """
+        self.posted += 1
+        if worker_pid == os.getpid() or self.posted % self.CHECK_INTERVAL != 1:
+            return
+
+        dbh = self.dbh()
+        while 1:
+            dbh.execute("select count(*) as count from jobs where state='pending' "
+                        "and not isnull(payload)")
+            count = dbh.fetch()['count']
+            if count < config.JOB_QUEUE_LIMIT:
+                break
+
+            pyflaglog.log(pyflaglog.DEBUG, "Job queue has %s outstanding jobs - waiting for workers" % count)
+            ring_doorbell()
+            time.sleep(1)
+
+    def post(self, command, argdict, cookie, priority):
+        self.wait_for_space()
+
+        dbh = self.dbh()
+        dbh.insert('jobs', command = command,
+                   arg1 = argdict.get('case') or '',
+                   arg3 = get_coalesce_key(command, argdict, cookie) or '',
+                   cookie = int(cookie), priority = priority,
+                   state = 'pending',
+                   __payload = pickle.dumps((command, argdict, cookie),
+                                            pickle.HIGHEST_PROTOCOL),
+                   _fast = True)
+        ring_doorbell()
+
+    def get(self, limit=1):
+        """ Takes the next job from the queue, as well as up to limit
+        pending jobs which may be coalesced with it.
+
+        Returns a list of (id, command, argdict, cookie), which is
+        empty if the queue is empty.
+        """
+        dbh = self.dbh()
+        dbh.execute("lock tables jobs write")
+        try:
+            ## Rows without a payload were written directly to the
+            ## table by old code - we can not run them.
+            dbh.execute("select id, command, arg3, payload from jobs where state='pending' "
+                        "and not isnull(payload) order by priority desc, id limit 1")
+            row = dbh.fetch()
+            if not row: return []
+
+            rows = [ row ]
+            if row['arg3'] and limit > 1:
+                dbh.execute("select id, command, arg3, payload from jobs where state='pending' "
+                            "and not isnull(payload) and command=%r and arg3=%r and id!=%r "
+                            "order by id limit %s",
+                            (row['command'], row['arg3'], row['id'], limit - 1))
+                rows.extend(dbh)
+
+            dbh.execute("update jobs set state='processing', pid=%r where id in (%s)",
+                        (os.getpid(), ",".join([ str(r['id']) for r in rows ])))
+        finally:
+            dbh.execute("unlock tables")
+
+        result = []
+        bad = []
+        for row in rows:
+            try:
+                command, argdict, cookie = pickle.loads(row['payload'])
+            except Exception,e:
+                pyflaglog.log(pyflaglog.ERRORS, "Dropping job %s (%s): Unable to unpickle: %s" % (
+                    row['id'], row['command'], e))
+                bad.append(row['id'])
+                continue
+
+            result.append((row['id'], command, argdict, cookie))
+
+        if bad:
+            self.done(bad)
+
+        return result
+
+    def done(self, ids):
+        self.dbh().execute("delete from jobs where id in (%s)",
+                           ",".join([ str(id) for id in ids ]))
+
+    def service(self, readable):
+        ## Drain the doorbell - the jobs themselves are in the db
+        if readable:
+            try:
+                os.read(self.read_pipe, PACKET_SIZE)
+            except OSError:
+                pass
+
+        jobs = self.get(config.JOB_COALESCE)
+        if not jobs: return False
+
+        run_jobs([ (command, argdict, cookie) for id, command, argdict, cookie in jobs ])
+        self.done([ job[0] for job in jobs ])
+
+        return True
+
+    def recover(self, pid=None):
+        """ Returns jobs held by dead workers to the queue.
+
+        If pid is not specified we check all the workers holding jobs.
+        """
+        ## We may be called from a signal handler while our own handle
+        ## is in use.
+        dbh = DB.DBO()
+        if pid:
+            pids = [ pid ]
+        else:
+            dbh.execute("select distinct pid from jobs where state='processing'")
+            pids = [ row['pid'] for row in dbh ]
+
+        for pid in pids:
+            try:
+                if pid: os.kill(pid, 0)
+                continue
+            except OSError:
+                pass
+
+            dbh.execute("update jobs set state='pending', pid=0 where "
+                        "state='processing' and pid=%r", pid)
+            pyflaglog.log(pyflaglog.INFO, "Requeued jobs of dead worker %s" % pid)
+
+class BrokerQueue(JobQueue):
+    """ Distributes jobs through a job broker over TCP (see
+    pyflag.Broker).
+
+    This allows workers on many hosts to service the same queue. The
+    broker keeps the cookie counts on its own host, so posting and
+    completing jobs is reported to the broker rather than counted
+    locally.
+    """
+    def __init__(self):
+        self.pid = None
+        self.connection = None
+        ## Bytes scanned by the jobs we have not reported done yet
+        self.bytes_scanned = 0
+
+    def get_connection(self):
+        ## Connections must not be shared across a fork
+        if self.pid != os.getpid():
+            import pyflag.Broker as Broker
+
+            self.connection = Broker.connect()
+            self.pid = os.getpid()
+
+        return self.connection
+
+    def add_job(self, cookie):
+        ## The broker counts the job when it is posted
+        pass
+
+    def jobs_done(self, cookies, bytes=0):
+        ## The broker counts the jobs when we report them done
+        self.bytes_scanned += bytes
+
+    def post(self, command, argdict, cookie, priority):
+        self.get_connection().send(('post', command, argdict, cookie, priority))
+
+    def pending(self):
+        return self.get_connection().request(('pending',))
+
+    def open_worker(self):
+        connection = self.get_connection()
+
+        ## Ask for our first jobs
+        connection.send(('get', max(config.JOB_COALESCE, 1)))
+
+        return connection.fileno()
+
+    def service(self, readable):
+        if not readable: return False
+
+        connection = self.get_connection()
+        message = connection.receive()
+        if not message:
+            pyflaglog.log(pyflaglog.WARNING, "Lost connection to broker. Exiting")
+            exit_worker()
+
+        jobs = message[1]
+        run_jobs([ (command, argdict, cookie) for id, command, argdict, cookie in jobs ])
+
+        connection.send(('done', [ job[0] for job in jobs ], self.bytes_scanned))
+        self.bytes_scanned = 0
+        connection.send(('get', max(config.JOB_COALESCE, 1)))
+
+        return False
+
+JOB_QUEUES = dict(fifo = FIFOQueue, db = DBQueue, broker = BrokerQueue)
+job_queue = None
+
+## The pid of the worker process (if we are a worker)
+worker_pid = None
+
+def get_job_queue():
+    global job_queue
+
+    if not job_queue:
+        try:
+            job_queue = JOB_QUEUES[config.JOB_QUEUE]()
+        except KeyError:
+            raise RuntimeError("Unknown job queue %s" % config.JOB_QUEUE)
+
+    return job_queue
 
 def worker_run(keepalive=None):
      """ The main loop of the worker.
@@ -126,51 +825,100 @@ def worker_run(keepalive=None):
      """
      FlagFramework.post_event("worker_startup")            
      my_pid = os.getpid()
-     
-     ## Open the pipes
-     try:
-         os.mkfifo(config.FIFO)
-     except OSError,e:
-         pass
 
-     global job_pipe
-     
-     read_pipe = os.open(config.FIFO, os.O_RDONLY | os.O_NONBLOCK) 
-     job_pipe = os.open(config.FIFO, os.O_WRONLY | os.O_NONBLOCK)
+     global worker_pid, worker_stats
+     worker_pid = my_pid
+     worker_stats = WorkerStats()
+
+     ## The nanny asks us to retire with SIGUSR1. We finish the
+     ## current job first.
+     retire = []
+     signal.signal(signal.SIGUSR1, lambda signum, frame: retire.append(signum))
 
-     count = 0
+     import pyflag.Cookies as Cookies
+
+     queue = get_job_queue()
+     read_pipe = queue.open_worker()
+     busy = False
      while 1:
-         count += 1
-         if (count % 100) == 0:
-             ## Check our memory footprint
-             check_mem()
-             count = 0
+         ## Check our memory footprint
+         check_mem()
+
+         if retire:
+             pyflaglog.log(pyflaglog.INFO, "Worker %s retiring" % my_pid)
+             exit_worker()
 
          fds = [read_pipe]
          if keepalive:
              fds.append(keepalive)
-         
-         ## This blocks until a job is available
-         fds = select.select(fds, [], [], None)
+
+         ## This blocks until a job is available (or until the queue
+         ## needs to be polled)
+         if busy:
+             timeout = 0
+         else:
+             timeout = queue.poll
+
+         ## Job counts we could not send must reach the cookie server
+         ## even if no more jobs come our way
+         if not Cookies.flush() and timeout is None:
+             timeout = Cookies.RETRY_PERIOD
+
+         try:
+             fds = select.select(fds, [], [], timeout)
+         except select.error, e:
+             if e[0] == errno.EINTR: continue
+             raise
+
          if keepalive in fds[0]:
              ## Action on the keepalive fd means the parent quit
              print "Child %s exiting" % os.getpid()
-             os._exit(0)
-             
-         elif read_pipe in fds[0]:
-             try:
-                 data = os.read(read_pipe, PACKET_SIZE)
-                 command, argdict, cookie = pickle.loads(data)
-                 run_task(command, argdict, cookie)
-             except OSError:
-                 pass
+             exit_worker()
+
+         busy = queue.service(read_pipe in fds[0])
+
+## The pids of our workers, and those we asked to retire. These are
+## only changed in the main thread (by start_workers and the signal
+## handlers).
+children = set()
+retiring = set()
+
+## What the nanny asked for: 1 to start a worker, -1 to retire one
+nanny_requests = []
+
+def spawn_worker():
+    """ Forks a new worker """
+    pid = os.fork()
+    if pid:
+        children.add(pid)
+        return pid
+
+    ## child
+    os.close(write_keepalive)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    
+    ## Initialise the worker
+    worker_run(keepalive)
+    sys.exit(0)
+
+def retire_worker():
+    """ Asks one of the workers to exit once it finishes its job """
+    candidates = children - retiring
+    if not candidates: return
+
+    pid = max(candidates)
+    retiring.add(pid)
+    pyflaglog.log(pyflaglog.INFO, "Retiring worker %s" % pid)
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except OSError:
+        pass
 
 def start_workers():
     print "%s: starting workers" % os.getpid()
     global job_pipe, keepalive, write_keepalive
 
-    children = []
-
     ## These pipes control the worker. If the master exits, the pipes
     ## will be closed which will notify the worker immediately. It
     ## will then exit.
@@ -178,18 +926,30 @@ def start_workers():
     if not keepalive:
         keepalive, write_keepalive = os.pipe()
 
-    ## Start up as many children as needed
-    for i in range(config.WORKERS):
-        pid = os.fork()
-        if pid:
-            children.append(pid)
+    ## Any jobs left over by workers which died before we started are
+    ## returned to the queue.
+    queue = get_job_queue()
+    queue.recover()
 
-        else:
-            os.close(write_keepalive)
+    ## The cookie server counts the outstanding jobs
+    import pyflag.Cookies as Cookies
 
-            ## Initialise the worker
-            worker_run(keepalive)
-            sys.exit(0)
+    if Cookies.enabled():
+        Cookies.start_server(keepalive, write_keepalive)
+
+    ## Remote workers need the broker to outlive us
+    if isinstance(queue, BrokerQueue):
+        import pyflag.Broker as Broker
+
+        if not config.NO_BROKER:
+            Broker.start_broker(keepalive, write_keepalive)
+
+    ## Anything loaded now is shared with the workers
+    FlagFramework.post_event("prefork")
+
+    ## Start up as many children as needed
+    for i in range(config.WORKERS):
+        spawn_worker()
             
     ## The process which called this function is a master
     FlagFramework.post_event("startup")
@@ -198,83 +958,192 @@ def start_workers():
     ## if the child quits, we restart it.
     signal.signal(signal.SIGCHLD, handler)
 
+    if config.MAX_WORKERS > config.WORKERS:
+        signal.signal(signal.SIGUSR2, nanny_handler)
+        t = threading.Thread(target=nanny)
+        t.setDaemon(True)
+        t.start()
+
 def handler(signal, frame):
     try:
         pid, status = os.waitpid(-1, 0)
     except:
         return
+
+    ## This is not one of our workers
+    if pid not in children: return
+    children.discard(pid)
+
+    ## Give the dead child's jobs to someone else
+    try:
+        get_job_queue().recover(pid)
+    except Exception,e:
+        pyflaglog.log(pyflaglog.ERRORS, "Unable to recover jobs from %s: %s" % (pid, e))
+
+    if pid in retiring:
+        retiring.discard(pid)
+        return
     
     print "Child %s Died - starting" % pid
     global keepalive, write_keepalive
-    
+
     if not keepalive:
         keepalive, write_keepalive = os.pipe()
-    
-    pid = os.fork()
-    if not pid:
-        os.close(write_keepalive)
-        
-        ## child
-        FlagFramework.post_event("worker_startup")
-        worker_run(keepalive)
-        sys.exit(0)
-    
+
+    spawn_worker()
+
+def cpu_times():
+    """ Returns the total and idle cpu time of the system """
+    fields = [ int(x) for x in open("/proc/stat").readline().split()[1:] ]
+    ## idle and iowait
+    return sum(fields), sum(fields[3:5])
+
+def free_memory():
+    """ Returns the memory available for new processes in Mb """
+    meminfo = {}
+    for line in open("/proc/meminfo"):
+        name, value = line.split(":", 1)
+        meminfo[name] = int(value.split()[0])
+
+    try:
+        free = meminfo['MemAvailable']
+    except KeyError:
+        free = meminfo['MemFree'] + meminfo.get('Buffers',0) + meminfo.get('Cached',0)
+
+    return free / 1024
+
+def nanny_handler(signum, frame):
+    """ Starts or retires the workers the nanny asked for.
+
+    The nanny runs in a thread of the master, which must not fork. It
+    signals us instead, and Python runs signal handlers in the main
+    thread.
+    """
+    while nanny_requests:
+        if nanny_requests.pop(0) > 0:
+            spawn_worker()
+        else:
+            retire_worker()
+
+def ask_master(change):
+    """ Asks the main thread to start (1) or retire (-1) a worker """
+    nanny_requests.append(change)
+    os.kill(os.getpid(), signal.SIGUSR2)
+
+def nanny():
+    """ Grows and shrinks the number of workers between WORKERS and
+    MAX_WORKERS depending on the backlog of jobs and the resources
+    available.
+
+    We only decide what to do - the main thread does it (see
+    nanny_handler).
+    """
+    queue = get_job_queue()
+    last_total, last_idle = cpu_times()
+
+    while 1:
+        time.sleep(config.WORKER_SCALE_PERIOD)
+
+        try:
+            total, idle = cpu_times()
+            cpu = 100 - 100 * (idle - last_idle) / max(total - last_total, 1)
+            last_total, last_idle = total, idle
+
+            pending = queue.pending()
+            free = free_memory()
+        except Exception,e:
+            pyflaglog.log(pyflaglog.WARNING, "Nanny unable to check resources: %s" % e)
+            continue
+
+        ## Only the main thread changes these, and the difference is
+        ## taken in one step
+        workers = len(children - retiring)
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Nanny: %s workers, %s pending jobs, "
+                      "cpu %s%%, %sMb free" % (workers, pending, cpu, free))
+
+        if pending > workers and cpu < config.WORKER_CPU_THRESHOLD and \
+               free > config.MINIMUM_FREE_MEMORY and workers < config.MAX_WORKERS:
+            pyflaglog.log(pyflaglog.INFO, "Starting extra worker for %s pending jobs" % pending)
+            ask_master(1)
+
+        elif (pending == 0 or free < config.MINIMUM_FREE_MEMORY) and \
+                 workers > config.WORKERS:
+            ask_master(-1)
+
 def get_job_tdb():
     if not FlagFramework.job_tdb:
         FlagFramework.job_tdb = pytdb.PyTDB("%s/jobs.tdb" % config.RESULTDIR)
 
     return FlagFramework.job_tdb
 
-def post_job(command, argdict={}, cookie=0):
-    global job_pipe
+def set_cookie_priority(cookie, priority):
+    """ Sets the priority of all jobs subsequently posted with this
+    cookie. Jobs with higher priorities are serviced first (This is
+    only supported by the db job queue).
+    """
+    job_tdb = get_job_tdb()
+    job_tdb.store("priority:%s" % cookie, str(priority))
 
-    if not job_pipe:
+def post_job(command, argdict={}, cookie=0, priority=None):
+    ## The job may refer to VFS nodes we just created - make sure
+    ## they are in the database first.
+    import pyflag.FileSystem as FileSystem
+    FileSystem.flush_vfs_writers()
+
+    queue = get_job_queue()
+
+    ## We increment the count of the cookie (in the job_tdb):
+    queue.add_job(cookie)
+
+    if priority is None:
         try:
-            job_pipe = os.open(config.FIFO, os.O_WRONLY | os.O_NONBLOCK)
-        except OSError:
-            pass
+            priority = int(get_job_tdb().get("priority:%s" % cookie))
+        except (KeyError, TypeError, ValueError):
+            priority = DEFAULT_PRIORITY
 
-    job_tdb = get_job_tdb()
-    
-    ## Serialise the command for transmission across the pipe. We
-    ## increment the count of the cookie in the job_tdb:
-    job_tdb.lock()
-    try:
-        count = int(job_tdb.get(str(cookie))) + 1
-        job_tdb.store(str(cookie), str(count))
-    except (KeyError, TypeError):
-        job_tdb.store(str(cookie), str(1))
+    queue.post(command, argdict, cookie, priority)
 
-    job_tdb.unlock()
+def post_batch(command, argdict, key, values, cookie=0, priority=None):
+    """ Posts jobs to run command over all the values.
 
-    fds = []
-    if job_pipe:
-        fds.append(job_pipe)
+    The values are split into batches of at most JOB_BATCH_SIZE and
+    each batch is passed to the task in argdict[key]. Each batch
+    counts as a single job for the cookie.
+    """
+    queue = get_job_queue()
 
-    ## Now we see if we can actually write to the jobs fifo:
-    fds = select.select([], fds, [], 0)
-    if job_pipe in fds[1]:
-        ## We can write to the fifo - dispatch the job for someone else
-        data = pickle.dumps((command, argdict, cookie))
-        if len(data) > PACKET_SIZE:
-            print "Error: data is larger than packet size... "
-            os._exit(1)
+    def post(batch):
+        args = argdict.copy()
+        args[key] = batch
 
-        try:
-            res = os.write(job_pipe, data + '\x00' * (PACKET_SIZE - len(data)))
-        except OSError:
-            ## Cant write to this pipe - try again next time
-            os.close(job_pipe)
-            job_pipe = None
-            run_task(command, argdict, cookie)            
-        
-    else:
-        ## No we can not write it now - we should just do the job
-        ## ourselves
-        run_task(command, argdict, cookie)
-        
+        ## Some queues limit the size of jobs - split the batch until
+        ## it fits.
+        if len(batch) > 1 and not queue.fits(command, args, cookie):
+            middle = len(batch) / 2
+            post(batch[:middle])
+            post(batch[middle:])
+        else:
+            post_job(command, args, cookie, priority)
+
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) >= config.JOB_BATCH_SIZE:
+            post(batch)
+            batch = []
+
+    if batch:
+        post(batch)
 
 def get_cookie_reference(cookie):
+    """ Returns the number of outstanding jobs of the cookie. Use
+    Cookies.wait() to wait for them rather than polling this.
+    """
+    import pyflag.Cookies as Cookies
+
+    if Cookies.enabled():
+        return Cookies.get_status(cookie)['outstanding']
+
     job_tdb = get_job_tdb()
     cookie = str(cookie)
     
@@ -55,7 +55,7 @@ import pyflag.FlagFramework as FlagFramework
 from pyflag.FlagFramework import normpath
 import pyflag.Registry as Registry
 import pyflag.pyflaglog as pyflaglog
-import time,re
+import time,re,thread
 import math
 import bisect
 import zipfile
@@ -67,6 +67,32 @@ import pyaff4
 
 oracle = pyaff4.Resolver()
 
+config.add_option("HANDLE_CACHE_SIZE", default=50, type='int',
+                  help="Number of idle AFF4 stream handles to keep open "
+                  "for reuse")
+
+config.add_option("HANDLE_CACHE_MEMORY", default=64, type='int',
+                  help="Maximum memory (in MB) which idle AFF4 stream "
+                  "handles may hold")
+
+def handle_size(fd):
+    """ An estimate of the memory held by an open stream - streams
+    buffer at most about a megabyte of their data.
+    """
+    try:
+        return min(fd.size.value, 1024 * 1024)
+    except AttributeError:
+        return 0
+
+## Open AFF4 streams are expensive to create - we keep idle handles
+## here keyed by urn so opening the same stream again (e.g. the
+## parent image of each zip member) reuses them.
+AFF4_HANDLES = Store.HandleCache("AFF4 streams",
+                                 max_handles = config.HANDLE_CACHE_SIZE,
+                                 max_bytes = config.HANDLE_CACHE_MEMORY * 1024 * 1024,
+                                 kill_cb = lambda fd: fd.cache_return(),
+                                 sizeof = handle_size)
+
 class File:
     """ This is a proxy object to the underlying AFF4 stream object.
     """
@@ -103,10 +129,6 @@ class File:
             if not self.urn:
                 raise IOError("Unable to find urn for inode_id %s" % inode_id)
 
-        self.fd = oracle.open(self.urn, 'r')
-        if not self.fd:
-            raise IOError("URN %s not found" % self.urn.value)
-
         self.size = self.fd.size.value
 
         # should reads return slack space or overread into the next block? 
@@ -114,8 +136,29 @@ class File:
         self.slack = False
         self.overread = False
 
+    def __getattr__(self, attr):
+        ## The stream handle is checked out of the handle cache when
+        ## first needed, and again if it was returned by close().
+        if attr != 'fd' or 'urn' not in self.__dict__:
+            raise AttributeError(attr)
+
+        fd = AFF4_HANDLES.get(self.urn.value,
+                              lambda : oracle.open(self.urn, 'r'))
+        if not fd:
+            raise IOError("URN %s not found" % self.urn.value)
+
+        fd.seek(self.__dict__.get('_offset', 0))
+        self.fd = fd
+        return fd
+
     def close(self):
-        pass
+        """ Returns the stream handle to the cache for reuse. The File
+        may still be used after this.
+        """
+        fd = self.__dict__.pop('fd', None)
+        if fd:
+            self._offset = fd.readptr
+            AFF4_HANDLES.put(self.urn.value, fd)
 
     def __getitem__(self, item):
         return oracle.resolve(self.urn, item)
@@ -856,6 +899,247 @@ class FileSystem:
 #         """ standards compliant listdir, generates directory entries. """
 #         return self.ls(path)
 
+def path_ancestors(path):
+    """ Returns the directories containing path, starting with path
+    itself and ending with the root.
+    """
+    path = FlagFramework.normpath(path)
+    if len(path) > 1:
+        path = path.rstrip("/")
+
+    result = [path]
+    while path != '/':
+        path = posixpath.dirname(path)
+        result.append(path)
+
+    return result
+
+def tree_rows(path):
+    """ Returns the rows of the vfs_tree table for the directory path.
+
+    vfs_tree is a closure table - it relates every directory to each
+    of its ancestors (and itself) along with how deep below the
+    ancestor it is. This means everything under a directory can be
+    found with a single indexed query.
+    """
+    return [ dict(ancestor = ancestor, path = path, depth = depth) for \
+             depth, ancestor in enumerate(path_ancestors(path)) ]
+
+def build_tree_index(case):
+    """ Rebuilds the vfs_tree table of case from the vfs table.
+
+    New directories are added to vfs_tree as they are created (see
+    VFSWriter) so this is only needed for cases made before the
+    table existed.
+    """
+    dbh = DB.DBO(case)
+    directories = set()
+
+    dbh.execute("select distinct path from vfs")
+    for row in dbh:
+        directories.update(path_ancestors(row['path']))
+
+    dbh.execute("select path, name from vfs where type='directory'")
+    for row in dbh:
+        directories.update(path_ancestors("%s/%s" % (row['path'], row['name'])))
+
+    dbh.delete('vfs_tree', where='1', _fast=True)
+    dbh.mass_insert_start('vfs_tree')
+    for path in directories:
+        for row in tree_rows(path):
+            dbh.mass_insert(**row)
+
+    dbh.mass_insert_commit()
+
+def make_directories(dbh, path, status='alloc', known=None):
+    """ Makes sure that all the directories above path exist in the
+    vfs (and vfs_tree) tables.
+
+    known is an optional set of directories which are known to
+    exist. It is updated with those we find or make.
+
+    The directories are inserted straight away (even when the files
+    are batched), and the check and insert are done under a lock so
+    concurrent workers do not both insert the same directory.
+    """
+    lock = "pyflag_vfs_%s" % dbh.case
+    locked = False
+
+    dirs = posixpath.dirname(path).split("/")
+    try:
+        for d in range(len(dirs),0,-1):
+            new_path = FlagFramework.normpath("/".join(dirs[:d]))
+            if known is not None and new_path in known: break
+
+            if not locked:
+                dbh.execute("select get_lock(%r, 60)", lock)
+                dbh.fetch()
+                locked = True
+
+            dirname = posixpath.dirname(new_path)
+            basename = posixpath.basename(new_path)
+            dbh.execute("select * from vfs where path=%r and "
+                        "name=%r and type='directory' limit 1",(dirname,basename))
+            found = dbh.fetch()
+            if not found:
+                dbh.insert("vfs",
+                           status=status,
+                           type = 'directory',
+                           path = dirname,
+                           name = basename)
+
+                tree_dbh = DB.DBO(dbh.case)
+                tree_dbh.mass_insert_start('vfs_tree')
+                for row in tree_rows(new_path):
+                    tree_dbh.mass_insert(**row)
+                tree_dbh.mass_insert_commit()
+
+            if known is not None:
+                known.add(new_path)
+
+            if found: break
+    finally:
+        if locked:
+            dbh.execute("select release_lock(%r)", lock)
+            dbh.fetch()
+
+def node_properties(urn, path, inode_id=None, size=0, status='alloc'):
+    """ Returns the vfs row of a new file node for the AFF4 urn """
+    if urn:
+        inode_id = oracle.get_id_by_urn(urn)
+
+    if not inode_id: raise RuntimeError("No inode_id found for the urn %s" % urn)
+
+    inode_properties = dict(status=status,
+                            mode= 040755,
+                            inode_id = inode_id,
+                            type='file',
+                            size = size,
+                            path = FlagFramework.normpath(posixpath.dirname(path)),
+                            name = posixpath.basename(path))
+
+    if urn:
+        xsddatetime = pyaff4.XSDDatetime()
+        integer = pyaff4.XSDInteger()
+
+        if oracle.resolve_value(urn, pyaff4.AFF4_SIZE, integer):
+            inode_properties['size'] = integer.value
+
+        if oracle.resolve_value(urn, pyaff4.AFF4_UNIX_PERMS, integer):
+            inode_properties['mode'] = integer.value
+
+        if oracle.resolve_value(urn, pyaff4.AFF4_MTIME, xsddatetime):
+            inode_properties['mtime'] = xsddatetime.serialised
+
+        if oracle.resolve_value(urn, pyaff4.AFF4_ATIME, xsddatetime):
+            inode_properties['atime'] = xsddatetime.serialised
+
+        if oracle.resolve_value(urn, pyaff4.AFF4_CTIME, xsddatetime):
+            inode_properties['ctime'] = xsddatetime.serialised
+
+    return inode_properties
+
+## The directories known to exist in the VFS of each case. This is
+## keyed by case and holds the creation time of the vfs table (so we
+## notice if the case is recreated) and the set of directory paths.
+DIRECTORY_CACHE = {}
+
+class VFSWriter:
+    """ Creates many VFS nodes efficiently.
+
+    The new file nodes are inserted with mass_insert, and the
+    directories which are known to exist in each case are cached so we
+    do not need to look for them again. The file nodes are not visible
+    in the vfs table until flush() is called - new directories are
+    inserted immediately (see make_directories()).
+
+    Usually there is no need to use this directly - while a writer is
+    open for the case (see open_vfs_writer()) DBFS.VFSCreate adds to
+    it.
+    """
+    def __init__(self, case):
+        self.case = case
+        self.dbh = DB.DBO(case)
+        self.dbh.mass_insert_start('vfs')
+        self.directories = self.get_directory_cache()
+
+        ## The number of times we have been opened
+        self.users = 0
+
+    def get_directory_cache(self):
+        self.dbh.execute("select create_time from information_schema.tables "
+                         "where table_schema = database() and table_name='vfs' limit 1")
+        row = self.dbh.fetch()
+        created = row and row['create_time']
+
+        try:
+            cached, directories = DIRECTORY_CACHE[self.case]
+            if cached == created:
+                return directories
+        except KeyError:
+            pass
+
+        directories = set()
+        DIRECTORY_CACHE[self.case] = (created, directories)
+
+        return directories
+
+    def create(self, urn, path, directory=False, inode_id=None, size=0,
+               status='alloc', timestamp=0, **properties):
+        """ Adds a new node for the AFF4 urn provided (see DBFS.VFSCreate) """
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
+                      DB.expand("Creating new VFS node %s", (urn)))
+
+        ## Make sure that all intermediate dirs exist:
+        make_directories(self.dbh, posixpath.normpath(path), status,
+                         self.directories)
+
+        if directory: return
+
+        inode_properties = node_properties(urn, path, inode_id, size, status)
+        self.dbh.mass_insert(**inode_properties)
+        return inode_properties['inode_id']
+
+    def flush(self):
+        """ Inserts the pending nodes """
+        self.dbh.mass_insert_commit()
+
+## The open VFS writers by case and thread
+VFS_WRITERS = {}
+
+def open_vfs_writer(case):
+    """ Opens a VFS writer for case in the current thread. Nodes
+    created by DBFS.VFSCreate are batched until close_vfs_writer() is
+    called. Calls may be nested.
+    """
+    key = (case, thread.get_ident())
+    try:
+        writer = VFS_WRITERS[key]
+    except KeyError:
+        writer = VFS_WRITERS[key] = VFSWriter(case)
+
+    writer.users += 1
+    return writer
+
+def close_vfs_writer(case):
+    """ Closes the VFS writer opened by open_vfs_writer() """
+    key = (case, thread.get_ident())
+    writer = VFS_WRITERS[key]
+    writer.users -= 1
+    if writer.users <= 0:
+        del VFS_WRITERS[key]
+
+    writer.flush()
+
+def flush_vfs_writers(case=None):
+    """ Flushes the VFS writers open in the current thread (only those
+    of case if specified) so their nodes are visible to others.
+    """
+    ident = thread.get_ident()
+    for (writer_case, writer_ident), writer in VFS_WRITERS.items():
+        if writer_ident == ident and case in (None, writer_case):
+            writer.flush()
+
 class DBFS(FileSystem):
     """ A FileSystem using AFF4 as the arena for the VFS """
     def __init__(self, case, query=None):
@@ -882,6 +1166,7 @@ class DBFS(FileSystem):
                    value = mount_point)
 
     def lookup(self, path=None, inode=None, inode_id=None):
+        flush_vfs_writers(self.case)
         dbh=DB.DBO(self.case)
         if path:
             dir,name = posixpath.split(path)
@@ -920,81 +1205,35 @@ class DBFS(FileSystem):
                   **properties):
         """ Creates a new Inode in the VFS from AFF4 urn provided.
 
-        The URN must already exist.
+        The URN must already exist. If a VFS writer is open for the
+        case (see open_vfs_writer()) the new node is only inserted
+        when it is flushed.
         """
-        #if timestamp and "HTTP" in path:
-        #    pdb.set_trace()
-        ## Basically this is how this function works - if root_inode
-        ## is provided we make the new inode inherit the root inodes
-        ## path and inode string.
+        try:
+            writer = VFS_WRITERS[(self.case, thread.get_ident())]
+        except KeyError:
+            writer = None
+
+        if writer:
+            return writer.create(urn, path, directory=directory, inode_id=inode_id,
+                                 size=size, status=status, timestamp=timestamp,
+                                 **properties)
+
         pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
                       DB.expand("Creating new VFS node %s", (urn)))
 
-        ## Normalise the path:
-        dbh = DB.DBO(self.case)
-        new_filename=posixpath.normpath(path)
-
         ## Make sure that all intermediate dirs exist:
-        dirs = posixpath.dirname(new_filename).split("/")
-        for d in range(len(dirs),0,-1):
-            new_path = FlagFramework.normpath("/".join(dirs[:d]))
-            dirname = posixpath.dirname(new_path)
-            basename = posixpath.basename(new_path)
-            dbh.execute("select * from vfs where path=%r and "
-                        "name=%r and type='directory' limit 1",(dirname,basename))
-            if not dbh.fetch():
-                dbh.insert("vfs",
-                           status=status,
-                           type = 'directory',
-                           path = dirname,
-                           name = basename)
-            else: break
+        dbh = DB.DBO(self.case)
+        make_directories(dbh, posixpath.normpath(path), status)
 
         if directory: return
 
-        if urn:
-            inode_id = oracle.get_id_by_urn(urn)
-
-        if not inode_id: raise RuntimeError("No inode_id found for the urn %s" % urn)
-        xsddatetime = pyaff4.XSDDatetime()
-        integer = pyaff4.XSDInteger()
-
-        inode_properties = dict(status=status,
-                                mode= 040755,
-                                inode_id = inode_id,
-                                type='file',
-                                size = size,
-                                _fast=_fast,
-                                path = FlagFramework.normpath(posixpath.dirname(path)),
-                                name = posixpath.basename(path))
-
-        if oracle.resolve_value(urn, pyaff4.AFF4_SIZE, integer):
-            inode_properties['size'] = integer.value
-
-        if oracle.resolve_value(urn, pyaff4.AFF4_UNIX_PERMS, integer):
-            inode_properties['mode'] = integer.value
-
-        if oracle.resolve_value(urn, pyaff4.AFF4_MTIME, xsddatetime):
-            inode_properties['mtime'] = xsddatetime.serialised
-
-        if oracle.resolve_value(urn, pyaff4.AFF4_ATIME, xsddatetime):
-            inode_properties['atime'] = xsddatetime.serialised
-
-        if oracle.resolve_value(urn, pyaff4.AFF4_CTIME, xsddatetime):
-            inode_properties['ctime'] = xsddatetime.serialised
-
-        ## Is it already present?
-#        dbh.execute("select inode_id from vfs where inode_id = %r", inode_id)
-#        if dbh.fetch():
-#            dbh.update('vfs', where='inode_id = "%s"' % inode_id,
-#                       **inode_properties)
-#        else:
-#            dbh.insert('vfs',**inode_properties)
-
-        dbh.insert('vfs',**inode_properties)
-        return inode_id
+        inode_properties = node_properties(urn, path, inode_id, size, status)
+        dbh.insert('vfs', _fast=_fast, **inode_properties)
+        return inode_properties['inode_id']
 
     def longls(self,path='/', dirs = None):
+        flush_vfs_writers(self.case)
         dbh=DB.DBO(self.case)
         if self.isdir(path):
             ## If we are listing a directory, we list the files inside the directory            
@@ -1019,6 +1258,55 @@ class DBFS(FileSystem):
     def ls(self, path="/", dirs=None):
         return [ "%s" % (dent['name']) for dent in self.longls(path,dirs) ]
 
+    def subtree_sql(self, path):
+        """ Returns a derived table of the directories below path
+        (including path itself) from the vfs_tree index.
+        """
+        return DB.expand("(select distinct path from vfs_tree where ancestor=%r)",
+                         path_ancestors(path)[0])
+
+    def subtree(self, path='/', dirs=None):
+        """ Lists everything below path recursively.
+
+        If dirs is 0 only files are returned, if 1 only directories.
+        """
+        flush_vfs_writers(self.case)
+        dbh=DB.DBO(self.case)
+        where = "vfs.name!=''"
+        if dirs == 1:
+            where += " and isnull(vfs.inode_id) "
+        elif dirs == 0:
+            where += " and not isnull(vfs.inode_id) "
+
+        dbh.execute("select vfs.* from %s as tree join vfs on vfs.path=tree.path "
+                    "where %s group by vfs.inode_id,vfs.path,vfs.name "
+                    "order by vfs.path,vfs.name",
+                    (self.subtree_sql(path), where))
+        return [ dent for dent in dbh ]
+
+    def subtree_stats(self, path='/'):
+        """ Returns the number of files below path and their total size """
+        flush_vfs_writers(self.case)
+        dbh=DB.DBO(self.case)
+        dbh.execute("select count(*) as files, "
+                    "sum(vfs.size) as size from %s as tree join vfs on vfs.path=tree.path "
+                    "where not isnull(vfs.inode_id)", self.subtree_sql(path))
+        row = dbh.fetch()
+        return row['files'], row['size'] or 0
+
+    def subdirs(self, path='/'):
+        """ Returns (name, has_children) for each of the directories
+        in path. This is suitable for expanding trees lazily.
+        """
+        flush_vfs_writers(self.case)
+        dbh=DB.DBO(self.case)
+        dbh.execute("select t.path, count(c.path) as children from vfs_tree as t "
+                    "left join vfs_tree as c on c.ancestor=t.path and c.depth=1 "
+                    "where t.ancestor=%r and t.depth=1 group by t.path order by t.path",
+                    path_ancestors(path)[0])
+
+        return [ (posixpath.basename(row['path']), row['children'] > 0) for row in dbh ]
+
     def istat(self, inode_id):
         urn = oracle.get_urn_by_id(inode_id)
         result = oracle.export_dict(urn)
@@ -1029,6 +1317,7 @@ class DBFS(FileSystem):
         directory=posixpath.normpath(directory)
         if directory=='/': return 1
         
+        flush_vfs_writers(self.case)
         dbh=DB.DBO(self.case)
         dirname=FlagFramework.normpath(posixpath.dirname(directory))
         dbh.execute("select type from vfs where path=%r and name=%r and "
@@ -1153,11 +1442,15 @@ class StringIOFile(File):
     def force_cache(self):
         self.look_for_cached()
 
-def translate(pat):
+def translate(pat, recursive=False):
     """Translate a shell PATTERN to a regular expression.
 
     There is no way to quote meta-characters.
     This is a derivative of fnmatch with some minor modifications.
+
+    * and ? do not match / unless recursive is set (as with
+    fnmatch). ** matches anything including /, and **/ matches any
+    number of directories (including none).
     """
     i, n = 0, len(pat)
     res = ''
@@ -1165,9 +1458,22 @@ def translate(pat):
         c = pat[i]
         i = i+1
         if c == '*':
-            res = res + '[^/]*'
+            if pat[i:i+1] == '*':
+                i = i+1
+                if pat[i:i+1] == '/':
+                    i = i+1
+                    res = res + '(.*/)?'
+                else:
+                    res = res + '.*'
+            elif recursive:
+                res = res + '.*'
+            else:
+                res = res + '[^/]*'
         elif c == '?':
-            res = res + '[^/]'
+            if recursive:
+                res = res + '.'
+            else:
+                res = res + '[^/]'
         elif c == '[':
             j = i
             if j < n and pat[j] == '!':
@@ -1193,21 +1499,78 @@ def translate(pat):
 ## This tells us if the pattern has a glob in it
 globbing_re = re.compile("[*+?\[\]]")
 
+def glob_prefix(pattern):
+    """ Returns the literal prefix of pattern (before any globbing
+    characters).
+    """
+    m = globbing_re.search(pattern)
+    if m:
+        return pattern[:m.start()]
+
+    return pattern
+
+## The upper bound of a prefix range is the prefix (up to its last
+## letter or digit) with that character incremented. Other characters
+## do not sort in the same order in all collations.
+prefix_upper_re = re.compile("^(.*[A-Ya-y0-8])")
+
+def prefix_range(column, prefix):
+    """ Returns an SQL condition selecting the rows where column starts
+    with prefix. This is a range which can use the index on column.
+    """
+    ## Only plain ascii characters sort by their bytes
+    prefix = re.match(r"[\x00-\x7e]*", prefix).group(0)
+    if not prefix: return "1"
+
+    m = prefix_upper_re.match(prefix)
+    if not m:
+        return DB.expand("`%s` >= %r", (column, prefix))
+
+    upper = m.group(1)
+    upper = upper[:-1] + chr(ord(upper[-1]) + 1)
+    return DB.expand("`%s` >= %r and `%s` < %r", (column, prefix, column, upper))
+
+def glob_condition(column, pattern, regex=None, recursive=False):
+    """ Returns an SQL condition matching column against the glob
+    pattern.
+
+    The literal prefix of the pattern is turned into a range on
+    column, so the regex (by default the translated pattern) is only
+    applied to the rows which may match.
+    """
+    if not globbing_re.search(pattern):
+        return DB.expand("`%s`=%r", (column, pattern))
+
+    if regex is None:
+        regex = "^%s$" % translate(pattern, recursive)
+
+    return DB.expand("%s and `%s` rlike %r", (prefix_range(column, glob_prefix(pattern)),
+                                              column, regex))
+
 def glob_sql(pattern):
+    ## Recursive patterns may match any number of directories, so we
+    ## match the whole path. The path column of any match must start
+    ## with the directory of the literal prefix. (Files in / have a
+    ## path of / so their full path starts with //).
+    if "**" in pattern:
+        directory = posixpath.dirname(glob_prefix(pattern))
+        if directory == '/': directory = ''
+
+        return DB.expand("select concat(path,'/',name) as path from vfs where %s and "
+                         "concat(path,'/',name) rlike %r group by vfs.path,name",
+                         (prefix_range('path', directory), "^/?%s$" % translate(pattern)))
+    
     path,name = posixpath.split(pattern)
 
     if globbing_re.search(path):
-        path_sql = "path rlike '^%s/?$'" % translate(path)
+        path_sql = glob_condition('path', path, "^%s/?$" % translate(path))
     else:
         ## Ensure that path has a / at the end:
         #if not path.endswith("/"): path=path+'/'
         
-        path_sql = "path='%s'" % path
+        path_sql = DB.expand("path=%r", path)
 
-    if globbing_re.search(name):
-        name_sql = "name rlike '^%s$'" % translate(name)
-    else:
-        name_sql = DB.expand("name=%r", name)
+    name_sql = glob_condition('name', name)
     
     if name and path:
         sql = "select concat(path,'/',name) as path from vfs where %s and %s group by vfs.path,name" % (path_sql,name_sql)
@@ -1269,3 +1632,34 @@ class VFSTests(unittest.TestCase):
         #dbh.execute("select count(*) from file where path='/toplevel/somedir/somefile/' and name='foobar' and inode='TestInode1|TestInode2'")
         #self.assert_(dbh.fetch())
         
+
+class GlobTests(unittest.TestCase):
+    """ Glob compiler """
+    def test01Translate(self):
+        """ Globs translate to the right regexes """
+        for pattern, matches, misses in (
+            ("/e/*/f", ["/e/x/f"], ["/e/x/y/f"]),
+            ("/e/**", ["/e/x", "/e/x/y"], ["/ex"]),
+            ("/e/**/*.exe", ["/e/a.exe", "/e/x/y/b.exe"], ["/e/a.exe/x", "/ex/a.exe"]),
+            ):
+            regex = re.compile("^%s$" % translate(pattern))
+            for path in matches:
+                self.assert_(regex.match(path), "%s should match %s" % (pattern, path))
+            for path in misses:
+                self.assert_(not regex.match(path), "%s should not match %s" % (pattern, path))
+
+    def test02PrefixRange(self):
+        """ Literal prefixes become ranges """
+        self.assertEqual(glob_prefix("/evidence/C/Win*/*.exe"), "/evidence/C/Win")
+        self.assertEqual(prefix_range("path", "/evidence/C/"),
+                         "`path` >= '/evidence/C/' and `path` < '/evidence/D'")
+        self.assertEqual(prefix_range("path", ""), "1")
+
+class TreeTests(unittest.TestCase):
+    """ Directory tree index """
+    def test01Ancestors(self):
+        """ Directories are related to all their ancestors """
+        self.assertEqual(path_ancestors("/a/b/c/"), ["/a/b/c", "/a/b", "/a", "/"])
+        self.assertEqual(path_ancestors("/"), ["/"])
+        self.assertEqual([ (r['ancestor'], r['depth']) for r in tree_rows("/a/b") ],
+                         [ ("/a/b", 0), ("/a", 1), ("/", 2) ])
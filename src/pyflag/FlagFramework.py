@@ -897,6 +897,11 @@ class EventHandler:
 
     def worker_startup(self, dbh, case):
         """ This will be called when a worker starts """
+
+    def prefork(self, dbh, case):
+        """ This will be called in the master just before the workers
+        are forked. Read only data loaded here is shared with them.
+        """
         
     def create(self,dbh,case):
         """ This method will be called when a new case is created """
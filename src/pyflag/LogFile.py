@@ -35,14 +35,177 @@ import pyflag.DB as DB
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 import pyflag.pyflaglog as pyflaglog
-import pickle,gzip
+import pickle,gzip,zlib,bz2
 import plugins.LogAnalysis.Whois as Whois
 from pyflag.ColumnTypes import IPType
 import re
 import pyflag.Registry as Registry
 import pyflag.IO as IO
+import pyflag.Store as Store
 import cStringIO
 import pyflag.code_parser as code_parser
+import pyflag.MultiGrep as MultiGrep
+import time, os
+
+config.add_option("NO_LOG_BULK_LOAD", default=False, action='store_true',
+                  help="Disable bulk loading of logs (where keys are "
+                  "disabled and indexes are built after the load)")
+
+config.add_option("LOG_READ_SIZE", default=1024*1024, type='int',
+                  help="The size of the blocks log files are read in")
+
+config.add_option("LOG_PROCESSES", default=1, type='int',
+                  help="Number of processes to parse log files with (0 uses "
+                  "all the CPUs, 1 loads them in the current process). "
+                  "Logs loaded by the GUI are loaded in chunks by the workers "
+                  "instead")
+
+config.add_option("LOG_CHUNK_SIZE", default=64, type='int',
+                  help="Size (in MB) of the chunks log files are split into "
+                  "when loading with several processes")
+
+## The magic of compressed log files and their decompressors:
+DECOMPRESSORS = (("\x1f\x8b", lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+                 ("BZh", bz2.BZ2Decompressor))
+
+def _read_magic(fd, data, size):
+    """ Reads more from fd until data is long enough to check the
+    magic (or we run out).
+    """
+    while 0 < len(data) < 3:
+        more = fd.read(size)
+        if not more: break
+        data += more
+
+    return data
+
+def read_chunks(fd, size=None):
+    """ Yields blocks of data from fd. gzip and bzip2 data is
+    decompressed transparently (including files made of several
+    concatenated streams).
+    """
+    size = size or config.LOG_READ_SIZE
+    data = _read_magic(fd, fd.read(size), size)
+
+    for magic, decompressor in DECOMPRESSORS:
+        if data.startswith(magic): break
+    else:
+        while data:
+            yield data
+            data = fd.read(size)
+
+        return
+
+    d = decompressor()
+    while data:
+        try:
+            result = d.decompress(data)
+            data = d.unused_data
+        except EOFError:
+            ## bz2 streams raise once they are finished
+            result = ''
+
+        if result:
+            yield result
+
+        if data:
+            ## Another stream follows - anything else is padding
+            data = _read_magic(fd, data, size)
+            if not data.startswith(magic): break
+            d = decompressor()
+        else:
+            data = fd.read(size)
+
+def split_lines(fd, chunk_size):
+    """ Returns a list of (start, end) ranges splitting the file like
+    object fd into chunks of about chunk_size bytes. Each range starts
+    at the beginning of a line.
+
+    Compressed files can not be split, so they are a single range
+    (end is None).
+    """
+    data = _read_magic(fd, fd.read(3), 3)
+    if isinstance(fd, gzip.GzipFile) or \
+           [ magic for magic, d in DECOMPRESSORS if data.startswith(magic) ]:
+        return [ (0, None) ]
+
+    fd.seek(0, 2)
+    size = fd.tell()
+
+    boundaries = [0]
+    for start, end in MultiGrep.split_ranges(size, chunk_size, 1)[1:]:
+        if start <= boundaries[-1]: continue
+
+        ## The next line starts after the first newline from start-1
+        offset = start - 1
+        fd.seek(offset)
+        while 1:
+            data = fd.read(64 * 1024)
+            if not data:
+                offset = size
+                break
+
+            i = data.find("\n")
+            if i >= 0:
+                offset += i + 1
+                break
+
+            offset += len(data)
+
+        if offset >= size: break
+        boundaries.append(offset)
+
+    boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+## The database pools we inherited from our parent (see
+## init_load_process())
+parent_db_pools = None
+
+def init_load_process():
+    """ Called in each log loading process when it starts. Sources
+    cached by the parent share their file offsets with it so we must
+    open our own. Likewise pooled database connections share their
+    sockets with the parent.
+    """
+    global parent_db_pools
+
+    IO.IO_Cache.flush()
+
+    ## Closing the parent's connections would close them for the
+    ## parent too, so we keep them aside and start a new pool
+    parent_db_pools = DB.PooledDBO.DBH
+    DB.PooledDBO.DBH = Store.Store(max_size=10)
+
+def load_chunk((case, preset, datafile, start, end, name, filter)):
+    """ Loads the lines of datafile between start and end into the
+    table name. This runs in its own process or in a worker (see
+    Log.load_chunks).
+
+    Returns the number of rows loaded, the bytes read, and the time
+    spent parsing and inserting.
+    """
+    log = load_preset(case, preset, [datafile])
+    if end is not None:
+        log.byte_range = (start, end)
+
+    tablename = name + "_log"
+    log.set_table(tablename)
+
+    dbh = DB.DBO(case)
+    dbh.cursor.ignore_warnings = True
+    dbh.mass_insert_start(tablename, _fast=True)
+    for count in log.insert_rows(dbh, filter):
+        pass
+
+    commit_start = time.time()
+    dbh.mass_insert_commit()
+    log.insert_time += time.time() - commit_start
+
+    pyflaglog.log(pyflaglog.DEBUG, "Loaded %s rows from %s (%s-%s)" % (
+        log.rows_loaded, datafile, start, end))
+
+    return log.rows_loaded, log.bytes_read, log.parse_time, log.insert_time
 
 def get_file(query,result):
     result.row("Select a sample log file for the previewer",stretch=False)
@@ -145,47 +308,71 @@ class Log:
             except RuntimeError:
                 pass
             
+    ## The number of bytes of log data read by read_record()
+    bytes_read = 0
+
+    ## If set, read_record() only reads the lines between these
+    ## offsets of the datafile (see load_chunk())
+    byte_range = None
+
+    ## Can our datafiles be split at line boundaries and loaded in
+    ## chunks?
+    splittable = True
+
+    ## The size of the chunks in bytes (default LOG_CHUNK_SIZE)
+    chunk_size = None
+
+    ## The preset we were restored from
+    preset = None
+
     def read_record(self, ignore_comment = True):
         """ Generates records.
 
         This can handle multiple files as provided in the constructor.
         """
-        
-        blank = re.compile("^\s*$")
-
         if self.datafile==None:
             raise IOError("Datafile is not set!!!")
-        
+
+        self.bytes_read = 0
         for file in self.datafile:
             ## open the file as a url:
             fd = IO.open_URL(file)
-            buffer = ''
-            while 1:
-                if len(buffer) < 1024:
-                    data = fd.read(1024)
-                    buffer = buffer + data
-
-                tmp = buffer.split("\n",1)
-                if len(tmp) == 0: break
-
-                line = tmp[0]
-               
-                try:
-                    buffer = tmp[1]
-                except:
-                    data = fd.read(1024)
-                    if len(data) == 0:
-                        break
-                    buffer = line + data
-                    continue
-                
-                if blank.match(line) or not line:
+            if self.byte_range:
+                start, end = self.byte_range
+                fd.seek(start)
+                fd = MultiGrep.RangeReader(fd, end - start)
+
+            for line in self.read_lines(fd):
+                if not line or line.isspace():
                     continue
                 if line.startswith('#') and ignore_comment:
                     continue
                 else:
                     yield line
 
+    def read_lines(self, fd):
+        """ Yields all the lines in fd (without the newline).
+
+        The file is read in large blocks which are split into lines
+        in one go, the last partial line being carried over to the
+        next block.
+        """
+        carry = ''
+        for data in read_chunks(fd):
+            self.bytes_read += len(data)
+
+            lines = data.split("\n")
+            lines[0] = carry + lines[0]
+            carry = lines.pop()
+            for line in lines:
+                yield line
+
+        yield carry
+
+    def read_rate(self, elapsed):
+        """ Returns the rate log data was read at in MB/s """
+        return self.bytes_read / 1024.0 / 1024 / max(elapsed, 0.001)
+
     def get_fields(self):
         """ A generator that returns all the columns in a log file.
 
@@ -198,7 +385,8 @@ class Log:
         ## By default we dont split the row
         return [self.read_record(),]
     
-    def load(self,name, rows = None, deleteExisting=None, filter=None):
+    def load(self,name, rows = None, deleteExisting=None, filter=None, bulk=None,
+             processes=None):
         """ Loads the specified number of rows into the database.
 
         __NOTE__ We assume this generator will run to
@@ -208,15 +396,25 @@ class Log:
         @arg table_name: A table name to use
         @arg rows: number of rows to upload - if None , we upload them all
         @arg deleteExisting: If this is anything but none, tablename will first be dropped
+        @arg bulk: Load in bulk mode - keys are disabled during the
+        load and all the indexes are built at the end in one go. This
+        is the default unless the NO_LOG_BULK_LOAD option is set.
+        @arg processes: The number of processes to parse the log
+        with. The default is taken from the LOG_PROCESSES option. Only
+        logs restored from a preset can be loaded by several
+        processes, and rows are then not loaded in file order.
         @return: A generator that represents the current progress indication.
         """
+        if bulk is None:
+            bulk = not config.NO_LOG_BULK_LOAD
+
+        if processes is None:
+            processes = config.LOG_PROCESSES
+
         ## We append _log to tablename to prevent name clashes in the
         ## db:
         tablename = name+"_log"
-        ## Set the table for our columns:
-        for f in self.fields:
-            if f:
-                f.table = tablename
+        self.set_table(tablename)
         
         ## First we create the table. We do this by asking all the
         ## column types for their create clause:
@@ -247,15 +445,87 @@ class Log:
             ',\n'.join([ x for x in creation_strings if x])
             ))
 
+        if bulk:
+            dbh.defer_indexes(tablename)
+            dbh.execute("alter table `%s` disable keys", tablename)
+
+        ## Now insert into the table:
+        load_start = time.time()
+        if processes != 1 and self.preset and self.splittable and not rows:
+            for progress in self.load_chunks(name, filter, processes):
+                yield progress
+        else:
+            for count in self.insert_rows(dbh, filter, rows):
+                yield "Loaded %s rows (%0.1f MB/s)" % (
+                    count, self.read_rate(time.time() - load_start))
+
+        read_rate = self.read_rate(time.time() - load_start)
+        start = time.time()
+        dbh.mass_insert_commit()
+        if bulk:
+            dbh.execute("alter table `%s` enable keys", tablename)
+
+        index_start = time.time()
+        insert_time = self.insert_time + index_start - start
+
+        ## Now create indexes on the required fields
+        for i in self.fields:
+            try:
+                ## Allow the column type to create an index on the
+                ## column
+                if i.index:
+                    i.make_index(dbh, tablename)
+            except AttributeError:
+                pass
+
+        dbh.build_indexes(tablename)
+        enrich_start = time.time()
+        index_time = enrich_start - index_start
+
+        ## Let the columns work out any extra data about their values
+        ## (e.g. the whois data of IP addresses) in bulk
+        for i in self.fields:
+            if i:
+                i.enrich(dbh, tablename)
+
+        enrich_time = time.time() - enrich_start
+
+        message = "Loaded %s rows into %s (read %0.1f MB at %0.1f MB/s): parsing %0.1fs, " \
+                  "inserting %0.1fs, indexing %0.1fs, enriching %0.1fs" % (
+            self.rows_loaded, tablename, self.bytes_read / 1024.0 / 1024, read_rate,
+            self.parse_time, insert_time, index_time, enrich_time)
+        pyflaglog.log(pyflaglog.INFO, message)
+        yield message
+
+    def set_table(self, tablename):
+        """ Sets the table for our columns """
+        for f in self.fields:
+            if f:
+                f.table = tablename
+
+    ## Totals of the rows inserted by insert_rows()
+    rows_loaded = 0
+    parse_time = 0
+    insert_time = 0
+
+    def insert_rows(self, dbh, filter=None, rows=None):
+        """ Parses our datafiles and mass inserts the rows with dbh
+        (which must already be started on our table).
+
+        This generator yields the number of rows parsed so far every
+        1000 rows. The totals are kept in self.rows_loaded,
+        self.parse_time and self.insert_time.
+        """
         ## Is there a filter implemented?
         if filter:
-            print fields
+            fields = [ x for x in self.fields if x]
             filter_parser = code_parser.parse_eval(filter, fields, None)
         else:
             filter_parser = None
 
-        ## Now insert into the table:
         count = 0
+        parse_time = insert_time = 0
+        start = time.time()
         for fields in self.get_fields():
             count += 1
             args = None
@@ -286,27 +556,95 @@ class Log:
             if filter_parser:
                 if not filter_parser(columns): continue
 
+            parsed = time.time()
+            parse_time += parsed - start
+
             if args:
                 dbh.mass_insert(args)
+
+            start = time.time()
+            insert_time += start - parsed
             
             if rows and count > rows:
                 break
 
             if not count % 1000:
-                yield "Loaded %s rows" % count
+                yield count
 
-        dbh.mass_insert_commit()
-        ## Now create indexes on the required fields
-        for i in self.fields:
-            try:
-                ## Allow the column type to create an index on the
-                ## column
-                if i.index:
-                    i.make_index(dbh, tablename)
-            except AttributeError:
-                pass
+        self.rows_loaded = count
+        self.parse_time = parse_time
+        self.insert_time = insert_time
 
-        return
+    def load_chunks(self, name, filter=None, processes=0):
+        """ Splits our datafiles at line boundaries and loads the
+        chunks into the table name in a pool of processes. Each
+        process restores our preset and inserts with its own
+        connection.
+
+        If we can not fork here (e.g. in the master's report threads)
+        the chunks are loaded by the workers instead (see
+        load_chunks_by_workers()).
+
+        This generator yields the progress as each chunk is done.
+        """
+        chunk_size = self.chunk_size or config.LOG_CHUNK_SIZE * 1024 * 1024
+        jobs = []
+        for datafile in self.datafile:
+            for start, end in split_lines(IO.open_URL(datafile), chunk_size):
+                jobs.append((self.case, self.preset, datafile, start, end,
+                             name, filter))
+
+        self.rows_loaded = self.bytes_read = 0
+        self.parse_time = self.insert_time = 0
+
+        if not MultiGrep.can_fork():
+            for progress in self.load_chunks_by_workers(name, jobs):
+                yield progress
+
+            return
+
+        load_start = time.time()
+        done = 0
+        for job, (count, bytes_read, parse_time, insert_time) in \
+                MultiGrep.parallel_map(load_chunk, jobs, processes or None,
+                                       init_load_process):
+            done += 1
+            self.rows_loaded += count
+            self.bytes_read += bytes_read
+            self.parse_time += parse_time
+            self.insert_time += insert_time
+
+            yield "Loaded %s rows (%s of %s chunks, %0.1f MB/s)" % (
+                self.rows_loaded, done, len(jobs),
+                self.read_rate(time.time() - load_start))
+
+    def load_chunks_by_workers(self, name, jobs):
+        """ Posts a LoadLogChunk job for each of the chunks and waits
+        for the workers to load them. Only the bytes read are reported
+        back, so the rows are counted in the table.
+        """
+        import pyflag.Farm as Farm
+        import pyflag.Cookies as Cookies
+
+        dbh = DB.DBO(self.case)
+        dbh.execute("select count(*) as c from `%s_log`", name)
+        rows = dbh.fetch()['c']
+
+        cookie = int(time.time())
+        for case, preset, datafile, start, end, table, filter in jobs:
+            Farm.post_job('LoadLogChunk', dict(case=case, preset=preset, datafile=datafile,
+                                               start=start, end=end, name=table,
+                                               filter=filter), cookie)
+
+        load_start = time.time()
+        for status in Cookies.wait(cookie):
+            self.bytes_read = status['bytes'] or 0
+            yield "Loaded %s of %s chunks (%0.1f MB/s)" % (
+                len(jobs) - status['outstanding'], len(jobs),
+                self.read_rate(time.time() - load_start))
+
+        dbh.execute("select count(*) as c from `%s_log`", name)
+        self.rows_loaded = dbh.fetch()['c'] - rows
 
     def restore(self, name):
         """ Restores the table from the log tables (This is the
@@ -317,6 +655,7 @@ class Log:
         row = dbh.fetch()
         self.query = query_type(string=row['query'])
         self.name = name
+        self.preset = name
 
     def store(self, name):
         """ Stores the configured driver in the db.
@@ -484,3 +823,84 @@ class LogDriverTester(unittest.TestCase):
         """ Remove test log tables """
         ## clear the preset we created
         drop_preset(self.log_preset)
+
+class ReadChunksTest(unittest.TestCase):
+    """ Chunked log reader """
+    text = "first line\n\n# comment\r\nlast line"
+
+    def test01Compressed(self):
+        """ Lines are the same in plain and compressed files """
+        import cStringIO
+
+        gz = cStringIO.StringIO()
+        fd = gzip.GzipFile(fileobj=gz, mode='w')
+        fd.write(self.text)
+        fd.close()
+
+        for data in (self.text, gz.getvalue(), bz2.compress(self.text),
+                     bz2.compress(self.text[:15]) + bz2.compress(self.text[15:])):
+            for size in (1, 5, 1024):
+                log = Log()
+                lines = list(log.read_lines(_ChunkedReader(data, size)))
+                self.assertEqual(lines, self.text.split("\n"))
+                self.assertEqual(log.bytes_read, len(self.text))
+
+class SplitLinesTest(unittest.TestCase):
+    """ Splitting log files into chunks """
+    lines = [ "line %s %s" % (i, "x" * (i % 37)) for i in range(500) ]
+
+    def setUp(self):
+        import tempfile
+
+        fd, self.filename = tempfile.mkstemp(suffix=".log")
+        os.write(fd, "\n".join(self.lines) + "\n")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test01Boundaries(self):
+        """ Chunks cover the file and start at the start of a line """
+        data = open(self.filename).read()
+        for chunk_size in (1, 100, 1000, len(data), len(data) * 2):
+            ranges = split_lines(open(self.filename), chunk_size)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], len(data))
+            for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+                self.assertEqual(data[next_start - 1], "\n")
+
+    def test02Compressed(self):
+        """ Compressed files are not split """
+        data = "\n".join(self.lines)
+        gz = cStringIO.StringIO()
+        fd = gzip.GzipFile(fileobj=gz, mode='w')
+        fd.write(data)
+        fd.close()
+
+        for compressed in (gz.getvalue(), bz2.compress(data)):
+            self.assertEqual(split_lines(cStringIO.StringIO(compressed), 100),
+                             [ (0, None) ])
+
+    def test03ByteRange(self):
+        """ Reading every chunk gives all the lines exactly once """
+        for chunk_size in (100, 1000):
+            result = []
+            for byte_range in split_lines(open(self.filename), chunk_size):
+                log = Log()
+                log.datafile = [ self.filename ]
+                log.byte_range = byte_range
+                result.extend(log.read_record())
+
+            self.assertEqual(result, self.lines)
+
+class _ChunkedReader:
+    """ Returns short reads as some file like objects do """
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def read(self, length):
+        result = self.data[:self.size]
+        self.data = self.data[self.size:]
+        return result
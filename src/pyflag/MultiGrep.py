@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Searches for many regular expressions in a single pass.
+
+Carving needs to find the signatures of many file types in very large
+images. Rather than running each regex over the data in turn, all the
+regexes are combined into a single alternation which finds the next
+position where any of them matches. Only at those positions do we try
+each regex individually to see which ones matched.
+
+Data is read in large blocks, with the last overlap bytes of each
+block carried over to the next so matches across block boundaries are
+found exactly once. Hits are produced as a stream in the order they
+appear in the data.
+
+This module only depends on the standard library so it may be used by
+the stand alone carvers too.
+"""
+import re, mmap
+
+class Scanner:
+    """ Finds all the matches of a set of regexes.
+
+    patterns is a list of (key, regex) tuples. Hits are reported as
+    (key, start, end) tuples, where start and end are absolute
+    offsets. Keys may be repeated and many keys may share the same
+    regex.
+
+    If overlapping is set, a regex is tried at every position (so the
+    matches of a regex may overlap). Otherwise matches of the same
+    regex do not overlap, just like re.finditer().
+
+    Matches may be at most overlap bytes long or they may be
+    truncated at block boundaries. Regexes must not use back
+    references since they are combined together.
+    """
+    def __init__(self, patterns, overlap=4096, overlapping=True):
+        self.overlap = overlap
+        self.overlapping = overlapping
+
+        ## A list of (regex, keys) in the order the regexes were first
+        ## seen.
+        regexs = []
+        index = {}
+        for key, regex in patterns:
+            try:
+                regexs[index[regex]][1].append(key)
+            except KeyError:
+                index[regex] = len(regexs)
+                regexs.append((regex, [key]))
+
+        self.regexs = [ (re.compile(regex), keys) for regex, keys in regexs ]
+        self.candidates = re.compile("|".join([ "(?:%s)" % regex for regex, keys in regexs ]))
+
+    def scan(self, data, offset=0, limit=None, _next=None):
+        """ Yields the hits which start before limit in data (a
+        string, buffer or mmap). offset is the absolute offset of
+        data.
+        """
+        if limit is None: limit = len(data)
+        if _next is None: _next = [0] * len(self.regexs)
+
+        search = self.candidates.search
+        pos = 0
+        while 1:
+            m = search(data, pos)
+            if not m: break
+
+            start = m.start()
+            if start >= limit: break
+
+            absolute = offset + start
+            for i in range(len(self.regexs)):
+                if absolute < _next[i]: continue
+
+                regex, keys = self.regexs[i]
+                hit = regex.match(data, start)
+                if hit:
+                    end = offset + hit.end()
+                    if not self.overlapping:
+                        _next[i] = max(end, absolute + 1)
+
+                    for key in keys:
+                        yield key, absolute, end
+
+            pos = start + 1
+
+    def scan_fd(self, fd, blocksize=10*1024*1024, offset=0, progress=None):
+        """ Yields the hits in the file like object fd, reading it
+        once in blocks of blocksize. offset is the absolute offset of
+        the current position of fd. progress is called with the number
+        of bytes read after each block.
+        """
+        _next = [0] * len(self.regexs)
+        window = ''
+        read = 0
+        while 1:
+            try:
+                data = fd.read(blocksize)
+            except IOError:
+                data = ''
+
+            if not data:
+                for hit in self.scan(window, offset, _next=_next):
+                    yield hit
+                break
+
+            read += len(data)
+            if progress: progress(read)
+
+            data = window + data
+            limit = max(len(data) - self.overlap, 0)
+            for hit in self.scan(data, offset, limit, _next):
+                yield hit
+
+            window = data[limit:]
+            offset += limit
+
+    def scan_file(self, fd, blocksize=10*1024*1024, progress=None):
+        """ Yields the hits in the file object fd. The file is mapped
+        into memory if possible, otherwise it is read in blocks.
+        """
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError, OverflowError):
+            for hit in self.scan_fd(fd, blocksize, progress=progress):
+                yield hit
+            return
+
+        try:
+            for hit in self.scan(data):
+                yield hit
+        finally:
+            data.close()
+
+    def scan_range(self, fd, start, end, blocksize=10*1024*1024):
+        """ Yields the hits in fd which start between start and
+        end. We read up to overlap bytes past end so hits which start
+        before end are complete.
+        """
+        fd.seek(start)
+        reader = RangeReader(fd, end - start + self.overlap)
+        for hit in self.scan_fd(reader, blocksize, offset=start):
+            if hit[1] >= end: break
+            yield hit
+
+class RangeReader:
+    """ A file like object which reads at most length bytes of fd """
+    def __init__(self, fd, length):
+        self.fd = fd
+        self.left = length
+
+    def read(self, length):
+        data = self.fd.read(min(length, self.left))
+        self.left -= len(data)
+        return data
+
+def split_ranges(size, range_size, align=512):
+    """ Splits size bytes into a list of (start, end) ranges of about
+    range_size bytes, aligned to align bytes.
+    """
+    range_size = max(range_size - range_size % align, align)
+    return [ (start, min(start + range_size, size)) for start in \
+             range(0, size, range_size) ]
+
+def remove_overlaps(hits):
+    """ Hits of a non overlapping scan which start inside a previous
+    hit of the same key are removed. A range which starts in the
+    middle of a match may produce such hits (which a sequential scan
+    would not have).
+
+    hits must be in offset order.
+    """
+    ends = {}
+    for key, start, end in hits:
+        if start < ends.get(key, 0): continue
+        ends[key] = max(end, start + 1)
+        yield key, start, end
+
+def can_fork():
+    """ Returns True if we may fork a pool of processes here. Only
+    the main thread may fork, and a SIGCHLD handler (like that of the
+    Farm master) would reap the pool's processes from under it.
+    """
+    import threading, signal
+
+    if not isinstance(threading.currentThread(), threading._MainThread):
+        return False
+
+    return signal.getsignal(signal.SIGCHLD) in (signal.SIG_DFL, signal.SIG_IGN, None)
+
+def parallel_map(function, jobs, processes=None, initializer=None):
+    """ Runs function over each of the jobs in a pool of processes
+    and yields (job, result) as they complete. function must be a
+    module level function so it can be pickled. initializer is called
+    in each process when it starts.
+
+    Check can_fork() first - the pool must not be started from a
+    thread, or from a process which handles SIGCHLD.
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(),
+                                initializer)
+    try:
+        for result in pool.imap_unordered(_run_job, [ (function, job) for job in jobs ]):
+            yield result
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _run_job((function, job)):
+    return job, function(job)
+
+import unittest
+
+class ScannerTest(unittest.TestCase):
+    """ Multi pattern scanner """
+    data = "xxGIF89a..PK\x03\x04....PK\x05\x06...12 0 obj..GIF87a"
+
+    def test01Overlapping(self):
+        """ Hits from all patterns are found in order """
+        s = Scanner([ ("gif", "GIF8[79]a"), ("zip", "PK\x03\x04"),
+                      ("end", "PK\x05\x06"), ("pk", "PK"), ("obj", r"(\d+) (\d+) obj") ])
+        hits = list(s.scan(self.data))
+        self.assertEqual([ (k, start) for k, start, end in hits ],
+                         [ ("gif", 2), ("zip", 10), ("pk", 10), ("end", 18), ("pk", 18),
+                           ("obj", 25), ("obj", 26), ("gif", 35) ])
+
+    def test02NonOverlapping(self):
+        """ Non overlapping hits are like finditer """
+        s = Scanner([ ("obj", r"(\d+) (\d+) obj") ], overlapping=False)
+        self.assertEqual(list(s.scan(self.data)), [ ("obj", 25, 33) ])
+
+    def test03Blocks(self):
+        """ Hits across block boundaries are found once """
+        import cStringIO
+
+        s = Scanner([ ("gif", "GIF8[79]a"), ("zip", "PK\x03\x04"), ("end", "PK\x05\x06") ],
+                    overlap=8)
+        expected = list(s.scan(self.data))
+        for blocksize in range(1, len(self.data) + 1):
+            hits = list(s.scan_fd(cStringIO.StringIO(self.data), blocksize))
+            self.assertEqual(hits, expected)
+
+    def test04Ranges(self):
+        """ Scanning ranges finds the same hits as a single scan """
+        import cStringIO
+
+        data = self.data * 20
+        for overlapping in (True, False):
+            s = Scanner([ ("gif", "GIF8[79]a"), ("obj", r"(\d+) (\d+) obj") ],
+                        overlap=16, overlapping=overlapping)
+            expected = list(s.scan(data))
+
+            for range_size in range(1, 50):
+                fd = cStringIO.StringIO(data)
+                hits = []
+                for start, end in split_ranges(len(data), range_size, 1):
+                    hits.extend(s.scan_range(fd, start, end, 7))
+
+                if not overlapping:
+                    hits = list(remove_overlaps(hits))
+
+                self.assertEqual(hits, expected)
@@ -30,11 +30,15 @@ registered classes when needed.
 This mechanism allows us to reorgenise the code according to
 functionality. For example we may include a Scanner, Report and File
 classes in the same plugin and have them all automatically loaded.
+
+The plugins are found and loaded only once (see find_plugins()), and
+the list of plugin files is cached in PLUGIN_CACHE so later runs do
+not need to walk the plugin directories again.
 """
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 
-import os,sys,imp
+import os,sys,imp,types,pickle
 import pyflag.pyflaglog as pyflaglog
 
 ## Define the parameters we need. The default plugins directory is
@@ -43,6 +47,188 @@ import pyflag.pyflaglog as pyflaglog
 config.add_option("PLUGINS", default=os.path.dirname(__file__) + "/plugins",
                   help="Plugin directories to use")
 
+config.add_option("PLUGIN_CACHE", default=None,
+                  help="A file to cache the list of plugins in between runs (default RESULTDIR/plugins.cache)")
+
+## Bump this when the format of the plugin cache changes
+PLUGIN_CACHE_VERSION = 1
+
+def plugin_cache_path():
+    return config.PLUGIN_CACHE or os.path.join(config.RESULTDIR, "plugins.cache")
+
+def walk_plugins():
+    """ Walks the plugin directories.
+
+    Returns a list of (path, mtime) for each directory and a list of
+    the plugin files to load. Files in directories below one with a
+    __dont_descend__ file are not loaded (but those directories are
+    still searched for imports).
+    """
+    directories = []
+    files = []
+    excluded_dirs = []
+
+    for path in config.PLUGINS.split(':'):
+        for dirpath, dirnames, filenames in os.walk(path):
+            directories.append((dirpath, os.stat(dirpath).st_mtime))
+
+            excluded = False
+            for x in excluded_dirs:
+                if dirpath.startswith(x):
+                    excluded = True
+                    break
+
+            if excluded: continue
+
+            for filename in filenames:
+                if filename.lower().startswith("__dont_descend__"):
+                    for d in dirnames:
+                        excluded_path = os.path.join(dirpath, d)
+                        if excluded_path not in excluded_dirs:
+                            excluded_dirs.append(excluded_path)
+
+                if filename.endswith(".py"):
+                    files.append(dirpath + '/' + filename)
+
+    return directories, files
+
+def read_plugin_cache():
+    """ Returns the directories and files saved by
+    write_plugin_cache(), or None if any of the plugin directories
+    were modified since. Adding or removing a file changes the mtime
+    of its directory.
+    """
+    try:
+        fd = open(plugin_cache_path(), "rb")
+        try:
+            ## Pickles are executable so we only trust our own
+            if os.fstat(fd.fileno()).st_uid != os.getuid():
+                return None
+
+            cache = pickle.load(fd)
+        finally:
+            fd.close()
+
+        if cache['version'] != PLUGIN_CACHE_VERSION or \
+               cache['plugins'] != config.PLUGINS:
+            return None
+
+        for dirpath, mtime in cache['directories']:
+            if os.stat(dirpath).st_mtime != mtime:
+                return None
+
+        return cache['directories'], cache['files']
+    except Exception,e:
+        return None
+
+def write_plugin_cache(directories, files):
+    filename = plugin_cache_path()
+    try:
+        ## Write a new file so readers never see a partial cache
+        fd = open("%s.%s" % (filename, os.getpid()), "wb")
+        try:
+            pickle.dump(dict(version = PLUGIN_CACHE_VERSION, plugins = config.PLUGINS,
+                             directories = directories, files = files),
+                        fd, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fd.close()
+
+        os.rename(fd.name, filename)
+    except (IOError, OSError),e:
+        pyflaglog.log(pyflaglog.DEBUG, "Unable to write plugin cache %s: %s" % (filename, e))
+
+## The active plugin modules as (module, module_desc, filename,
+## classes), where classes is a list of (name, class) defined in the
+## module. This is built once by find_plugins().
+PLUGIN_MODULES = None
+
+def find_plugins():
+    """ Finds and loads all the plugin modules. This is only done
+    once, all the registries then pick their classes from the modules.
+    """
+    global PLUGIN_MODULES
+
+    if PLUGIN_MODULES is not None:
+        return PLUGIN_MODULES
+
+    cache = read_plugin_cache()
+    if cache:
+        directories, files = cache
+    else:
+        directories, files = walk_plugins()
+        write_plugin_cache(directories, files)
+
+    ## Plugins may import modules from any of the plugin directories
+    for dirpath, mtime in directories:
+        if dirpath not in sys.path:
+            sys.path.append(dirpath)
+
+    PLUGIN_MODULES = []
+    for path in files:
+        plugin = load_plugin(path)
+        if plugin:
+            PLUGIN_MODULES.append(plugin)
+
+    return PLUGIN_MODULES
+
+def load_plugin(path):
+    """ Loads the plugin module in path. Returns (module, module_desc,
+    filename, classes) or None if the module could not be loaded or
+    is not active.
+    """
+    dirpath, filename = os.path.split(path)
+    #Lose the extension for the module name
+    module_name = filename[:-3]
+
+    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Will attempt to load plugin '%s/%s'"
+                  % (dirpath,filename))
+    try:
+        #open the plugin file
+        fd = open(path ,"r")
+    except Exception,e:
+        pyflaglog.log(pyflaglog.DEBUG, "Unable to open plugin file '%s': %s"
+                      % (filename,e))
+        return None
+
+    #load the module into our namespace
+    try:
+        try:
+            module = imp.load_source(module_name,path,fd)
+        except TypeError, e:
+            pyflaglog.log(pyflaglog.ERRORS, "Could not compile module %s: %s"
+                          % (module_name,e))
+            return None
+        except Exception,e:
+            pyflaglog.log(pyflaglog.ERRORS, "*** Unable to load module %s: %s"
+                          % (module_name,e))
+            return None
+    finally:
+        fd.close()
+
+    #Is this module active?
+    if getattr(module, 'hidden', False):
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module Hidden"% (module_name))
+        return None
+
+    if not getattr(module, 'active', True):
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module not active" % (module_name))
+        return None
+
+    #find the module description
+    module_desc = getattr(module, 'description', module_name)
+
+    ## Store information about this module here.
+    Registry.modules.append(module)
+    Registry.module_desc.append(module_desc)
+    Registry.module_paths.append(path)
+
+    ## The classes are enumerated once here rather than by each
+    ## registry
+    classes = [ (name, value) for name, value in sorted(module.__dict__.items()) \
+                if isinstance(value, (type, types.ClassType)) ]
+
+    return module, module_desc, filename, classes
+
 class Registry:
     """ Main class to register classes derived from a given parent class. """
     modules = []
@@ -51,128 +237,33 @@ class Registry:
     classes = []
     order = []
     filenames = {}
-    ## These are the modules which have been disabled
-    loaded_modules = []
-
-    ## Excluded dirs are not descended into
-    excluded_dirs = []
     
     def __init__(self,ParentClass):
-        """ Search the plugins directory for all classes extending ParentClass.
+        """ Search the plugins for all classes extending ParentClass.
         
         These will be considered as implementations and added to our internal registry.
         """
         ## Create instance variables
         self.classes = []
         self.order = []
-        
-        ## Recurse over all the plugin directories recursively
-        for path in config.PLUGINS.split(':'):
-            for dirpath, dirnames, filenames in os.walk(path):
-                sys.path.append(dirpath)
-                excluded = False
-                for x in self.excluded_dirs:
-                    if dirpath.startswith(x):
-                        excluded = True
-                        break
-
-                if excluded: continue
-                
-                for filename in filenames:
-                    #Lose the extension for the module name
-                    module_name = filename[:-3]
-                    if filename.lower().startswith("__dont_descend__"):
-                        for d in dirnames:
-                            excluded_path = os.path.join(dirpath, d)
-                            if excluded_path not in self.excluded_dirs:
-                                self.excluded_dirs.append(excluded_path)
-
-                    if filename.endswith(".py"):
-                        path = dirpath+'/'+filename
-                        try:
-                            if path not in self.loaded_modules:
-                                self.loaded_modules.append(path)
-                                
-                                pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Will attempt to load plugin '%s/%s'"
-                                            % (dirpath,filename))
-                                try:
-                                    #open the plugin file
-                                    fd = open(path ,"r")
-                                except Exception,e:
-                                    pyflaglog.log(pyflaglog.DEBUG, "Unable to open plugin file '%s': %s"
-                                                % (filename,e))
-                                    continue
-
-                                #load the module into our namespace
-                                try:
-                                    module = imp.load_source(module_name,dirpath+'/'+filename,fd)
-                                except Exception,e:
-                                    pyflaglog.log(pyflaglog.ERRORS, "*** Unable to load module %s: %s"
-                                                % (module_name,e))
-                                    continue
-
-                                fd.close()
-
-                                #Is this module active?
-                                try:
-                                    if module.hidden:
-                                        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module Hidden"% (module_name))
-                                        continue
-                                except AttributeError:
-                                    pass
-                                
-                                try:
-                                    if not module.active:
-                                        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module not active" % (module_name))
-                                        continue
-                                except AttributeError:
-                                    pass
-                                
-                                #find the module description
-                                try:
-                                    module_desc = module.description
-                                except AttributeError:
-                                    module_desc = module_name
-
-                                ## Store information about this module here.
-                                self.modules.append(module)
-                                self.module_desc.append(module_desc)
-                                self.module_paths.append(path)
-                                
-                            else:
-                                try:
-                                    ## We already have the module in the cache:
-                                    module = self.modules[self.module_paths.index(path)]
-                                    module_desc = self.module_desc[self.module_paths.index(path)]
-                                except (ValueError, IndexError),e:
-                                    ## If not the module has been loaded, but disabled
-                                    continue
-
-                            #Now we enumerate all the classes in the
-                            #module to see which one is a ParentClass:
-                            for cls in dir(module):
-                                try:
-                                    Class = module.__dict__[cls]
-                                    if issubclass(Class,ParentClass) and Class!=ParentClass:
-                                        ## Check the class for consitancy
-                                        try:
-                                            self.check_class(Class)
-                                        except AttributeError,e:
-                                            err = "Failed to load %s '%s': %s" % (ParentClass,cls,e)
-                                            pyflaglog.log(pyflaglog.WARNINGS, err)
-                                            continue
-
-                                        ## Add the class to ourselves:
-                                        self.add_class(ParentClass, module_desc, cls, Class, filename)
-                                            
-                                # Oops: it isnt a class...
-                                except (TypeError, NameError) , e:
-                                    continue
-
-                        except TypeError, e:
-                            pyflaglog.log(pyflaglog.ERRORS, "Could not compile module %s: %s"
-                                        % (module_name,e))
-                            continue
+
+        for module, module_desc, filename, classes in find_plugins():
+            #Now we check all the classes in the module to see which
+            #ones are a ParentClass:
+            for cls, Class in classes:
+                if Class == ParentClass or not issubclass(Class, ParentClass):
+                    continue
+
+                ## Check the class for consitancy
+                try:
+                    self.check_class(Class)
+                except AttributeError,e:
+                    err = "Failed to load %s '%s': %s" % (ParentClass,cls,e)
+                    pyflaglog.log(pyflaglog.WARNINGS, err)
+                    continue
+
+                ## Add the class to ourselves:
+                self.add_class(ParentClass, module_desc, cls, Class, filename)
 
     def add_class(self, ParentClass, module_desc, cls, Class, filename):
         """ Adds the class provided to our self. This is here to be
@@ -117,6 +117,15 @@ def scan_inode_distributed(case, inode_id, scanners, cookie):
     ## other workers from here.
     Farm.wake_workers()
     
+def scan_inodes_distributed(case, inode_ids, scanners, cookie):
+    """ Schedules jobs to scan many inodes.
+
+    The inodes are posted in batches (see Farm.post_batch) so each
+    batch is only a single job.
+    """
+    Farm.post_batch('ScanBatch', dict(case=case, scanners=scanners),
+                    'inode_ids', inode_ids, cookie)
+
 MESSAGE_COUNT = 0
 ### This is used to scan a file with all the requested scanner factories
 def scan_inode(case, inode_id, scanners, cookie, force=False):
@@ -126,67 +135,96 @@ def scan_inode(case, inode_id, scanners, cookie, force=False):
 
     if force is set we just scan anyway - even if its already been scanned.
     """
-    import pyflag.FileSystem as FileSystem
-    fsfd = FileSystem.DBFS(case)
+    scan_inodes(case, [inode_id], scanners, cookie, force)
+
+def _scan_inode(fsfd, dbh, m, factories, case, inode_id, scanners, cookie, force):
+    """ Scans one inode for scan_inodes() """
+    global MESSAGE_COUNT
+
     fd = fsfd.open(inode_id=inode_id)
-    stat = fd.stat()
-    
-    # instantiate a scanner object from each of the factory. We only
-    # instantiate scanners from factories which have not been run on
-    # this inode previously. We find which factories were already run
-    # by checking the inode table.  Note that we still pass the full
-    # list of factories to the Scan class so that it may invoke all of
-    # the scanners on new files it discovers.
-    dbh = DB.DBO(case)    
-    dbh.execute("select inode_id, scanner_cache from vfs where inode_id=%r limit 1",
-                fd.inode_id)
-    row=dbh.fetch()
     try:
-        scanners_run =row['scanner_cache'].split(',')
-    except:
-        scanners_run = []
-
-    ## Force the scanners to run anyway
-    if force: scanners_run = []
+        stat = fd.stat()
     
-    fd.inode_id = row['inode_id']
-
-    ## The new scanning framework is much simpler - we just call the
-    ## scan() method on each factory.
-    m = Magic.MagicResolver()
-    type, mime, scores = m.find_inode_magic(case, fd.inode_id)
+        # instantiate a scanner object from each of the factory. We only
+        # instantiate scanners from factories which have not been run on
+        # this inode previously. We find which factories were already run
+        # by checking the inode table.  Note that we still pass the full
+        # list of factories to the Scan class so that it may invoke all of
+        # the scanners on new files it discovers.
+        dbh.execute("select inode_id, scanner_cache from vfs where inode_id=%r limit 1",
+                    fd.inode_id)
+        row=dbh.fetch()
+        try:
+            scanners_run =row['scanner_cache'].split(',')
+        except:
+            scanners_run = []
 
-    for c in get_factories(scanners):
-        if c.__class__.__name__ not in scanners_run:
-            fd.seek(0)
-            try:
-                c.scan(fd, scanners=scanners, type=type, mime=mime, cookie=cookie, scores=scores)
-            except Exception,e:
-                print e
-                #continue
-                pdb.post_mortem(t = sys.exc_info()[2])
+        ## Force the scanners to run anyway
+        if force: scanners_run = []
     
-    global MESSAGE_COUNT
-    MESSAGE_COUNT += 1
-    if not MESSAGE_COUNT % 50:
-        messages = DB.expand("Scanning file %s/%s (inode %s)",
-                             (stat['path'],stat['name'],stat['inode_id']))
-        pyflaglog.log(pyflaglog.DEBUG, messages)
-    else:
-        messages = DB.expand("Scanning file %s/%s (inode %s)",
-                             (stat['path'],stat['name'],stat['inode_id']))
-        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, messages)
-
-    ## We dont care about scanning the same inode multiple times now -
-    ## so this is not necessary
-    return
+        fd.inode_id = row['inode_id']
+
+        ## The new scanning framework is much simpler - we just call the
+        ## scan() method on each factory.
+        type, mime, scores = m.find_inode_magic(case, fd.inode_id)
+
+        for c in factories:
+            if c.__class__.__name__ not in scanners_run:
+                fd.seek(0)
+                try:
+                    c.scan(fd, scanners=scanners, type=type, mime=mime, cookie=cookie, scores=scores)
+                except Exception,e:
+                    print e
+                    #continue
+                    pdb.post_mortem(t = sys.exc_info()[2])
+
+        MESSAGE_COUNT += 1
+        if not MESSAGE_COUNT % 50:
+            messages = DB.expand("Scanning file %s/%s (inode %s)",
+                                 (stat['path'],stat['name'],stat['inode_id']))
+            pyflaglog.log(pyflaglog.DEBUG, messages)
+        else:
+            messages = DB.expand("Scanning file %s/%s (inode %s)",
+                                 (stat['path'],stat['name'],stat['inode_id']))
+            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, messages)
+
+        ## This is reported with the progress of the cookie
+        Farm.add_bytes_scanned(stat.get('size') or 0)
+    finally:
+        ## Return the stream handle so the next inode can reuse it
+        fd.close()
+
+def scan_inodes(case, inode_ids, scanners, cookie, force=False):
+    """ Scans all the inode_ids with the factories provided.
+
+    This is the same as calling scan_inode() on each inode, but the
+    filesystem, database handle, magic resolver and factories are
+    shared for all the inodes.
+
+    New VFS nodes created by the scanners are written in batches (see
+    FileSystem.open_vfs_writer).
+    """
+    import pyflag.FileSystem as FileSystem
+    fsfd = FileSystem.DBFS(case)
+    dbh = DB.DBO(case)    
+    m = Magic.MagicResolver()
+    factories = get_factories(scanners)
 
-    # Store the fact that we finished in the inode table:
-    scanner_names = ','.join([ c.__class__.__name__ for c in factories ])
+    ## The VFS nodes the scanners create are batched until we are
+    ## done (or a job is posted). If we are scanning a node which a
+    ## scanner just created, it must be flushed first.
+    FileSystem.open_vfs_writer(case)
+    FileSystem.flush_vfs_writers(case)
     try:
-        dbh.execute("update vfs set scanner_cache = concat_ws(',',scanner_cache, %r) where inode_id=%r", (scanner_names, fd.inode_id))
-    except DB.DBError:
-        pass
+        for inode_id in inode_ids:
+            ## One bad inode must not stop the rest of the batch
+            try:
+                _scan_inode(fsfd, dbh, m, factories, case, inode_id,
+                            scanners, cookie, force)
+            except Exception, e:
+                pyflaglog.log(pyflaglog.ERRORS, "Unable to scan inode %s: %s" % (inode_id, e))
+    finally:
+        FileSystem.close_vfs_writer(case)
 
 class Drawer:
     """ This class is responsible for rendering scanners of similar classes.
@@ -17,6 +17,159 @@ the store at any one time.
 import thread,time,re
 import pyflag.pyflaglog as pyflaglog
 
+class Entry:
+    """ A node in the LRU list """
+    __slots__ = ('key', 'obj', 'time', 'size', 'prev', 'next')
+
+class LRU:
+    """ The cache engine behind the Store and FastStore.
+
+    Entries are kept in a hash for lookups and in a doubly linked list
+    in order of use (least recently used first), so all operations
+    other than expire_regex() are O(1).
+
+    Entries are evicted when there are more than max_items of them,
+    when they were not used for max_age seconds, or when the total
+    size of all entries exceeds max_bytes. The limits are not enforced
+    if they are 0. Sizes are given to put(), or measured with the
+    sizeof callable.
+
+    kill_cb is called with each object which is evicted or flushed.
+
+    This class is not thread safe.
+    """
+    def __init__(self, max_items=0, max_age=0, max_bytes=0, kill_cb=None, sizeof=None):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.kill_cb = kill_cb
+        self.sizeof = sizeof
+        self.hash = {}
+        self.bytes = 0
+
+        ## The list is circular around this sentinel. head.next is the
+        ## oldest entry and head.prev the newest.
+        self.head = Entry()
+        self.head.prev = self.head.next = self.head
+
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.hash)
+
+    def __contains__(self, key):
+        return key in self.hash
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _append(self, entry):
+        entry.prev = self.head.prev
+        entry.next = self.head
+        self.head.prev.next = entry
+        self.head.prev = entry
+
+    def put(self, key, obj, size=None):
+        """ Adds the object under key (replacing any object already
+        stored there) and evicts entries as needed.
+        """
+        try:
+            self.remove(key)
+        except KeyError:
+            pass
+
+        if size is None:
+            if self.sizeof:
+                size = self.sizeof(obj)
+            else:
+                size = 0
+
+        entry = Entry()
+        entry.key = key
+        entry.obj = obj
+        entry.size = size
+        entry.time = time.time()
+        self._append(entry)
+        self.hash[key] = entry
+        self.bytes += size
+
+        self.check_full()
+
+    def get(self, key, refresh=True):
+        """ Returns the object under key. If refresh is set, the entry
+        becomes the most recently used one. Raises KeyError if the key
+        is not present.
+        """
+        entry = self.hash[key]
+        if refresh:
+            entry.time = time.time()
+            self._unlink(entry)
+            self._append(entry)
+
+        return entry.obj
+
+    def remove(self, key):
+        """ Removes the key and returns its object (kill_cb is not
+        called).
+        """
+        entry = self.hash.pop(key)
+        self._unlink(entry)
+        self.bytes -= entry.size
+
+        return entry.obj
+
+    def evict(self, entry, reason):
+        self.remove(entry.key)
+        self.evictions += 1
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Removed object %r because %s" % (entry.key, reason))
+        if self.kill_cb:
+            self.kill_cb(entry.obj)
+
+    def check_full(self):
+        """ Evicts the oldest entries until we are within the limits """
+        while self.max_items and len(self.hash) > self.max_items:
+            self.evict(self.head.next, "store is full")
+
+        ## We always keep the newest entry even if its too large
+        while self.max_bytes and self.bytes > self.max_bytes and len(self.hash) > 1:
+            self.evict(self.head.next, "store is too large")
+
+        if self.max_age:
+            expired = time.time() - self.max_age
+            while self.head.next is not self.head and self.head.next.time < expired:
+                self.evict(self.head.next, "it is too old")
+
+    def expire_regex(self, regex):
+        """ Removes all entries with keys matching the regex """
+        for key in self.hash.keys():
+            if re.search(regex, key):
+                self.remove(key)
+
+    def flush(self):
+        """ Removes all entries, killing their objects """
+        if self.kill_cb:
+            for entry in self.hash.values():
+                self.kill_cb(entry.obj)
+
+        self.hash = {}
+        self.bytes = 0
+        self.head.prev = self.head.next = self.head
+
+    def keys(self):
+        """ Returns the keys in order of use (oldest first) """
+        result = []
+        entry = self.head.next
+        while entry is not self.head:
+            result.append(entry.key)
+            entry = entry.next
+
+        return result
+
+    def values(self):
+        """ Returns the objects in order of use (oldest first) """
+        return [ self.hash[k].obj for k in self.keys() ]
+
 class Store:
     """ Stores objects for a length of time.
 
@@ -28,43 +181,40 @@ class Store:
     destruction. Therefore, objects may only exist in the store or out
     of store (in the client) - never in both places.
     """
-    def __init__(self, max_size=300, age=1800):
-        """ max_size is the maximum number of objects in the store, age is their maximum age.
+    def __init__(self, max_size=300, age=1800, max_bytes=0, sizeof=None):
+        """ max_size is the maximum number of objects in the store,
+        age is their maximum age. If max_bytes is given, the store
+        also holds at most this many bytes of objects (as measured by
+        sizeof, or given to put()).
         """
         self.max_size = max_size
         self.max_age = age
         self.mutex = thread.allocate_lock()
-
-        ## creation_times is an array of (time, key, object). The time
-        ## is ordered in oldest first and newest last time order.
-        self.creation_times = []
+        self.cache = LRU(max_items = max_size, max_age = age,
+                         max_bytes = max_bytes, sizeof = sizeof)
         self.id = 0
 
     def flush(self):
         self.mutex.acquire()
-        self.creation_times = []
-        self.mutex.release()
+        try:
+            self.cache.flush()
+        finally:
+            self.mutex.release()
 
     def size(self):
-        return len(self.creation_times)
+        return len(self.cache)
         
-    def put(self,object, prefix='', key=None):
+    def put(self,object, prefix='', key=None, size=None):
         """ Stores an object in the Store.  Returns the key for the
-        object. If key is already supplied we use that instead - Note
-        that we do not check that it doesnt already exist.
+        object. If key is already supplied we use that instead - an
+        object already stored under the key is replaced.
         """
         self.mutex.acquire()
         try:
-
-            ## Ensure that we have enough space:
-            self.check_full()
-
-            ## Push the item in:
-            now = time.time()
             if not key:
                 key = "%s%s" % (prefix,self.id)
                 
-            self.creation_times.append([now,key, object])
+            self.cache.put(key, object, size)
             self.id+=1
 
         finally:
@@ -79,114 +229,147 @@ class Store:
         """ Retrieve the key from the store.
         If remove is specified we remove it from the Store altogether.
         """
-        ## FIXME: This is slow for large stores... use a dict for
-        ## quick reference:
         self.mutex.acquire()
 
         try:
-            ## Find and remove the object from the store
-            i=0
-            for t, k, obj in self.creation_times:
-                if k==key:
-                    ## Remove the object from the store:
-                    t, k, obj = self.creation_times.pop(i)
-
-                    ## Reinsert it into the cache at the most recent
-                    ## time:
-                    if not remove:
-                        self.creation_times.append([time.time(), k, obj])
-                    
-                    self.check_full()
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
-                                  "Got key %s: %s" % (key,
-                                                      ("%r" % (obj,))[:100]))
-                    return obj
-                i+=1
-
-            ## If we are here we could not find the key:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Key %s not found" % (key,))
-            raise KeyError("Key not found %s" % (key,))
+            ## Expire old objects first so we dont return them
+            self.cache.check_full()
+            try:
+                if remove:
+                    obj = self.cache.remove(key)
+                else:
+                    obj = self.cache.get(key)
+            except KeyError:
+                pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Key %s not found" % (key,))
+                raise KeyError("Key not found %s" % (key,))
+
+            pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
+                          "Got key %s: %s" % (key,
+                                              ("%r" % (obj,))[:100]))
+            return obj
 
         finally:
             self.mutex.release()
         
     def check_full(self):
         """ Checks to ensure the Store is not full """
-        ## Check to see if we store too many objects - remove oldest
-        ## objects first:
-        while len(self.creation_times)>self.max_size:
-            t, key, o = self.creation_times.pop(0)
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Removed object %r because store is full" % (o,))
-
-        ## Now ensure that objects are not too old:
-        now = time.time()
-        try:
-            while 1:
-                t,key,o = self.creation_times[0]
-                if t+self.max_age < now:
-                    self.creation_times.pop(0)
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Removed object %r because it is too old" % (o,))
-                else:
-                    break
-        except IndexError:
-            pass
+        self.cache.check_full()
 
     def expire(self, regex):
         """ Automatially expire all objects with keys matching the regex """
         self.mutex.acquire()
 
         try:
-            tmp = []
-            for x in self.creation_times:
-                if not re.search(regex, x[1]):
-                    tmp.append(x)
-            self.creation_times = tmp
+            self.cache.expire_regex(regex)
         finally:
             self.mutex.release()
 
     def __iter__(self):
-        for t, k, obj in self.creation_times:
+        for obj in self.cache.values():
             yield obj
 
 ## A much faster and simpler implementation of the above
 class FastStore:
     """ This is a cache which expires objects in oldest first manner. """
     def __init__(self, limit=50, max_size=0, kill_cb=None):
-        self.age = []
-        self.hash = {}
         self.limit = max_size or limit
         self.kill_cb = kill_cb
+        self.cache = LRU(max_items = self.limit, kill_cb = kill_cb)
 
     def expire(self):
-        while len(self.age) > self.limit:
-            x = self.age.pop(0)
-            ## Kill the object if needed
-            if self.kill_cb:
-                self.kill_cb(self.hash[x])
-
-            del self.hash[x]
+        self.cache.check_full()
 
     def add(self, urn, obj):
-        self.hash[urn] = obj
-        self.age.append(urn)
-        self.expire()
+        self.cache.put(urn, obj)
 
     def get(self, urn):
-        return self.hash[urn]
+        ## Objects expire in the order they were added
+        return self.cache.get(urn, refresh=False)
 
     def __contains__(self, obj):
-        return obj in self.hash
+        return obj in self.cache
 
     def __getitem__(self, urn):
-        return self.hash[urn]
+        return self.cache.get(urn, refresh=False)
 
     def flush(self):
-        if self.kill_cb:
-            for x in self.hash.values():
-                self.kill_cb(x)
+        self.cache.flush()
 
-        self.hash = {}
-        self.age = []
+
+## All the HandleCaches in this process by name, for reporting
+HANDLE_CACHES = {}
+
+class HandleCache:
+    """ A cache of open handles (e.g. AFF4 streams or pcap readers).
+
+    Unlike the Store, handles are checked out of the cache with get()
+    and checked back in with put() when the caller is done with them,
+    so a handle is never used by two callers at once. Only idle
+    handles are held in the cache - these are closed through kill_cb
+    when there are more than max_handles of them, or when their
+    total size (as measured by sizeof) exceeds max_bytes.
+
+    The cache is thread safe and keeps hit/miss/eviction counters
+    which can be seen with stats().
+    """
+    def __init__(self, name, max_handles=50, max_bytes=0, kill_cb=None, sizeof=None):
+        self.name = name
+        self.mutex = thread.allocate_lock()
+        self.cache = LRU(max_items = max_handles, max_bytes = max_bytes,
+                         kill_cb = kill_cb, sizeof = sizeof)
+        self.hits = 0
+        self.misses = 0
+        HANDLE_CACHES[name] = self
+
+    def get(self, key, open_cb=None):
+        """ Checks out the idle handle for key. If there is none we
+        call open_cb() to open a new handle, or raise KeyError if
+        open_cb is not given.
+        """
+        self.mutex.acquire()
+        try:
+            try:
+                obj = self.cache.remove(key)
+                self.hits += 1
+                return obj
+            except KeyError:
+                self.misses += 1
+                if not open_cb: raise
+        finally:
+            self.mutex.release()
+
+        ## Open outside the lock so other threads are not held up
+        return open_cb()
+
+    def put(self, key, obj):
+        """ Checks the handle back in. If there is already an idle
+        handle for key we close this one instead.
+        """
+        if obj is None: return
+
+        self.mutex.acquire()
+        try:
+            if key in self.cache:
+                self.cache.evictions += 1
+                if self.cache.kill_cb:
+                    self.cache.kill_cb(obj)
+            else:
+                self.cache.put(key, obj)
+        finally:
+            self.mutex.release()
+
+    def flush(self):
+        self.mutex.acquire()
+        try:
+            self.cache.flush()
+        finally:
+            self.mutex.release()
+
+    def stats(self):
+        """ Returns a dict of counters for this cache """
+        return dict(hits = self.hits, misses = self.misses,
+                    evictions = self.cache.evictions,
+                    handles = len(self.cache), bytes = self.cache.bytes)
 
 
 ## Store unit tests:
@@ -231,4 +414,81 @@ class StoreTests(unittest.TestCase):
 
         s.expire("test\d+")
         ## Should have 5 "testsxxx" left
-        self.assertEqual(len(s.creation_times),5)
+        self.assertEqual(s.size(),5)
+
+    def test04MaxBytes(self):
+        """ Tests the store limits the total size of objects """
+        s = Store(max_size = 100, max_bytes = 1000, sizeof = len)
+        keys = [ s.put("x" * 100) for i in range(20) ]
+        self.assertEqual(s.size(), 10)
+        self.assertRaises(KeyError, lambda : s.get(keys[0]))
+        s.get(keys[-1])
+
+    def test05FastStoreKill(self):
+        """ Tests FastStore expires the oldest objects and kills them """
+        killed = []
+        s = FastStore(limit = 3, kill_cb = killed.append)
+        for i in range(5):
+            s.add(i, "obj%s" % i)
+
+        self.assertEqual(killed, ["obj0", "obj1"])
+        self.assert_(4 in s and 0 not in s)
+
+        s.flush()
+        self.assertEqual(len(killed), 5)
+
+    def test06EvictionOrder(self):
+        """ Tests the least recently used objects are evicted first """
+        s = Store(max_size = 1000)
+        keys = [ s.put(i) for i in range(1000) ]
+
+        ## Refresh every third object, then push out 1000 - 334 objects
+        refreshed = keys[::3]
+        for k in refreshed:
+            s.get(k)
+
+        new_keys = [ s.put(i) for i in range(1000 - len(refreshed)) ]
+
+        ## Only the refreshed objects and the new ones survive, in
+        ## order of use
+        self.assertEqual(s.cache.keys(), refreshed + new_keys)
+        self.assertEqual(s.cache.evictions, 1000 - len(refreshed))
+
+        hits = misses = 0
+        for k in keys:
+            try:
+                s.get(k)
+                hits += 1
+            except KeyError:
+                misses += 1
+
+        self.assertEqual((hits, misses), (334, 666))
+
+    def test07HandleCache(self):
+        """ Tests handles are reused and closed on eviction """
+        opened = []
+        closed = []
+        def open_cb(key):
+            opened.append(key)
+            return [key]
+
+        c = HandleCache("test", max_handles = 2, kill_cb = closed.append)
+        for key in (1, 1, 2, 3, 1):
+            fd = c.get(key, lambda : open_cb(key))
+            c.put(key, fd)
+
+        ## 1 was evicted by 3 and reopened
+        self.assertEqual(opened, [1, 2, 3, 1])
+        self.assertEqual(closed, [[1], [2]])
+
+        ## A second handle for the same key is closed when returned
+        fd1 = c.get(1, lambda : open_cb(1))
+        fd2 = c.get(1, lambda : open_cb(1))
+        c.put(1, fd1)
+        c.put(1, fd2)
+        self.assert_(fd2 is closed[-1])
+
+        stats = c.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (2, 5, 3))
+        self.assertRaises(KeyError, lambda : c.get(4))
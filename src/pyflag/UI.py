@@ -31,7 +31,7 @@
 
 The output within flag is abstracted such that it is possible to connect any GUI backend with any GUI Front end. This is done by use of UI objects. When a report runs, it will generate a UI object, which will be built during report execution. The report then returns the object to the calling framework which will know how to handle it. Therefore the report doesnt really know or care how the GUI is constructed """
 
-import re,cgi,types,os,time,posixpath
+import re,cgi,types,os,time,posixpath,threading
 import pyflag.FlagFramework as FlagFramework
 import pyflag.DB as DB
 from pyflag.DB import expand
@@ -40,6 +40,8 @@ import pyflag.pyflaglog as pyflaglog
 config=pyflag.conf.ConfObject()
 import pyflag.parser as parser
 import pyflag.Registry as Registry
+import pyflag.Store as Store
+from hashlib import md5
 import pdb
 
 config.LOG_LEVEL=7
@@ -294,17 +296,21 @@ class GenericUI:
                     def tree_cb(path):
                         fsfd = FileSystem.DBFS(query['case'])
                         query.default("path",'/')
-                        dirs = []
-                        for i in fsfd.longls(path): 
-                            if i['type']=="directory":
-                                dirs.append(i['name'])
-                                yield(([i['name'],i['name'],'branch']))
+                        ## Only directories with children may be expanded
+                        for name, children in fsfd.subdirs(path):
+                            if children:
+                                yield(([name,name,'branch']))
+                            else:
+                                yield(([name,name,'leaf']))
                                 
                     def pane_cb(path,tmp):
                         fsfd = FileSystem.DBFS( query["case"])
                         if not fsfd.isdir(path):
                             path=posixpath.dirname(path)
 
+                        files, size = fsfd.subtree_stats(path)
+                        tmp.para("%s files (%s bytes) under %s" % (files, size, path))
+
                         new_query = make_new_query(query, path + '/')
 
                         tmp.table(
@@ -457,6 +463,88 @@ UI = None
 config.add_option("PAGESIZE", default=50, type='int',
                   help="number of rows to display per page in the Table widget")
 
+config.add_option("SPARSE_INDEX_STEP", default=10000, type='int',
+                  help="The Table widget samples the sort key every this "
+                  "many rows to skip directly to rows deep in a table")
+
+## Sampled keys of table queries (see TableRenderer.sparse_index)
+SPARSE_INDEXES = Store.Store(max_size=20, age=600)
+
+config.add_option("COUNT_CHUNK_SIZE", default=1000000, type='int',
+                  help="The range of keys counted at once when counting "
+                  "the rows in the Table widget")
+
+class RowCounter:
+    """ Counts the rows of a query in the background.
+
+    If the table has a numeric key, the rows are counted in chunks of
+    the key range so the count so far can be shown while we count.
+    Until the count is done estimate() extrapolates from the part
+    counted (or the EXPLAIN estimate before the first chunk).
+    """
+    def __init__(self, case, sql, count_sql, table, key=None):
+        self.case = case
+        self.sql = sql
+        self.count_sql = count_sql
+        self.table = table
+        self.key = key
+        self.count = 0
+        self.fraction = 0.0
+        self.done = False
+        self.error = None
+
+        ## The optimiser's estimate is immediate
+        dbh = DB.DBO(case)
+        self.explain_estimate = 1
+        dbh.execute("explain %s", sql)
+        for row in dbh:
+            self.explain_estimate *= row['rows'] or 1
+
+    def estimate(self):
+        if self.fraction > 0:
+            return int(self.count / self.fraction)
+
+        return self.explain_estimate
+
+    def start(self):
+        t = threading.Thread(target = self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def run(self):
+        dbh = DB.DBO(self.case)
+        try:
+            low = high = None
+            if self.key:
+                dbh.execute("select min(`%s`) as low, max(`%s`) as high from `%s`",
+                            (self.key, self.key, self.table))
+                row = dbh.fetch()
+                low, high = row['low'], row['high']
+
+            if isinstance(low, (int, long)) and isinstance(high, (int, long)):
+                chunk = config.COUNT_CHUNK_SIZE
+                start = low
+                while start <= high:
+                    dbh.execute("%s and `%s`.`%s` >= %r and `%s`.`%s` < %r",
+                                (self.count_sql, self.table, self.key, start,
+                                 self.table, self.key, start + chunk))
+                    self.count += dbh.fetch()['total']
+                    start += chunk
+                    self.fraction = min(float(start - low) / (high + 1 - low), 1.0)
+            else:
+                dbh.execute(self.count_sql)
+                self.count = dbh.fetch()['total']
+
+            dbh.cache_count(self.sql, self.count)
+        except Exception, e:
+            self.error = e
+
+        self.fraction = 1.0
+        self.done = True
+
+## Counts in progress keyed by case and query
+COUNTERS = Store.Store(max_size=50)
+
 def _make_join_clause(total_elements):
     query_str = ''
     ## The tables are calculated as a join of all the individual
@@ -525,6 +613,13 @@ class TableRenderer:
     groupby = None
     _groupby = None
 
+    ## A unique column of table used to page through the table by key
+    ## (the primary key is used if not set)
+    key = None
+
+    ## The sort expression and key column when paging by key
+    keyset = None
+
     def __init__(self, **args):
         self.__dict__.update(args)
         
@@ -573,16 +668,47 @@ class TableRenderer:
         
     def count_button(self, query, result):
         """  This returns the total number of rows in this table - it
-        could take a while which is why its a popup."""
+        could take a while which is why its a popup.
+
+        We show an estimate straight away, and refine it while the
+        rows are counted in the background. Exact counts are
+        remembered until the table changes.
+        """
         def count_cb(query, result):
-            sql = self._make_sql(query).split("from",1)[1]
-            #sql = self._make_sql(query)[len("select "):]
+            sql = self._make_sql(query, ordering=False)
+            result.heading("Total rows")
 
             dbh=DB.DBO(self.case)
-            dbh.execute("select count(*) as total from " + sql)
-            row=dbh.fetch()
-            result.heading("Total rows")
-            result.para("%s rows" % row['total'])
+            count = dbh.cached_count(sql)
+            if count is not None:
+                result.para("%s rows" % count)
+                return
+
+            cache_key = "%s:%s" % (self.case, sql)
+            try:
+                counter = COUNTERS.get(cache_key)
+            except KeyError:
+                if self.groupby or self._groupby:
+                    count_sql = "select count(*) as total from (select 1 %s) as t" % self.from_clause
+                    key = None
+                else:
+                    count_sql = "select count(*) as total %s" % self.from_clause
+                    key = DB.get_primary_key(self.case, self.table)
+
+                counter = RowCounter(self.case, sql, count_sql, self.table, key)
+                COUNTERS.put(counter, key=cache_key)
+                counter.start()
+
+            if counter.error:
+                COUNTERS.get(cache_key, remove=True)
+                result.para("Unable to count rows: %s" % counter.error)
+            elif counter.done:
+                COUNTERS.get(cache_key, remove=True)
+                result.para("%s rows" % counter.count)
+            else:
+                result.para("About %s rows (%d%% counted)" % (counter.estimate(),
+                                                             counter.fraction * 100))
+                result.refresh(2, query, pane='self')
 
         result.toolbar(count_cb, "Count rows matching filter", icon = "add.png")
         
@@ -657,15 +783,19 @@ class TableRenderer:
 
     def paging_buttons(self,query, result):
         """ Adds toolbar buttons for paging through the table """
-        new_query = query.clone()
+        first_key = getattr(self, 'first_key', None)
+        last_key = getattr(self, 'last_key', None)
 
         ## The previous button goes back if possible:
         previous_limit = self.limit - self.pagesize
         if previous_limit<0:
             result.toolbar(icon = 'stock_left_gray.png')
         else:
-            del new_query[self.limit_context]
-            new_query[self.limit_context] = previous_limit
+            if previous_limit > 0:
+                new_query = self.seek_query(query, previous_limit, 'before', first_key)
+            else:
+                new_query = self.seek_query(query, 0)
+
             result.toolbar(icon = 'stock_left.png',
                          link = new_query, pane='pane',
                          tooltip='Previous Page (Rows %s-%s)' % (previous_limit, self.limit))
@@ -677,8 +807,8 @@ class TableRenderer:
         else:
             ## We could not fill a full page - means we ran out of
             ## rows in this table
-            del new_query[self.limit_context]
-            new_query[self.limit_context] = self.limit + self.pagesize
+            new_query = self.seek_query(query, self.limit + self.pagesize,
+                                        'after', last_key)
             result.toolbar(icon = 'stock_right.png',
                            link = new_query, pane='pane',
                            tooltip='Next Page (Rows %s-%s)' % (self.limit, self.limit \
@@ -692,6 +822,12 @@ class TableRenderer:
             result.decoration = 'naked'
             result.heading("Skip directly to a row")
             result.para("You may specify the row number in hex by preceeding it with 0x")
+
+            ## The row is found from the sparse index rather than
+            ## the key of the current page
+            for k in ("_seek", "_sort", "_key"):
+                query.clear(variable + k)
+
             result.start_form(query, pane="parent_pane")
             result.start_table()
             if limit.startswith('0x'):
@@ -720,8 +856,34 @@ class TableRenderer:
             icon = "sql.png", pane = 'popup',
             )
     
-    def _make_sql(self, query, ordering=True):
-        """ Calculates the SQL for the table widget based on the query """
+    def _keyset_columns(self):
+        """ Returns the sort expression and the key column used to
+        page through the table by key, or None if we can not.
+        """
+        if self.groupby or self._groupby: return None
+
+        key = self.key or DB.get_primary_key(self.case, self.table)
+        if not key: return None
+
+        try:
+            sort = self.elements[self.order].order_by()
+        except IndexError:
+            return None
+
+        return sort, "`%s`.`%s`" % (self.table, key)
+
+    def _make_sql(self, query, ordering=True, keyset=False, seek=None,
+                  keys_only=False):
+        """ Calculates the SQL for the table widget based on the query
+
+        If keyset is set and the table has a key, the sort and key
+        values are also selected (as _sort_key and _row_key) and the
+        key is used to break ties in the ordering. seek may then be
+        ('after' or 'before', sort value, key value) to select the
+        rows after or before that row. Rows before are returned in
+        reverse order. If keys_only is set only the sort and key
+        values are selected.
+        """
         ## Calculate the SQL
         query_str = "select "
         try:
@@ -741,9 +903,23 @@ class TableRenderer:
             if not e.case: e.case = self.case
 
         ## The columns and their aliases:
-        query_str += ",".join([ e.select() + " as `" + e.name + "`" for e in self.elements ])
+        columns = [ e.select() + " as `" + e.name + "`" for e in self.elements ]
+
+        self.keyset = None
+        if keyset:
+            self.keyset = self._keyset_columns()
+
+        if self.keyset:
+            sort, key = self.keyset
+            keys = [ "%s as `_sort_key`" % sort, "%s as `_row_key`" % key ]
+            if keys_only:
+                columns = keys
+            else:
+                columns += keys
+
+        query_str += ",".join(columns)
         
-        query_str += _make_join_clause(total_elements)
+        from_clause = _make_join_clause(total_elements)
 
         if self.where:
             w = ["(%s)" % self.where,]
@@ -754,6 +930,19 @@ class TableRenderer:
             tmp = e.where()
             if tmp: w.append(tmp)
 
+        ascending = self.direction == 1
+        if self.keyset and seek:
+            where, sort_value, key_value = seek
+            if where == 'before':
+                ascending = not ascending
+
+            if ascending: op = '>'
+            else: op = '<'
+
+            w.append(DB.expand("(%s %s %r or (%s = %r and %s %s %r))",
+                               (sort, op, sort_value, sort, sort_value,
+                                key, op, key_value)))
+
         ## Is there a filter condition?
         if self.filter_str:
             filter_str = parser.parse_to_sql(self.filter_str, total_elements, ui=None)
@@ -761,20 +950,27 @@ class TableRenderer:
             
         else: filter_str = 1
 
-        query_str += "where (%s and (%s)) " % (" and ".join(w), filter_str)
+        from_clause += "where (%s and (%s)) " % (" and ".join(w), filter_str)
 
         if self.groupby:
-            query_str += "group by %s " % DB.escape_column_name(self.groupby)
+            from_clause += "group by %s " % DB.escape_column_name(self.groupby)
         elif self._groupby:
-            query_str += "group by %s " % self.groupby
+            from_clause += "group by %s " % self.groupby
+
+        ## This is everything after the columns (used for counting)
+        self.from_clause = from_clause
+        query_str += from_clause
             
         ## Now calculate the order by:
         if ordering:
+            if ascending: direction = "asc"
+            else: direction = "desc"
+
             try:
-                query_str += "order by %s " % self.elements[self.order].order_by()
-                if self.direction == 1:
-                    query_str += "asc"
-                else: query_str += "desc"
+                query_str += "order by %s %s" % (self.elements[self.order].order_by(),
+                                                 direction)
+                if self.keyset:
+                    query_str += ", %s %s" % (self.keyset[1], direction)
             except IndexError:
                 pass
 
@@ -791,15 +987,106 @@ class TableRenderer:
         FIXME - Implement a memory based table renderer.
         """
         dbh = DB.DBO(self.case)
-        self.sql = self._make_sql(query)
-        ## This allows pyflag to cache the resultset, needed to speed
-        ## paging of slow queries.
+        self.sql = self._make_sql(query, keyset=True)
         try:    self.limit = int(query.get(self.limit_context,0))
         except: self.limit = 0
-        
+
+        if not self.keyset:
+            ## This allows pyflag to cache the resultset, needed to speed
+            ## paging of slow queries.
+            dbh.cached_execute(self.sql,limit=self.limit, length=self.pagesize)
+            return dbh
+
+        ## If we came from the next or previous page we know the key
+        ## of the row next to this page, so we seek straight to it
+        ## rather than making the server skip over all the rows
+        ## before. The key is only valid for the same query.
+        try:
+            where, signature = query[self.limit_context + "_seek"].split(":")
+            if signature == self.signature():
+                seek = (where, query[self.limit_context + "_sort"],
+                        query[self.limit_context + "_key"])
+                dbh.execute(self._make_sql(query, keyset=True, seek=seek) + \
+                            " limit %s" % self.pagesize)
+                rows = [ row for row in dbh ]
+                if where == 'before': rows.reverse()
+
+                return self.track_keys(rows)
+        except (KeyError, ValueError):
+            pass
+
+        ## Deep rows are found from the nearest sampled key
+        step = config.SPARSE_INDEX_STEP
+        if self.limit >= step:
+            index = self.sparse_index(query)
+            i = min(self.limit / step, len(index))
+            if i > 0 and None not in index[i-1]:
+                seek = ('after',) + tuple(index[i-1])
+                dbh.execute(self._make_sql(query, keyset=True, seek=seek) + \
+                            " limit %s,%s" % (self.limit - i * step, self.pagesize))
+                return self.track_keys([ row for row in dbh ])
+
         dbh.cached_execute(self.sql,limit=self.limit, length=self.pagesize)
-        
-        return dbh
+        return self.track_keys(dbh)
+
+    def signature(self):
+        """ Identifies the current query so keys are only used to seek
+        in the query they came from.
+        """
+        return md5(DB.force_string(self.sql)).hexdigest()[:8]
+
+    def track_keys(self, rows):
+        """ Remembers the keys of the first and last rows of the page
+        for the paging buttons.
+        """
+        self.first_key = self.last_key = None
+        for row in rows:
+            key = (row['_sort_key'], row['_row_key'])
+            if self.first_key is None:
+                self.first_key = key
+
+            self.last_key = key
+            yield row
+
+    def sparse_index(self, query):
+        """ Returns the sort and key values of every SPARSE_INDEX_STEP
+        rows in the table (i.e. index[i] is the key of row
+        (i+1)*SPARSE_INDEX_STEP-1). These allow us to skip to any row
+        by seeking from the nearest key.
+        """
+        sql = self._make_sql(query, keyset=True, keys_only=True)
+        cache_key = "%s:%s" % (self.case, sql)
+        try:
+            return SPARSE_INDEXES.get(cache_key)
+        except KeyError:
+            pass
+
+        step = config.SPARSE_INDEX_STEP
+        index = []
+        dbh = DB.DBO(self.case)
+        dbh.stream_execute(sql)
+        for rows in dbh.iter_batches(step):
+            if len(rows) == step:
+                index.append(rows[-1])
+
+        SPARSE_INDEXES.put(index, key=cache_key)
+        return index
+
+    def seek_query(self, query, limit, where=None, key=None):
+        """ Returns a query for the page starting at row limit. If key
+        is given, the page is the rows after (or before) that key.
+        """
+        new_query = query.clone()
+        for k in ("", "_seek", "_sort", "_key"):
+            new_query.clear(self.limit_context + k)
+
+        new_query[self.limit_context] = limit
+        if self.keyset and key and None not in key:
+            new_query[self.limit_context + "_seek"] = "%s:%s" % (where, self.signature())
+            new_query[self.limit_context + "_sort"] = key[0]
+            new_query[self.limit_context + "_key"] = key[1]
+
+        return new_query
 
     def render_table(self, query, result):
         """ Renders the actual table itself """
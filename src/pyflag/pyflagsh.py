@@ -59,6 +59,9 @@ class environment:
         self.CWD='/'
         self._CASE = case
         self.interactive = True
+        ## The cookie for the jobs posted by commands (a new one is
+        ## made if this is not set)
+        self.cookie = None
 
 class command:
     optlist=""
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures how fast rows can be read out of the database for export.
+
+A table like the vfs table is filled with synthetic rows, and then
+read back by iterating over dicts, by fetching batches of tuples, by
+fetching a projection of columns and by writing the CSV file the way
+the CSV exporter does.
+"""
+import sys,time
+import csv, cStringIO
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+
+Registry.Init()
+
+config.set_usage(usage = """%prog [options]
+
+Reports the number of rows per second read from a large table (by
+default 10 million rows) with the different fetch methods.
+
+The table is made in the case given (or the default pyflag database)
+and is only filled if it has fewer rows than requested, so subsequent
+runs are quicker.
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("case", default=None,
+                  help="Case to make the benchmark table in")
+
+config.add_option("rows", default=10000000, type='int',
+                  help="Number of rows in the table")
+
+config.add_option("table", default="export_benchmark",
+                  help="The name of the benchmark table")
+
+config.add_option("batch_size", default=1000, type='int',
+                  help="Number of rows in each batch")
+
+config.parse_options(True)
+
+dbh = DB.DBO(config.case)
+dbh.execute("""create table if not exists `%s` (
+`inode_id` int unsigned NOT NULL auto_increment,
+`path` text,
+`name` text,
+`mtime` timestamp NULL,
+`size` bigint not null,
+primary key (inode_id)
+)""", config.table)
+
+dbh.execute("select count(*) as count from `%s`", config.table)
+count = dbh.fetch()['count']
+if count < config.rows:
+    print "Adding %s rows to %s" % (config.rows - count, config.table)
+    dbh.mass_insert_start(config.table)
+    for i in xrange(count, config.rows):
+        dbh.mass_insert(path = "/dir%s/subdir%s" % (i % 1000, i % 37),
+                        name = "file%s.txt" % i,
+                        _mtime = "from_unixtime(%s)" % (1200000000 + i),
+                        size = i * 13 % 100000)
+    dbh.mass_insert_commit()
+
+sql = "select inode_id, path, name, mtime, size from `%s` limit %s" % (
+    config.table, config.rows)
+
+def dicts():
+    dbh = DB.DBO(config.case)
+    dbh.stream_execute(sql)
+    count = 0
+    for row in dbh:
+        count += 1
+
+    return count
+
+def batches():
+    dbh = DB.DBO(config.case)
+    dbh.stream_execute(sql)
+    count = 0
+    for rows in dbh.iter_batches(config.batch_size):
+        count += len(rows)
+
+    return count
+
+def projection():
+    dbh = DB.DBO(config.case)
+    dbh.stream_execute(sql)
+    count = 0
+    for rows in dbh.iter_batches(config.batch_size, columns = ['path', 'name']):
+        count += len(rows)
+
+    return count
+
+def csv_export():
+    dbh = DB.DBO(config.case)
+    dbh.stream_execute(sql)
+    data = cStringIO.StringIO()
+    csv_writer = csv.writer(data, dialect = 'excel')
+    count = 0
+    for rows in dbh.iter_batches(config.batch_size):
+        csv_writer.writerows(rows)
+        data.seek(0)
+        data.truncate(0)
+        count += len(rows)
+
+    return count
+
+for name, function in (("Dict per row", dicts), ("Batched tuples", batches),
+                       ("Projection", projection), ("CSV export", csv_export)):
+    start = time.time()
+    count = function()
+    end = time.time()
+
+    print "%s: %s rows in %0.2fs (%0.0f rows/s)" % (
+        name, count, end - start, count / max(end - start, 0.001))
+
+sys.exit(0)
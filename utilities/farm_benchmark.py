@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the job throughput of the scan farm.
+
+We post a Scan job for each inode, and then the same inodes as
+ScanBatch jobs, and report how many inodes per second the workers
+got through in each case.
+"""
+import sys,time
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+import pyflag.Farm as Farm
+import pyflag.Cookies as Cookies
+import pyflag.Scanner as Scanner
+import pyflag.ScannerUtils as ScannerUtils
+
+Registry.Init()
+
+config.set_usage(usage = """%prog [options]
+
+Measures the number of inodes per second scanned by the workers when
+posting a job per inode and when posting batches of inodes.
+
+If a case is given, its inodes are scanned with the scanners
+specified - load an image with many small files to make a suitable
+case. Otherwise synthetic inode ids are posted with no scanners which
+measures the overhead of the job distribution alone.
+
+Try different values of --job_queue, --job_batch_size and
+--job_coalesce to compare.
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("case", default=None,
+                  help="Case to take inodes from")
+
+config.add_option("inodes", default=100000, type='int',
+                  help="Number of inodes to scan")
+
+config.add_option("scanners", default='',
+                  help='A comma delimited string of scanners to run')
+
+config.parse_options(True)
+
+if config.case:
+    dbh = DB.DBO(config.case)
+    dbh.execute("select inode_id from vfs where !isnull(inode_id) limit %s",
+                config.inodes)
+    inode_ids = [ row['inode_id'] for row in dbh ]
+else:
+    inode_ids = range(1, config.inodes + 1)
+
+if config.scanners:
+    scanners = ScannerUtils.fill_in_dependancies(config.scanners.split(','))
+else:
+    scanners = []
+
+def wait_for(cookie):
+    for status in Cookies.wait(cookie, interval=1):
+        pass
+
+def single(cookie):
+    for inode_id in inode_ids:
+        Scanner.scan_inode_distributed(config.case, inode_id, scanners, cookie)
+
+def batch(cookie):
+    Scanner.scan_inodes_distributed(config.case, inode_ids, scanners, cookie)
+
+Farm.start_workers()
+
+for name, function in (("Job per inode", single), ("Batched", batch)):
+    cookie = int(time.time())
+    start = time.time()
+    function(cookie)
+    posted = time.time()
+    wait_for(cookie)
+    end = time.time()
+
+    print "%s: posted %s inodes in %0.2fs, completed in %0.2fs (%0.0f inodes/s)" % (
+        name, len(inode_ids), posted - start, end - start,
+        len(inode_ids) / max(end - start, 0.001))
+
+    ## Make sure the next run gets a new cookie
+    time.sleep(1)
+
+sys.exit(0)
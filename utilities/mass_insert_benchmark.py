@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the rate at which mass_insert loads rows.
+
+The lines of an Apache access log are parsed and loaded into a table
+with regular inserts and then with LOAD DATA LOCAL INFILE.
+"""
+import sys,time,re
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+
+Registry.Init()
+
+config.set_usage(usage = """%prog [options] [access_log]
+
+Reports the number of rows per second loaded by mass_insert from an
+Apache common log format file. If no log is given, a synthetic log of
+--lines lines is used.
+
+The server must allow local_infile for the LOAD DATA run.
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("case", default=None,
+                  help="Case to load the table into")
+
+config.add_option("lines", default=5000000, type='int',
+                  help="Number of synthetic log lines")
+
+config.add_option("table", default="mass_insert_benchmark",
+                  help="The name of the benchmark table")
+
+config.parse_options(True)
+
+LINE_RE = re.compile(r'(\S+) (\S+) (\S+) \[([^\]]+)\] "([^"]*)" (\d+) (\S+)')
+
+def synthetic_lines():
+    for i in xrange(config.lines):
+        yield '10.%s.%s.%s - - [10/Oct/2008:13:%02d:%02d +1000] "GET /dir%s/page%s.html HTTP/1.1" 200 %s\n' % (
+            i % 256, i / 256 % 256, i / 65536 % 256, i / 60 % 60, i % 60,
+            i % 100, i, i * 7 % 50000)
+
+def lines():
+    if config.args:
+        return open(config.args[0])
+
+    return synthetic_lines()
+
+def load():
+    dbh = DB.DBO(config.case)
+    dbh.execute("drop table if exists `%s`", config.table)
+    dbh.execute("""create table `%s` (
+    `ip` varchar(15),
+    `ident` varchar(50),
+    `user` varchar(50),
+    `timestamp` varchar(50),
+    `request` text,
+    `status` int,
+    `size` int
+    )""", config.table)
+
+    dbh.mass_insert_start(config.table, _fast=True)
+    count = 0
+    for line in lines():
+        m = LINE_RE.match(line)
+        if not m: continue
+
+        ip, ident, user, timestamp, request, status, size = m.groups()
+        dbh.mass_insert(ip = ip, ident = ident, user = user,
+                        timestamp = timestamp, request = request,
+                        status = status, size = size)
+        count += 1
+
+    dbh.mass_insert_commit()
+    return count
+
+for name, infile in (("Insert", False), ("LOAD DATA INFILE", True)):
+    config.MASS_INSERT_INFILE = infile
+    ## Make sure new connections allow local infile
+    DB.mysql_connection_args = None
+    DB.PooledDBO.DBH.flush()
+
+    start = time.time()
+    count = load()
+    end = time.time()
+
+    print "%s: %s rows in %0.2fs (%0.0f rows/s)" % (
+        name, count, end - start, count / max(end - start, 0.001))
+
+sys.exit(0)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures how long Registry.Init takes to start up.
+
+Registry.Init only runs once in each process, so each run is a new
+python process. The first run has no plugin cache and walks the plugin
+directories, the others find the plugins through the cache.
+"""
+import sys,os,subprocess
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+
+config.set_usage(usage = """%prog [options]
+
+Times Registry.Init in new processes, without and then with the plugin
+cache. The processes use the PLUGINS and RESULTDIR settings of the
+configuration file.
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("runs", default=5, type='int',
+                  help="Number of runs using the plugin cache")
+
+config.parse_options(True)
+
+CHILD = """
+import sys,time
+start = time.time()
+import pyflag.Registry as Registry
+Registry.Init()
+print time.time() - start, len(sys.path)
+"""
+
+def run():
+    child = subprocess.Popen([sys.executable, "-c", CHILD], stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    elapsed, path_length = output.splitlines()[-1].split()
+    return float(elapsed), int(path_length)
+
+try:
+    os.unlink(Registry.plugin_cache_path())
+except OSError:
+    pass
+
+elapsed, path_length = run()
+print "No cache: %0.2fs (%s entries in sys.path)" % (elapsed, path_length)
+
+times = [ run()[0] for i in range(config.runs) ]
+print "Cached: %0.2fs best, %0.2fs average over %s runs" % (
+    min(times), sum(times) / len(times), len(times))
+
+sys.exit(0)
@@ -13,6 +13,9 @@ parser.add_option("-l", "--length", dest='length', default=None,
 parser.add_option("-t", "--types", dest='types', default=None,
                   help="File types to extract. ? lists all types supported")
 
+parser.add_option("-j", "--processes", default=None, type='int',
+                  help="Carve with this many processes (0 for one per CPU)")
+
 (options, args) = parser.parse_args()
 
 if options.types=="?":
@@ -47,7 +50,12 @@ for f in args:
 
     print "Carving file %s into directory %s" % (f, options.output)
 
-    for m in Exgrep.process('',fd):
+    if options.processes is None:
+        hits = Exgrep.process('',fd)
+    else:
+        hits = Exgrep.process_parallel(None, f, processes=options.processes)
+
+    for m in hits:
         fd2 = open("%s/%s.%s" % (options.output, m['offset'], m['type']), 'w')
         fd3.seek(m['offset'])
         fd2.write(fd3.read(m['length']))
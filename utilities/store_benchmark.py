@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures Store lookups as the store grows. Lookups should not slow
+down with the number of objects stored.
+"""
+import sys,time,random
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+from pyflag.Store import Store
+
+config.set_usage(usage = """%prog [options]
+
+Fills stores of increasing size and times lookups of randomly chosen
+objects in each.
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("sizes", default="100,10000,100000",
+                  help="Comma separated list of store sizes to try")
+
+config.add_option("lookups", default=10000, type='int',
+                  help="Number of lookups to time in each store")
+
+config.parse_options(True)
+
+for size in [ int(x) for x in config.sizes.split(",") ]:
+    s = Store(max_size = size)
+    keys = [ s.put(i) for i in range(size) ]
+    keys = [ random.choice(keys) for i in range(config.lookups) ]
+
+    start = time.time()
+    for k in keys:
+        s.get(k)
+
+    elapsed = time.time() - start
+    print "%s objects: %s lookups in %0.2fs (%0.0f/s)" % (
+        size, len(keys), elapsed, len(keys) / max(elapsed, 1e-6))
+
+sys.exit(0)
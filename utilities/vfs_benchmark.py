@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures how many VFS nodes per second we can create.
+
+Nodes are created one at a time with DBFS.VFSCreate, and then again
+with a VFS writer open (as the scanners do) so they are inserted in
+batches.
+"""
+import sys,time
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+import pyflag.FileSystem as FileSystem
+
+Registry.Init()
+
+config.set_usage(usage = """%prog [options]
+
+Creates synthetic VFS nodes under /vfs_benchmark in the case and
+reports the number of nodes per second created with and without a VFS
+writer. The nodes are removed afterwards.
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("case", default=None,
+                  help="Case to create the nodes in")
+
+config.add_option("nodes", default=100000, type='int',
+                  help="Number of nodes to create")
+
+config.add_option("directories", default=100, type='int',
+                  help="Number of directories to spread the nodes over")
+
+config.parse_options(True)
+
+if not config.case:
+    print "You must specify a case"
+    sys.exit(1)
+
+## Synthetic inode ids which should not clash with real ones
+FIRST_INODE_ID = 1000000000
+
+def cleanup():
+    dbh = DB.DBO(config.case)
+    dbh.delete("vfs", where="path like '/vfs_benchmark%' or "
+               "(path='/' and name='vfs_benchmark')")
+
+    ## The directories we removed are still in the cache
+    FileSystem.DIRECTORY_CACHE.clear()
+
+def create_nodes():
+    fsfd = FileSystem.DBFS(config.case)
+    for i in range(config.nodes):
+        fsfd.VFSCreate(None, "/vfs_benchmark/%s/stream%s" % (i % config.directories, i),
+                       inode_id = FIRST_INODE_ID + i)
+
+def single():
+    create_nodes()
+
+def batch():
+    FileSystem.open_vfs_writer(config.case)
+    try:
+        create_nodes()
+    finally:
+        FileSystem.close_vfs_writer(config.case)
+
+for name, function in (("Node at a time", single), ("Batched", batch)):
+    cleanup()
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+
+    print "%s: created %s nodes in %0.2fs (%0.0f nodes/s)" % (
+        name, config.nodes, elapsed, config.nodes / max(elapsed, 0.001))
+
+cleanup()
+sys.exit(0)
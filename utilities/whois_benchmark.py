@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Compares whois route lookups using the in memory route index with
+the database netmask walk.
+"""
+import sys,time,random
+import pyflag.conf
+config = pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+
+Registry.Init()
+
+import plugins.LogAnalysis.Whois as Whois
+
+config.set_usage(usage = """%prog [options]
+
+Looks up the whois route of a number of IP addresses, first with the
+database (one query per netmask tried) and then with the in memory
+route index, and checks they agree.
+
+The addresses are random unless a case, table and column are given,
+in which case they are taken from that IP column (e.g. of a loaded
+log table).
+""", version = "Version: %%prog PyFlag %s" % config.VERSION)
+
+config.add_option("case", default=None,
+                  help="Case to take addresses from")
+
+config.add_option("table", default=None,
+                  help="Table to take addresses from")
+
+config.add_option("column", default=None,
+                  help="The IP column to take addresses from")
+
+config.add_option("addresses", default=10000, type='int',
+                  help="Number of addresses to look up")
+
+config.parse_options(True)
+
+if config.case and config.table and config.column:
+    dbh = DB.DBO(config.case)
+    dbh.execute("select inet_ntoa(`%s`) as ip from `%s` limit %s",
+                (config.column, config.table, config.addresses))
+    ips = [ row['ip'] for row in dbh if row['ip'] ]
+else:
+    ips = [ "%s.%s.%s.%s" % tuple([ random.randint(0,255) for i in range(4) ]) \
+            for i in range(config.addresses) ]
+
+dbh = DB.DBO()
+start = time.time()
+sql_ids = [ Whois.lookup_whois_id_sql(dbh, ip) for ip in ips ]
+sql_time = time.time() - start
+
+print "Database: %s lookups in %0.2fs (%0.0f/s)" % (
+    len(ips), sql_time, len(ips) / max(sql_time, 0.001))
+
+start = time.time()
+index = Whois.get_route_index()
+load_time = time.time() - start
+print "Route index: loaded %s routes as %s intervals in %0.2fs" % (
+    index.routes, len(index), load_time)
+
+start = time.time()
+index_ids = index.lookup_many(ips)
+index_time = time.time() - start
+
+print "Route index: %s lookups in %0.2fs (%0.0f/s)" % (
+    len(ips), index_time, len(ips) / max(index_time, 0.001))
+
+mismatches = [ (ip, a, b) for ip, a, b in zip(ips, sql_ids, index_ids) if a != b ]
+for ip, a, b in mismatches[:10]:
+    print "Mismatch for %s: database %s, index %s" % (ip, a, b)
+
+print "%s mismatches" % len(mismatches)
+
+sys.exit(0)